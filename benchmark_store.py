@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""
+消息存储基准测试脚本
+用合成的群聊数据测量各存储后端的写入吞吐、查询延迟、启动加载时间和内存占用，
+不依赖 Telegram 和 OpenAI，结果以 JSON 输出便于在升级前后对比
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from loguru import logger
+
+from bot.services.message_store import MessageStore
+from bot.services.sqlite_message_store import SQLiteMessageStore
+
+# 合成消息用到的常用汉字和英文单词
+SAMPLE_CJK = (
+    "的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动"
+    "同工也能下过子说产种面而方后多定行学法所民得经十三之进着等部度家电力里如水化高自"
+    "二理起小物现实加量都两体制机当使点从业本去把性好应开它合还因由其些然前外天政四日"
+)
+ASCII_WORDS = (
+    "the bot redis deploy python release server update config docker cache "
+    "error fix test build merge branch token model prompt summary search"
+).split()
+
+# 合成消息：(chat_id, user_id, username, 消息内容, 时间)
+SyntheticMessage = Tuple[int, int, str, str, datetime]
+
+
+def synthetic_text(rng: random.Random, cjk_ratio: float) -> str:
+    """生成一条中英文混合的消息，长度大致符合群聊中的短消息分布"""
+    if rng.random() < cjk_ratio:
+        length = max(2, int(rng.lognormvariate(2.5, 0.8)))
+        return "".join(rng.choice(SAMPLE_CJK) for _ in range(length))
+    length = max(1, int(rng.lognormvariate(1.8, 0.7)))
+    return " ".join(rng.choice(ASCII_WORDS) for _ in range(length))
+
+
+def generate_workload(
+    chats: int,
+    messages_per_chat: int,
+    users_per_chat: int = 50,
+    cjk_ratio: float = 0.7,
+    span_hours: float = 48,
+    burst_probability: float = 0.1,
+    seed: int = 42,
+) -> Iterator[SyntheticMessage]:
+    """按时间顺序生成所有聊天的合成消息
+
+    到达时间为突发式：大多数消息之间间隔服从指数分布，
+    以 burst_probability 的概率出现一段几秒内连续发送的消息。
+    """
+    rng = random.Random(seed)
+    total = chats * messages_per_chat
+    start = datetime.now(timezone.utc) - timedelta(hours=span_hours)
+    mean_gap = span_hours * 3600 / max(1, total)
+
+    remaining = {chat_id: messages_per_chat for chat_id in range(1, chats + 1)}
+    offset = 0.0
+    while remaining:
+        chat_id = rng.choice(list(remaining))
+        burst = rng.randint(5, 30) if rng.random() < burst_probability else 1
+        burst = min(burst, remaining[chat_id])
+        for _ in range(burst):
+            if burst > 1:
+                offset += rng.uniform(0.1, 2.0)
+            else:
+                offset += rng.expovariate(1 / mean_gap)
+            user_id = rng.randint(1, users_per_chat)
+            yield (
+                -1000000000000 - chat_id,
+                user_id,
+                f"user_{chat_id}_{user_id}",
+                synthetic_text(rng, cjk_ratio),
+                start + timedelta(seconds=min(offset, span_hours * 3600)),
+            )
+        remaining[chat_id] -= burst
+        if not remaining[chat_id]:
+            del remaining[chat_id]
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """计算毫秒级延迟的 p50、p95、p99 和最大值（最近秩法）"""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def rank(p: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))], 3)
+
+    return {
+        "count": len(ordered),
+        "p50_ms": rank(0.50),
+        "p95_ms": rank(0.95),
+        "p99_ms": rank(0.99),
+        "max_ms": round(ordered[-1], 3),
+    }
+
+
+def current_rss_mb() -> float:
+    """当前进程的常驻内存（MB），无法读取 /proc 时退回到峰值常驻内存，都不支持时返回 0"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            pages = int(f.read().split()[1])
+        return round(pages * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024, 1)
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS 以字节为单位，Linux 以 KB 为单位
+    return round(peak / 1024 / (1024 if sys.platform == "darwin" else 1), 1)
+
+
+def measure_latency(
+    fn: Callable[[int], Any], chat_ids: List[int], rounds: int
+) -> List[float]:
+    """对每个聊天调用 fn rounds 次，返回每次调用的毫秒耗时"""
+    samples = []
+    for _ in range(rounds):
+        for chat_id in chat_ids:
+            started = time.perf_counter()
+            fn(chat_id)
+            samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+
+class BackendFactory:
+    """创建、重新打开和销毁某个后端的测试实例"""
+
+    def __init__(self, name: str, workdir: str, redis_client=None):
+        self.name = name
+        self.workdir = workdir
+        self.redis_client = redis_client
+        self.prefix = f"bench:{uuid.uuid4().hex[:8]}:"
+
+    def open(self):
+        """打开（或重新打开）后端实例"""
+        if self.name == "file":
+            return MessageStore(
+                storage_dir=os.path.join(self.workdir, "file"), lazy=True
+            )
+        if self.name == "file-eager":
+            return MessageStore(
+                storage_dir=os.path.join(self.workdir, "file-eager"), lazy=False
+            )
+        if self.name == "sqlite":
+            return SQLiteMessageStore(
+                db_path=os.path.join(self.workdir, "messages.db")
+            )
+        if self.name == "redis":
+            from bot.services.redis_message_store import RedisMessageStore
+
+            return RedisMessageStore(self.redis_client, key_prefix=self.prefix)
+        raise ValueError(f"未知的存储后端: {self.name}")
+
+    def close(self, store):
+        """写入剩余数据并释放实例"""
+        store.flush()
+        if hasattr(store, "close"):
+            store.close()
+
+    def destroy(self):
+        """删除测试数据"""
+        if self.name == "redis" and self.redis_client is not None:
+            keys = list(self.redis_client.scan_iter(match=f"{self.prefix}*"))
+            if keys:
+                self.redis_client.delete(*keys)
+
+
+def run_backend(
+    factory: BackendFactory, workload: List[SyntheticMessage], rounds: int
+) -> Dict[str, Any]:
+    """对一个后端依次测量写入、查询、重新加载和内存占用"""
+    chat_ids = sorted({message[0] for message in workload})
+    rss_before = current_rss_mb()
+
+    store = factory.open()
+    started = time.perf_counter()
+    for chat_id, user_id, username, text, timestamp in workload:
+        store.add_message(chat_id, user_id, username, text, timestamp)
+    store.flush()
+    ingest_seconds = time.perf_counter() - started
+
+    recent = measure_latency(
+        lambda chat_id: store.get_recent_messages(chat_id, hours=24), chat_ids, rounds
+    )
+    stats = measure_latency(store.get_chat_stats, chat_ids, rounds)
+    rss_loaded = current_rss_mb()
+    factory.close(store)
+    del store
+
+    # 重新打开：构造耗时即启动时间，之后逐个访问所有聊天得到完整预热时间
+    started = time.perf_counter()
+    store = factory.open()
+    startup_seconds = time.perf_counter() - started
+    first_access = measure_latency(store.get_chat_stats, chat_ids, 1)
+    warm_seconds = time.perf_counter() - started
+    factory.close(store)
+
+    return {
+        "messages": len(workload),
+        "chats": len(chat_ids),
+        "ingest": {
+            "seconds": round(ingest_seconds, 3),
+            "messages_per_second": round(len(workload) / ingest_seconds, 1)
+            if ingest_seconds
+            else None,
+        },
+        "get_recent_messages": percentiles(recent),
+        "get_chat_stats": percentiles(stats),
+        "startup": {
+            "open_seconds": round(startup_seconds, 4),
+            "warm_seconds": round(warm_seconds, 4),
+            "first_access": percentiles(first_access),
+        },
+        "rss_mb": {"before": rss_before, "loaded": rss_loaded},
+    }
+
+
+def resolve_redis_client(url: Optional[str]):
+    """获取基准测试使用的 Redis 客户端，不可用时返回 None"""
+    if url:
+        import redis
+
+        client = redis.Redis.from_url(url, decode_responses=True)
+        client.ping()
+        return client
+
+    from config.settings import config_manager
+
+    return config_manager.redis_client
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="消息存储基准测试")
+    parser.add_argument(
+        "--backends",
+        default="file,file-eager,sqlite,redis",
+        help="逗号分隔的后端列表：file、file-eager、sqlite、redis",
+    )
+    parser.add_argument("--chats", type=int, default=20, help="聊天数量")
+    parser.add_argument("--messages", type=int, default=2000, help="每个聊天的消息数")
+    parser.add_argument("--users", type=int, default=50, help="每个聊天的用户数")
+    parser.add_argument("--cjk-ratio", type=float, default=0.7, help="中文消息的比例")
+    parser.add_argument("--span-hours", type=float, default=48, help="消息覆盖的小时数")
+    parser.add_argument("--burst", type=float, default=0.1, help="出现突发消息的概率")
+    parser.add_argument("--rounds", type=int, default=5, help="每个聊天的查询轮数")
+    parser.add_argument("--seed", type=int, default=42, help="随机种子")
+    parser.add_argument("--redis-url", help="Redis 地址，默认使用机器人配置中的连接")
+    parser.add_argument("--output", help="结果 JSON 文件路径，默认输出到标准输出")
+    args = parser.parse_args()
+
+    # 存储内部的逐条日志会严重干扰计时，只保留警告以上
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    workload = list(
+        generate_workload(
+            args.chats,
+            args.messages,
+            users_per_chat=args.users,
+            cjk_ratio=args.cjk_ratio,
+            span_hours=args.span_hours,
+            burst_probability=args.burst,
+            seed=args.seed,
+        )
+    )
+
+    results: Dict[str, Any] = {}
+    workdir = tempfile.mkdtemp(prefix="snaily-bench-")
+    try:
+        for name in [b.strip() for b in args.backends.split(",") if b.strip()]:
+            redis_client = None
+            if name == "redis":
+                try:
+                    redis_client = resolve_redis_client(args.redis_url)
+                except Exception as e:
+                    logger.warning(f"无法连接 Redis: {e}")
+                if redis_client is None:
+                    results[name] = {"skipped": "Redis 不可用"}
+                    continue
+
+            print(f"⏱️ 正在测试 {name} 后端...", file=sys.stderr)
+            factory = BackendFactory(name, workdir, redis_client)
+            try:
+                results[name] = run_backend(factory, workload, args.rounds)
+            finally:
+                factory.destroy()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "time": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "params": vars(args),
+        },
+        "results": results,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+        print(f"✅ 结果已写入 {args.output}", file=sys.stderr)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,14 +2,17 @@
 AI 对话和搜索功能处理器
 """
 
+import contextlib
+
 from loguru import logger
 from telegram import Update
 from telegram.ext import ContextTypes
 
 from bot.handlers.common import delete_messages_after_delay
 from bot.services.ai_services import ai_services
-from bot.services.message_store import message_store
+from bot.services.async_message_store import async_message_store
 from bot.utils.helpers import escape_markdown_v2
+from bot.utils.stream_reply import StreamingReply
 from config.settings import config_manager
 
 
@@ -109,7 +112,7 @@ async def _chat_with_ai(update: Update, text: str) -> None:
             )
 
             # 获取历史对话记录
-            history = message_store.get_dialog_history(
+            history = await async_message_store.get_dialog_history(
                 chat.id, limit=history_max_length
             )
 
@@ -117,7 +120,7 @@ async def _chat_with_ai(update: Update, text: str) -> None:
             user_message = {"role": "user", "content": text}
 
             # 保存用户消息到历史记录
-            message_store.add_dialog_message(chat.id, user_message)
+            await async_message_store.add_dialog_message(chat.id, user_message)
 
             # 更新历史记录，包含当前用户消息
             updated_history = history + [user_message]
@@ -126,9 +129,16 @@ async def _chat_with_ai(update: Update, text: str) -> None:
             user_message = {"role": "user", "content": text}
             updated_history = [user_message]
 
+        if config_manager.get("features.chat.stream_enabled", True):
+            await _stream_chat_reply(
+                thinking_message, updated_history, user.id, chat.id, history_enabled
+            )
+            logger.info(f"用户 {user.id} ({user.username}) 完成AI对话")
+            return
+
         # 调用 AI 服务
         ai_response = await ai_services.chat_completion(
-            history=updated_history, user_id=user.id
+            history=updated_history, user_id=user.id, feature="chat"
         )
 
         if ai_response:
@@ -137,7 +147,9 @@ async def _chat_with_ai(update: Update, text: str) -> None:
 
             # 只有在历史功能启用时才保存AI回复到历史记录
             if history_enabled:
-                message_store.add_dialog_message(chat.id, assistant_message)
+                await async_message_store.add_dialog_message(
+                    chat.id, assistant_message
+                )
 
             # 删除"正在思考"消息并发送回复
             await thinking_message.delete()
@@ -155,6 +167,36 @@ async def _chat_with_ai(update: Update, text: str) -> None:
             await update.effective_message.reply_text("抱歉，处理对话时出现错误。")
 
 
+async def _stream_chat_reply(
+    thinking_message,
+    history: list,
+    user_id: int,
+    chat_id: int,
+    history_enabled: bool,
+) -> None:
+    """流式调用 AI，并把回复逐步编辑到“正在思考”消息中"""
+    reply = StreamingReply(
+        thinking_message,
+        min_interval=config_manager.get("features.chat.stream_edit_interval", 1.0),
+    )
+    # 生成器在调度槽位内产出增量，必须确定性关闭以及时释放槽位
+    stream = ai_services.stream_chat_completion(history, user_id)
+    async with contextlib.aclosing(stream) as deltas:
+        async for delta in deltas:
+            await reply.append(delta)
+    ai_response = await reply.finish()
+
+    if not ai_response.strip():
+        await thinking_message.edit_text("抱歉，AI 服务暂时不可用，请稍后再试。")
+        return
+
+    # 只有在历史功能启用时才保存AI回复到历史记录
+    if history_enabled:
+        await async_message_store.add_dialog_message(
+            chat_id, {"role": "assistant", "content": ai_response}
+        )
+
+
 async def chat_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """处理 /chat 命令"""
     if not (
@@ -338,7 +380,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         # 如果是群聊，无论如何都先记录消息
         if chat.type in ["group", "supergroup"]:
             if config_manager.is_feature_enabled("auto_summary") and message.text:
-                message_store.add_message(
+                await async_message_store.add_message(
                     chat_id=chat.id,
                     user_id=user.id,
                     username=user.username or user.first_name,
@@ -373,7 +415,7 @@ async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         chat = update.effective_chat
 
         # 清除对话历史记录
-        message_store.clear_dialog_history(chat.id)
+        await async_message_store.clear_dialog_history(chat.id)
 
         # 发送确认消息并保存返回的 Message 对象
         sent_message = await update.effective_message.reply_text(
@@ -141,6 +141,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 • **自动总结** - 定期总结群聊内容的重要话题
 • **智能欢迎** - 自动欢迎新成员并介绍群规
 • **消息记录** - 为总结功能收集群聊消息
+• `/find <关键词>` - 查找群聊历史消息，可加时间范围如 `/find 3d 发布`
 
 ⚙️ **使用提示：**
 • 所有功能都支持中文
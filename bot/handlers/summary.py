@@ -3,6 +3,9 @@
 """
 
 import asyncio
+import re
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.jobstores.base import JobLookupError
@@ -11,8 +14,10 @@ from telegram import Update
 from telegram.ext import ContextTypes
 
 from bot.handlers.common import delete_messages_after_delay
+from bot.services.ai_scheduler import PRIORITY_SCHEDULED
 from bot.services.ai_services import ai_services
-from bot.services.message_store import message_store
+from bot.services.async_message_store import async_message_store
+from bot.services.message_index import make_snippet
 from config.settings import config_manager
 
 
@@ -54,15 +59,26 @@ async def auto_summary_job(application):
         min_messages = summary_config.get("min_messages", 50)
         interval_hours = summary_config.get("interval_hours", 24)
 
-        # 获取所有有消息的聊天
-        for chat_id in message_store.messages.keys():
+        # 本次任务的所有聊天共用同一个时间窗口
+        window_end = datetime.now(timezone.utc)
+        window_start = window_end - timedelta(hours=interval_hours)
+
+        # 先用增量统计筛掉消息明显不足的聊天，无需读取消息内容
+        candidate_chat_ids = await async_message_store.get_active_chat_ids(
+            window_start, min_messages
+        )
+        logger.debug(f"自动总结候选聊天: {len(candidate_chat_ids)} 个")
+
+        for chat_id in candidate_chat_ids:
             try:
                 # 检查消息数量是否达到最小要求
-                message_count = message_store.get_message_count(chat_id, interval_hours)
+                message_count = await async_message_store.count_messages_between(
+                    chat_id, window_start, window_end
+                )
 
                 if message_count >= min_messages:
                     await generate_and_send_summary(
-                        application, chat_id, interval_hours
+                        application, chat_id, interval_hours, window_start, window_end
                     )
                 else:
                     logger.debug(
@@ -78,11 +94,46 @@ async def auto_summary_job(application):
         logger.error(f"自动总结任务失败: {e}")
 
 
-async def generate_and_send_summary(application, chat_id: int, hours: int = 24):
-    """生成并发送群聊总结"""
+async def collect_summary_messages(
+    chat_id: int, start: datetime, end: Optional[datetime] = None
+) -> List[str]:
+    """按 token 预算收集时间窗口内最近的消息，按时间顺序返回
+
+    从最新的消息开始流式读取，预算用完即停止，窗口很大时也不会读入全部消息。
+    """
+    max_tokens = config_manager.get("features.auto_summary.max_input_tokens", 16000)
+    messages = [
+        line
+        async for line in async_message_store.iter_messages_between(
+            chat_id, start, end, newest_first=True, max_tokens=max_tokens
+        )
+    ]
+    messages.reverse()
+    return messages
+
+
+async def generate_and_send_summary(
+    application,
+    chat_id: int,
+    hours: int = 24,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+):
+    """生成并发送群聊总结
+
+    Args:
+        application: Telegram 应用实例
+        chat_id: 聊天ID
+        hours: 总结的时间范围（小时），未指定 start 时用于计算窗口起点
+        start: 时间窗口起点（包含）
+        end: 时间窗口终点（不包含），为空表示直到当前
+    """
     try:
-        # 获取最近的消息
-        recent_messages = message_store.get_recent_messages(chat_id, hours)
+        if start is None:
+            start = datetime.now(timezone.utc) - timedelta(hours=hours)
+
+        # 获取时间窗口内的消息（超出预算时只保留最近的部分）
+        recent_messages = await collect_summary_messages(chat_id, start, end)
 
         if not recent_messages:
             logger.debug(f"聊天 {chat_id} 没有最近消息，跳过总结")
@@ -90,7 +141,7 @@ async def generate_and_send_summary(application, chat_id: int, hours: int = 24):
 
         # 生成总结
         summary = await ai_services.summarize_messages(
-            recent_messages, f"群聊 {chat_id}"
+            recent_messages, f"群聊 {chat_id}", priority=PRIORITY_SCHEDULED
         )
 
         if summary:
@@ -185,8 +236,14 @@ async def summary_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             f"📝 正在生成最近 {hours} 小时的群聊总结..."
         )
 
+        # 计数和取消息使用同一个时间窗口
+        window_end = datetime.now(timezone.utc)
+        window_start = window_end - timedelta(hours=hours)
+
         # 获取消息数量
-        message_count = message_store.get_message_count(chat.id, hours)
+        message_count = await async_message_store.count_messages_between(
+            chat.id, window_start, window_end
+        )
 
         if message_count == 0:
             await generating_message.edit_text(f"📝 最近 {hours} 小时内没有消息记录。")
@@ -200,8 +257,10 @@ async def summary_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             )
             return
 
-        # 获取最近的消息
-        recent_messages = message_store.get_recent_messages(chat.id, hours)
+        # 获取时间窗口内的消息（超出预算时只保留最近的部分）
+        recent_messages = await collect_summary_messages(
+            chat.id, window_start, window_end
+        )
 
         # 生成总结
         summary = await ai_services.summarize_messages(
@@ -212,7 +271,7 @@ async def summary_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             await generating_message.delete()
 
             # 添加统计信息
-            stats = message_store.get_chat_stats(chat.id)
+            stats = await async_message_store.get_chat_stats(chat.id)
             summary_with_stats = f"{summary}\n\n📊 **统计信息：**\n"
             summary_with_stats += f"• 总结时间范围: {hours} 小时\n"
             summary_with_stats += f"• 消息数量: {message_count} 条\n"
@@ -253,7 +312,7 @@ async def summary_stats_command(
             return
 
         # 获取统计信息
-        stats = message_store.get_chat_stats(chat.id)
+        stats = await async_message_store.get_chat_stats(chat.id)
 
         stats_text = f"""
 📊 **群聊统计信息**
@@ -281,12 +340,69 @@ async def summary_stats_command(
             await update.message.reply_text("抱歉，获取统计信息时出现错误。")
 
 
+async def find_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """在群聊消息索引中检索关键词，不调用 AI"""
+    try:
+        user = update.effective_user
+        chat = update.effective_chat
+        message = update.message
+
+        # 基本检查
+        if not user or not chat or not message:
+            return
+
+        # 检查是否在群组中
+        if chat.type not in ["group", "supergroup"]:
+            await message.reply_text("此命令只能在群组中使用。")
+            return
+
+        # 可选的时间范围参数：/find 12h 关键词 或 /find 3d 关键词
+        args = list(context.args or [])
+        start = None
+        if args and re.fullmatch(r"\d+[hd]", args[0].lower()):
+            spec = args.pop(0).lower()
+            hours = int(spec[:-1]) * (24 if spec.endswith("d") else 1)
+            if hours <= 0:
+                await message.reply_text("时间范围必须大于 0。")
+                return
+            start = datetime.now(timezone.utc) - timedelta(hours=hours)
+
+        query = " ".join(args).strip()
+        if not query:
+            await message.reply_text(
+                "请提供要查找的关键词，例如：`/find 周末聚餐` 或 `/find 3d 发布`",
+                parse_mode="MarkdownV2",
+            )
+            return
+
+        results = await async_message_store.search(chat.id, query, start, limit=5)
+        if not results:
+            await message.reply_text(f"🔎 没有找到与“{query}”相关的消息。")
+            return
+
+        lines = [f"🔎 与“{query}”最相关的 {len(results)} 条消息："]
+        for result in results:
+            sent_at = datetime.fromisoformat(result["timestamp"]).strftime("%m-%d %H:%M")
+            snippet = make_snippet(result["message"], query)
+            lines.append(f"[{sent_at}] {result['username']}: {snippet}")
+
+        bot_message = await message.reply_text("\n".join(lines))
+        asyncio.create_task(delete_messages_after_delay(message, bot_message, 300))
+
+        logger.info(f"用户 {user.id} 在群聊 {chat.id} 检索了消息，结果 {len(results)} 条")
+
+    except Exception as e:
+        logger.error(f"处理 /find 命令时出错: {e}")
+        if update.message:
+            await update.message.reply_text("抱歉，检索消息时出现错误。")
+
+
 async def setup_cleanup_scheduler(scheduler, message_store):
     """设置历史文件清理定时任务
 
     Args:
         scheduler: AsyncIOScheduler 实例
-        message_store: MessageStore 实例
+        message_store: AsyncMessageStore 实例
     """
     try:
         job_id = "cleanup_expired_files"
@@ -334,11 +450,12 @@ async def cleanup_expired_files_job(message_store):
     """清理过期文件的定时任务
 
     Args:
-        message_store: MessageStore 实例
+        message_store: AsyncMessageStore 实例
     """
     try:
         logger.info("开始执行定时清理任务...")
-        message_store.cleanup_expired_files()
+        await message_store.compact_all()
+        await message_store.cleanup_expired_files()
         logger.info("定时清理任务完成")
 
     except Exception as e:
@@ -48,6 +48,7 @@ from bot.handlers.common import (
 from bot.handlers.draw import draw_command, draw_help_command
 from bot.handlers.hotspot_push import setup_hotspot_push_scheduler
 from bot.handlers.summary import (
+    find_command,
     setup_cleanup_scheduler,
     setup_summary_scheduler,
     summary_command,
@@ -100,6 +101,15 @@ class TelegramBot:
             # 设置定时任务
             await self.setup_schedulers()
 
+            # 启动消息存储和索引的后台延迟写入
+            if config_manager.get("storage.write_behind", True):
+                from bot.services.async_message_store import async_message_store
+
+                async_message_store.start_flusher()
+
+            # 启动 AI 服务商的后台健康探测
+            ai_services.start_health_checks()
+
             # 设置机器人命令菜单
             await self.setup_bot_commands()
             logger.info("Telegram 机器人应用已成功初始化")
@@ -145,6 +155,7 @@ class TelegramBot:
         if config_manager.is_feature_enabled("auto_summary"):
             app.add_handler(CommandHandler("summary", summary_command))
             app.add_handler(CommandHandler("summary_stats", summary_stats_command))
+            app.add_handler(CommandHandler("find", find_command))
 
         # 新成员欢迎
         if config_manager.is_feature_enabled("welcome_message"):
@@ -172,9 +183,9 @@ class TelegramBot:
             await setup_summary_scheduler(self.application, self.scheduler)
 
         # 历史文件清理定时任务
-        from bot.services.message_store import message_store
+        from bot.services.async_message_store import async_message_store
 
-        await setup_cleanup_scheduler(self.scheduler, message_store)
+        await setup_cleanup_scheduler(self.scheduler, async_message_store)
 
         # 热点新闻推送定时任务
         await setup_hotspot_push_scheduler(self.application, self.scheduler)
@@ -212,6 +223,7 @@ class TelegramBot:
                 BotCommand("ask_gb", "询问 GEMINI BALANCE 相关问题"),
                 BotCommand("draw", "生成一张图片 (格式: /draw <描述>)"),
                 BotCommand("summary", "总结群聊消息"),
+                BotCommand("find", "查找群聊历史消息 (格式: /find <关键词>)"),
                 BotCommand("reset", "重置当前对话历史"),
                 BotCommand("status", "查看机器人当前状态"),
             ]
@@ -300,6 +312,15 @@ class TelegramBot:
                 except Exception as e:
                     logger.warning(f"停止应用程序时出现警告: {e}")
 
+            # 等待已提交的存储操作完成，再停止延迟写入并写入尚未持久化的数据
+            from bot.services.async_message_store import async_message_store
+
+            await async_message_store.close()
+            await async_message_store.stop_flusher()
+
+            # 停止 AI 服务商健康探测并关闭连接池
+            await ai_services.close()
+
             self._is_stopped = True
             logger.info("机器人已成功停止")
 
@@ -0,0 +1,364 @@
+"""
+AI 服务商路由
+把配置中的多个 OpenAI 兼容服务商作为一个池使用：按策略排列候选顺序，
+每个服务商有独立的熔断器和延迟统计，后台定期探测健康状况
+"""
+
+import asyncio
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import httpx
+import openai
+from loguru import logger
+
+ROUTING_STRATEGIES = ("priority", "round_robin", "least_latency")
+
+
+class NoProviderAvailableError(Exception):
+    """没有配置可用的服务商，或所有服务商都处于熔断状态"""
+
+
+def is_provider_error(error: BaseException) -> bool:
+    """判断异常是否说明服务商本身出了问题（应计入熔断并切换到下一个服务商）
+
+    连接失败、超时、限流、认证失败和 5xx 属于服务商问题；
+    400 等由请求内容导致的错误换一个服务商通常也无济于事，直接抛给调用方。
+    """
+    if isinstance(
+        error,
+        (
+            openai.APIConnectionError,
+            openai.RateLimitError,
+            openai.AuthenticationError,
+            openai.PermissionDeniedError,
+            asyncio.TimeoutError,
+        ),
+    ):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code >= 500
+    return False
+
+
+class CircuitBreaker:
+    """熔断器
+
+    连续失败达到 failure_threshold 次后打开，recovery_timeout 秒内不再放行请求；
+    冷却结束后进入半开状态放行一个试探请求，成功则关闭，失败则重新打开。
+    试探请求超过 recovery_timeout 仍未报告结果时，允许下一个试探请求。
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, recovery_timeout: float = 30.0):
+        self.failure_threshold = max(1, failure_threshold)
+        self.recovery_timeout = max(0.0, recovery_timeout)
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self._changed_at = 0.0  # 打开或开始试探的时间
+
+    def available(self) -> bool:
+        """是否可以放行请求（不改变状态）"""
+        if self.state == self.CLOSED:
+            return True
+        return time.monotonic() - self._changed_at >= self.recovery_timeout
+
+    def allow(self) -> bool:
+        """尝试放行一个请求，打开状态冷却结束时转为半开并占用试探名额"""
+        if not self.available():
+            return False
+        if self.state != self.CLOSED:
+            self.state = self.HALF_OPEN
+            self._changed_at = time.monotonic()
+        return True
+
+    def record_success(self):
+        """请求成功，关闭熔断器"""
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+
+    def record_failure(self):
+        """请求失败，达到阈值或试探失败时打开熔断器"""
+        self.consecutive_failures += 1
+        if (
+            self.state == self.HALF_OPEN
+            or self.consecutive_failures >= self.failure_threshold
+        ):
+            if self.state != self.OPEN:
+                logger.warning(
+                    f"AI 服务商熔断器打开 - 连续失败 {self.consecutive_failures} 次，"
+                    f"{self.recovery_timeout:.0f} 秒后试探恢复"
+                )
+            self.state = self.OPEN
+            self._changed_at = time.monotonic()
+
+
+class Provider:
+    """一个 OpenAI 兼容的服务商及其运行统计"""
+
+    def __init__(
+        self,
+        index: int,
+        config: Dict[str, Any],
+        client: openai.AsyncOpenAI,
+        breaker: CircuitBreaker,
+    ):
+        self.index = index
+        self.config = config
+        self.client = client
+        # 构建客户端时的 (API Key, 接口地址)；配置字典可能被原地修改，不能每次从配置读取
+        self.client_key = provider_client_key(config)
+        self.breaker = breaker
+        self.requests = 0
+        self.failures = 0
+        self.ewma_latency: Optional[float] = None  # 秒
+        self.last_error = ""
+        self.healthy: Optional[bool] = None  # 最近一次探测结果，尚未探测时为 None
+        self.last_probe_ms: Optional[float] = None
+
+    @property
+    def name(self) -> str:
+        return self.config.get("name") or f"配置 {self.index}"
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取该服务商的延迟、错误率和熔断状态"""
+        return {
+            "index": self.index,
+            "name": self.name,
+            "base_url": self.client_key[1],
+            "model": self.config.get("model"),
+            "state": self.breaker.state,
+            "healthy": self.healthy,
+            "requests": self.requests,
+            "failures": self.failures,
+            "error_rate": self.failures / self.requests if self.requests else 0.0,
+            "ewma_latency_ms": round(self.ewma_latency * 1000, 1)
+            if self.ewma_latency is not None
+            else None,
+            "last_probe_ms": self.last_probe_ms,
+            "last_error": self.last_error,
+        }
+
+
+def provider_client_key(config: Dict[str, Any]) -> Tuple[str, str]:
+    """服务商配置中的 (API Key, 接口地址)"""
+    return (
+        config.get("api_key") or "",
+        config.get("api_base_url") or "https://api.openai.com/v1",
+    )
+
+
+class ProviderRouter:
+    """服务商池
+
+    - priority：活动配置优先，其余按配置顺序作为备用
+    - round_robin：每次请求从下一个服务商开始轮转
+    - least_latency：按请求耗时的指数加权移动平均（EWMA）从低到高，
+      尚无统计的服务商排在最前以便尽快获得数据
+
+    候选顺序中跳过熔断中的服务商；所有服务商共享同一个 HTTP 连接池。
+    """
+
+    def __init__(
+        self,
+        http_client: httpx.AsyncClient,
+        strategy: str = "priority",
+        failure_threshold: int = 5,
+        recovery_timeout: float = 30.0,
+        ewma_alpha: float = 0.3,
+        probe_interval: float = 60.0,
+        probe_timeout: float = 10.0,
+    ):
+        self.http_client = http_client
+        self.providers: List[Provider] = []
+        self.primary: Optional[Provider] = None
+        self.configure(
+            strategy=strategy,
+            failure_threshold=failure_threshold,
+            recovery_timeout=recovery_timeout,
+            ewma_alpha=ewma_alpha,
+            probe_interval=probe_interval,
+            probe_timeout=probe_timeout,
+        )
+        self._rotation = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def configure(
+        self,
+        strategy: str = "priority",
+        failure_threshold: int = 5,
+        recovery_timeout: float = 30.0,
+        ewma_alpha: float = 0.3,
+        probe_interval: float = 60.0,
+        probe_timeout: float = 10.0,
+    ):
+        """更新路由参数，已有服务商的熔断器同步使用新阈值"""
+        if strategy not in ROUTING_STRATEGIES:
+            logger.warning(f"未知的 AI 路由策略 {strategy}，使用 priority")
+            strategy = "priority"
+        self.strategy = strategy
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.ewma_alpha = min(1.0, max(0.01, ewma_alpha))
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        for provider in getattr(self, "providers", []):
+            provider.breaker.failure_threshold = max(1, failure_threshold)
+            provider.breaker.recovery_timeout = max(0.0, recovery_timeout)
+
+    def sync(self, configs: List[Dict[str, Any]], active_index: int):
+        """按最新配置重建服务商列表
+
+        API Key 和接口地址不变的服务商沿用原有客户端、熔断器和统计，
+        缺少 API Key 的配置被忽略。活动配置排在最前并作为主服务商。
+        """
+        existing = {p.client_key: p for p in self.providers}
+        providers: List[Provider] = []
+        for index, config in enumerate(configs):
+            key = provider_client_key(config)
+            if not key[0]:
+                continue
+            provider = existing.pop(key, None)
+            if provider is None:
+                client = openai.AsyncOpenAI(
+                    api_key=key[0], base_url=key[1], http_client=self.http_client
+                )
+                provider = Provider(
+                    index,
+                    config,
+                    client,
+                    CircuitBreaker(self.failure_threshold, self.recovery_timeout),
+                )
+                logger.info(
+                    f"OpenAI 客户端初始化或更新成功，使用配置: {provider.name}，base_url: {key[1]}"
+                )
+            else:
+                provider.index = index
+                provider.config = config
+            providers.append(provider)
+
+        providers.sort(key=lambda p: p.index != active_index)
+        self.providers = providers
+        self.primary = providers[0] if providers else None
+
+    def _ordered(self) -> List[Provider]:
+        """按路由策略排列全部服务商"""
+        providers = list(self.providers)
+        if self.strategy == "round_robin" and providers:
+            start = self._rotation % len(providers)
+            self._rotation += 1
+            providers = providers[start:] + providers[:start]
+        elif self.strategy == "least_latency":
+            providers.sort(key=lambda p: p.ewma_latency or 0.0)
+        return providers
+
+    def candidates(self) -> Iterator[Provider]:
+        """按策略依次产出可以放行请求的服务商
+
+        惰性求值：只有真正尝试某个服务商时才占用其熔断器的试探名额。
+
+        Raises:
+            NoProviderAvailableError: 一个可用的服务商都没有
+        """
+        tried = False
+        for provider in self._ordered():
+            if provider.breaker.allow():
+                tried = True
+                yield provider
+        if not tried:
+            raise NoProviderAvailableError("没有可用的 AI 服务商")
+
+    def record_success(self, provider: Provider, latency: float):
+        """记录一次成功请求及其耗时"""
+        provider.requests += 1
+        provider.breaker.record_success()
+        if provider.ewma_latency is None:
+            provider.ewma_latency = latency
+        else:
+            provider.ewma_latency += self.ewma_alpha * (latency - provider.ewma_latency)
+
+    def record_failure(self, provider: Provider, error: BaseException):
+        """记录一次失败请求"""
+        provider.requests += 1
+        provider.failures += 1
+        provider.last_error = str(error)[:200]
+        provider.breaker.record_failure()
+
+    def record_rejected(self, provider: Provider):
+        """请求被服务商以请求内容错误拒绝，服务商本身可用"""
+        provider.requests += 1
+        provider.breaker.record_success()
+
+    @property
+    def running(self) -> bool:
+        """健康探测任务是否在运行"""
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        """在当前事件循环中启动后台健康探测，probe_interval 不大于 0 时不启动"""
+        if self.running or self.probe_interval <= 0:
+            return
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        logger.info(f"AI 服务商健康探测已启动 - 间隔: {self.probe_interval}s")
+
+    async def stop(self):
+        """停止后台健康探测"""
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        """后台循环：每隔 probe_interval 秒探测一次所有服务商"""
+        while True:
+            # 运行中把间隔改为 0 时暂停探测，而不是空转
+            await asyncio.sleep(max(1.0, self.probe_interval))
+            if self.probe_interval > 0:
+                await self.probe_all()
+
+    async def probe_all(self):
+        """并发探测所有服务商"""
+        await asyncio.gather(*(self._probe(p) for p in list(self.providers)))
+
+    async def _probe(self, provider: Provider):
+        """请求模型列表探测服务商
+
+        探测失败计入熔断器，使故障的服务商在真实请求到来前就被跳过；
+        只有探测成功（2xx）时才认为服务商正常，熔断中的服务商随之立即恢复。
+        不支持模型列表接口等原因返回 4xx 时没有探测结果，健康状态和熔断器都不变，
+        否则真实请求打开的熔断器会在每次探测时被错误地关闭。
+        """
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(
+                provider.client.models.list(), timeout=self.probe_timeout
+            )
+        except Exception as e:
+            if not is_provider_error(e):
+                logger.debug(f"AI 服务商 {provider.name} 健康探测无结果: {e}")
+                return
+            provider.healthy = False
+            provider.last_error = str(e)[:200]
+            provider.breaker.record_failure()
+            logger.warning(f"AI 服务商 {provider.name} 健康探测失败: {e}")
+            return
+        provider.last_probe_ms = round((time.monotonic() - started) * 1000, 1)
+        if provider.healthy is False or provider.breaker.state != CircuitBreaker.CLOSED:
+            logger.info(f"AI 服务商 {provider.name} 探测恢复正常")
+        provider.healthy = True
+        provider.breaker.record_success()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取路由策略和每个服务商的统计"""
+        return {
+            "strategy": self.strategy,
+            "primary": self.primary.name if self.primary else None,
+            "probing": self.running,
+            "providers": [p.get_stats() for p in self.providers],
+        }
@@ -0,0 +1,286 @@
+"""
+AI 请求调度
+按服务商限制并发的上游请求数，超出时按优先级排队：
+交互式对话 > 手动总结 > 定时任务，队列有长度上限，排队超过截止时间即放弃
+"""
+
+import asyncio
+import bisect
+import itertools
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Deque, Dict, Hashable, List, Optional
+
+from loguru import logger
+
+# 优先级类别，按先后顺序从高到低
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_MANUAL = "manual"
+PRIORITY_SCHEDULED = "scheduled"
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_MANUAL, PRIORITY_SCHEDULED)
+
+# 每个类别保留用于计算排队耗时分位数的最近样本数
+_WAIT_SAMPLES = 500
+
+
+class AdmissionError(Exception):
+    """请求未能获得执行名额"""
+
+
+class AdmissionRejectedError(AdmissionError):
+    """排队队列已满，请求被拒绝"""
+
+
+class AdmissionTimeoutError(AdmissionError):
+    """排队超过截止时间"""
+
+
+class _ClassStats:
+    """一个优先级类别的排队统计"""
+
+    def __init__(self):
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.max_wait = 0.0
+        self.waits: Deque[float] = deque(maxlen=_WAIT_SAMPLES)
+
+    def record_wait(self, seconds: float):
+        self.admitted += 1
+        self.max_wait = max(self.max_wait, seconds)
+        self.waits.append(seconds)
+
+    def get_stats(self) -> Dict[str, Any]:
+        ordered = sorted(self.waits)
+
+        def rank(p: float) -> float:
+            if not ordered:
+                return 0.0
+            index = min(len(ordered) - 1, int(p * len(ordered)))
+            return round(ordered[index] * 1000, 1)
+
+        return {
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "wait_p50_ms": rank(0.50),
+            "wait_p95_ms": rank(0.95),
+            "wait_max_ms": round(self.max_wait * 1000, 1),
+        }
+
+
+class PriorityLimiter:
+    """带优先级排队的并发限制器（在单个事件循环中使用）
+
+    正在执行的请求数达到 limit 时，新请求按 (优先级, 到达顺序) 排队，
+    有名额释放时优先放行高优先级的请求。class_limits 可以限制某个类别
+    最多占用的名额，使低优先级的批量任务无法占满全部并发。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        limit: int,
+        class_limits: Dict[str, int],
+        queue_limits: Dict[str, int],
+    ):
+        self.name = name
+        self.limit = max(1, limit)
+        self.class_limits = class_limits
+        self.queue_limits = queue_limits
+        self.active = {priority: 0 for priority in PRIORITIES}
+        self._queue: List[tuple] = []  # (优先级序号, 到达序号, 类别, future)
+        self._seq = itertools.count()
+        self.stats = {priority: _ClassStats() for priority in PRIORITIES}
+
+    def _queued(self, priority: str) -> int:
+        return sum(1 for item in self._queue if item[2] == priority)
+
+    def _can_run(self, priority: str) -> bool:
+        """是否还有总名额和该类别的名额"""
+        return sum(self.active.values()) < self.limit and self.active[
+            priority
+        ] < self.class_limits.get(priority, self.limit)
+
+    def _grant(self, priority: str):
+        self.active[priority] += 1
+
+    async def acquire(self, priority: str, deadline: float):
+        """获取一个执行名额，deadline 为 time.monotonic() 下的截止时间
+
+        Raises:
+            AdmissionRejectedError: 该类别的排队队列已满
+            AdmissionTimeoutError: 截止时间前未获得名额
+        """
+        rank = PRIORITIES.index(priority)
+        started = time.monotonic()
+        ahead = any(item[0] <= rank for item in self._queue)
+        if not ahead and self._can_run(priority):
+            self._grant(priority)
+            self.stats[priority].record_wait(0.0)
+            return
+
+        if self._queued(priority) >= self.queue_limits.get(priority, 0):
+            self.stats[priority].rejected += 1
+            raise AdmissionRejectedError(f"AI 服务商 {self.name} 的 {priority} 队列已满")
+
+        future = asyncio.get_running_loop().create_future()
+        item = (rank, next(self._seq), priority, future)
+        bisect.insort(self._queue, item)
+        try:
+            await asyncio.wait_for(future, timeout=max(0.0, deadline - started))
+        except asyncio.TimeoutError:
+            self._remove(item)
+            if future.done() and not future.cancelled():
+                self.release(priority)
+            self.stats[priority].timed_out += 1
+            raise AdmissionTimeoutError(
+                f"等待 AI 服务商 {self.name} 超时（{priority}）"
+            ) from None
+        except BaseException:
+            self._remove(item)
+            # 已获得名额但调用方被取消，归还名额
+            if future.done() and not future.cancelled():
+                self.release(priority)
+            raise
+        self.stats[priority].record_wait(time.monotonic() - started)
+
+    def _remove(self, item: tuple):
+        try:
+            self._queue.remove(item)
+        except ValueError:
+            pass
+
+    def release(self, priority: str):
+        """归还名额，并按优先级放行排队中的请求"""
+        self.active[priority] -= 1
+        self._wake()
+
+    def _wake(self):
+        """按排队顺序放行所有能获得名额的请求"""
+        for item in list(self._queue):
+            if sum(self.active.values()) >= self.limit:
+                break
+            priority, future = item[2], item[3]
+            if future.done():
+                self._queue.remove(item)
+                continue
+            if not self._can_run(priority):
+                continue
+            self._queue.remove(item)
+            self._grant(priority)
+            future.set_result(None)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取并发、排队和各类别的排队耗时"""
+        return {
+            "limit": self.limit,
+            "active": sum(self.active.values()),
+            "queued": len(self._queue),
+            "classes": {
+                priority: dict(
+                    self.stats[priority].get_stats(),
+                    active=self.active[priority],
+                    queued=self._queued(priority),
+                )
+                for priority in PRIORITIES
+            },
+        }
+
+
+class AIScheduler:
+    """AI 请求的准入调度
+
+    每个服务商一个 PriorityLimiter，并发上限取服务商配置中的 max_concurrency，
+    未配置时使用 max_concurrency。定时任务类别最多占用 scheduled_share 比例的名额，
+    为交互请求留出余量。
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 8,
+        scheduled_share: float = 0.5,
+        queue_limits: Optional[Dict[str, int]] = None,
+        deadlines: Optional[Dict[str, float]] = None,
+    ):
+        self._limiters: Dict[Hashable, PriorityLimiter] = {}
+        self.configure(max_concurrency, scheduled_share, queue_limits, deadlines)
+
+    def configure(
+        self,
+        max_concurrency: int = 8,
+        scheduled_share: float = 0.5,
+        queue_limits: Optional[Dict[str, int]] = None,
+        deadlines: Optional[Dict[str, float]] = None,
+    ):
+        """更新调度参数，已有的限制器在下次使用时应用新参数"""
+        self.max_concurrency = max(1, max_concurrency)
+        self.scheduled_share = min(1.0, max(0.0, scheduled_share))
+        self.queue_limits = {
+            PRIORITY_INTERACTIVE: 50,
+            PRIORITY_MANUAL: 20,
+            PRIORITY_SCHEDULED: 200,
+            **(queue_limits or {}),
+        }
+        self.deadlines = {
+            PRIORITY_INTERACTIVE: 30.0,
+            PRIORITY_MANUAL: 120.0,
+            PRIORITY_SCHEDULED: 900.0,
+            **(deadlines or {}),
+        }
+
+    def deadline(self, priority: str) -> float:
+        """某个类别的请求从现在起的截止时间（time.monotonic()）"""
+        return time.monotonic() + self.deadlines.get(priority, 30.0)
+
+    def _limiter(self, provider) -> PriorityLimiter:
+        """获取服务商的限制器，并应用当前的并发和队列参数"""
+        limiter = self._limiters.get(provider.client_key)
+        limit = int(provider.config.get("max_concurrency") or self.max_concurrency)
+        class_limits = {
+            PRIORITY_SCHEDULED: max(1, int(limit * self.scheduled_share)),
+        }
+        if limiter is None:
+            limiter = PriorityLimiter(
+                provider.name, limit, class_limits, self.queue_limits
+            )
+            self._limiters[provider.client_key] = limiter
+        else:
+            limiter.name = provider.name
+            limiter.limit = max(1, limit)
+            limiter.class_limits = class_limits
+            limiter.queue_limits = self.queue_limits
+        return limiter
+
+    @asynccontextmanager
+    async def slot(
+        self, provider, priority: str, deadline: float
+    ) -> AsyncIterator[None]:
+        """在服务商的一个执行名额内运行
+
+        Raises:
+            AdmissionRejectedError: 排队队列已满
+            AdmissionTimeoutError: 截止时间前未获得名额
+        """
+        limiter = self._limiter(provider)
+        try:
+            await limiter.acquire(priority, deadline)
+        except AdmissionError as e:
+            logger.warning(f"AI 请求未获准执行: {e}")
+            raise
+        try:
+            yield
+        finally:
+            limiter.release(priority)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取各服务商的并发、排队和排队耗时"""
+        return {
+            "max_concurrency": self.max_concurrency,
+            "scheduled_share": self.scheduled_share,
+            "providers": {
+                limiter.name: limiter.get_stats()
+                for limiter in self._limiters.values()
+            },
+        }
@@ -5,12 +5,30 @@ AI 服务模块
 
 import os
 import re
-from typing import Any, Dict, List, Optional
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 
+import httpx
 import openai
 from loguru import logger
 from md2tgmd import escape
 
+from bot.services.ai_router import (
+    NoProviderAvailableError,
+    Provider,
+    ProviderRouter,
+    is_provider_error,
+)
+from bot.services.ai_scheduler import (
+    PRIORITY_INTERACTIVE,
+    PRIORITY_MANUAL,
+    PRIORITY_SCHEDULED,
+    AdmissionError,
+    AdmissionRejectedError,
+    AIScheduler,
+)
+from bot.services.response_cache import make_cache_key, response_cache
+from bot.utils.single_flight import SingleFlight
 from config.settings import config_manager
 
 
@@ -20,55 +38,126 @@ class AIServices:
     def __init__(self):
         self.openai_client = None
         self.active_config_cache = None
+        # 构建客户端时的配置版本
+        self._config_version: Optional[int] = None
+        self.http_client = self._create_http_client()
+        self.router = ProviderRouter(self.http_client)
+        self.scheduler = AIScheduler()
+        # 合并并发的相同请求
+        self.chat_flight = SingleFlight("chat_completion")
+        self.search_flight = SingleFlight("search_web")
+        self.rag_flight = SingleFlight("get_rag_answer")
         self._setup_openai()
 
+    @staticmethod
+    def _create_http_client() -> httpx.AsyncClient:
+        """创建所有 AI 客户端和功能共享的 HTTP 连接池"""
+        http_config = config_manager.get("ai_services.http", {})
+        return httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=http_config.get("max_connections", 50),
+                max_keepalive_connections=http_config.get(
+                    "max_keepalive_connections", 20
+                ),
+                keepalive_expiry=http_config.get("keepalive_expiry", 60),
+            ),
+            timeout=httpx.Timeout(
+                http_config.get("timeout", 120),
+                connect=http_config.get("connect_timeout", 5),
+            ),
+        )
+
     def _setup_openai(self):
-        """设置 OpenAI 客户端"""
-        try:
-            active_config = config_manager.get_active_openai_config()
-
-            # 检查配置是否有变化，如果没有变化且客户端已存在，则直接返回
-            if (
-                self.openai_client is not None
-                and self.active_config_cache is not None
-                and self.active_config_cache == active_config
-            ):
-                return
+        """设置 OpenAI 客户端
 
-            if not active_config:
-                logger.error("没有找到活动的 OpenAI 配置")
-                self.openai_client = None
-                self.active_config_cache = None
-                return
+        配置版本未变化时直接返回；变化后按最新配置同步服务商池，
+        只有 API Key 或接口地址改变的服务商才重建客户端，连接池始终复用。
+        openai_client 和 active_config_cache 指向主服务商（活动配置）。
+        """
+        version = config_manager.version
+        if version == self._config_version:
+            return
 
-            api_key = active_config.get("api_key")
-            base_url = active_config.get("api_base_url", "https://api.openai.com/v1")
+        try:
+            ai_config = config_manager.get_ai_config()
+            self._config_version = version
+
+            routing = ai_config.get("routing", {})
+            self.router.configure(
+                strategy=routing.get("strategy", "priority"),
+                failure_threshold=routing.get("failure_threshold", 5),
+                recovery_timeout=routing.get("recovery_timeout", 30),
+                ewma_alpha=routing.get("ewma_alpha", 0.3),
+                probe_interval=routing.get("probe_interval", 60),
+                probe_timeout=routing.get("probe_timeout", 10),
+            )
+            scheduling = ai_config.get("scheduler", {})
+            self.scheduler.configure(
+                max_concurrency=scheduling.get("max_concurrency", 8),
+                scheduled_share=scheduling.get("scheduled_share", 0.5),
+                queue_limits=scheduling.get("queue_limits"),
+                deadlines=scheduling.get("deadlines"),
+            )
+            self.router.sync(
+                ai_config.get("openai_configs", []),
+                ai_config.get("active_openai_config_index", 0),
+            )
 
-            if not api_key:
-                logger.error("活动的 OpenAI 配置中缺少 API Key")
+            primary = self.router.primary
+            if primary is None:
+                logger.error("没有找到配置了 API Key 的 OpenAI 配置")
                 self.openai_client = None
                 self.active_config_cache = None
                 return
 
-            self.openai_client = openai.AsyncOpenAI(api_key=api_key, base_url=base_url)
-            self.active_config_cache = active_config
-            logger.info(
-                f"OpenAI 客户端初始化或更新成功，使用配置: {active_config.get('name', '未命名')}，base_url: {base_url}"
-            )
+            if primary.index != ai_config.get("active_openai_config_index", 0):
+                logger.warning(
+                    f"活动的 OpenAI 配置不可用，改用配置: {primary.name}"
+                )
+            self.openai_client = primary.client
+            self.active_config_cache = primary.config
         except Exception as e:
             logger.error(f"OpenAI 客户端初始化失败: {e}")
             self.openai_client = None
             self.active_config_cache = None
+            self._config_version = None
 
     def reload_config(self):
         """重新加载配置并重新初始化OpenAI客户端"""
         try:
             logger.info("重新加载AI服务配置...")
+            # 显式重新加载时不论版本号是否变化都重新读取配置
+            self._config_version = None
             self._setup_openai()
             logger.info("AI服务配置重新加载完成")
         except Exception as e:
             logger.error(f"重新加载AI服务配置失败: {e}")
 
+    def start_health_checks(self):
+        """启动服务商的后台健康探测"""
+        self._setup_openai()
+        self.router.start()
+
+    async def close(self):
+        """停止健康探测并关闭共享的 HTTP 连接池"""
+        await self.router.stop()
+        await self.http_client.aclose()
+
+    def get_single_flight_stats(self) -> Dict[str, Any]:
+        """获取各入口被合并的请求数"""
+        return {
+            flight.name: flight.get_stats()
+            for flight in (self.chat_flight, self.search_flight, self.rag_flight)
+        }
+
+    def get_scheduler_stats(self) -> Dict[str, Any]:
+        """获取各服务商的并发、排队长度和排队耗时"""
+        return self.scheduler.get_stats()
+
+    def get_provider_stats(self) -> Dict[str, Any]:
+        """获取各服务商的延迟、错误率和熔断状态"""
+        return self.router.get_stats()
+
     async def get_available_models(self) -> List[str]:
         """
         获取当前配置可用的模型列表
@@ -101,11 +190,147 @@ class AIServices:
             logger.error(f"获取模型列表失败: {e}")
             return []
 
+    def _chat_request(
+        self, history: List[Dict[str, Any]], openai_config: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        """按服务商配置构建对话请求参数（模型、加上系统提示的消息等）"""
+        max_tokens = openai_config.get("max_tokens", 1000)
+        if not isinstance(max_tokens, int) or max_tokens <= 0:
+            max_tokens = 1000
+        temperature = openai_config.get("temperature")
+        if temperature is None:
+            temperature = 0.7
+
+        # 添加系统提示到历史记录的最前面
+        system_prompt = config_manager.get(
+            "features.chat.system_prompt",
+            "你是一个友善、有帮助的AI助手。请用简洁明了的中文回答用户的问题。",
+        )
+
+        return {
+            "model": openai_config.get("model", "gpt-3.5-turbo"),
+            "messages": [{"role": "system", "content": system_prompt}] + history,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+        }
+
+    def _record_error(self, provider: Provider, error: BaseException) -> bool:
+        """记录服务商请求失败，返回是否应切换到下一个服务商"""
+        if is_provider_error(error):
+            self.router.record_failure(provider, error)
+            return True
+        if isinstance(error, openai.APIStatusError):
+            self.router.record_rejected(provider)
+        return False
+
+    async def _fetch_reply(
+        self, history: List[Dict[str, Any]], priority: str
+    ) -> Tuple[str, str]:
+        """按路由顺序请求服务商，服务商出错或排队已满时切换到下一个
+
+        每次请求先在调度器中按优先级获得该服务商的执行名额，
+        排队截止时间对整个请求（包括切换服务商）只计算一次。
+
+        Returns:
+            (回复, 实际使用的模型)
+
+        Raises:
+            NoProviderAvailableError: 没有可用的服务商
+            AdmissionTimeoutError: 截止时间前未获得执行名额
+            最后一个服务商的异常: 所有服务商都失败
+        """
+        self._setup_openai()
+        deadline = self.scheduler.deadline(priority)
+        last_error: Optional[BaseException] = None
+        for provider in self.router.candidates():
+            request = self._chat_request(history, provider.config)
+            try:
+                async with self.scheduler.slot(provider, priority, deadline):
+                    started = time.monotonic()
+                    response = await provider.client.chat.completions.create(
+                        **request
+                    )
+            except AdmissionRejectedError as e:
+                last_error = e
+                continue
+            except Exception as e:
+                if not self._record_error(provider, e):
+                    raise
+                last_error = e
+                logger.warning(f"AI 服务商 {provider.name} 请求失败，尝试下一个: {e}")
+                continue
+
+            self.router.record_success(provider, time.monotonic() - started)
+            content = response.choices[0].message.content
+            return (content.strip() if content is not None else ""), request["model"]
+
+        raise last_error
+
+    async def _coalesced_reply(
+        self, history: List[Dict[str, Any]], feature: Optional[str], priority: str
+    ) -> Tuple[str, str]:
+        """合并并发的相同请求，再经过回复缓存
+
+        请求键按主服务商的请求参数计算，单飞合并和回复缓存共用，不随路由结果变化；
+        功能名也计入合并键，关闭缓存的功能不会拿到来自缓存的回复。
+        """
+        self._setup_openai()
+        primary = self.router.primary
+        if primary is None:
+            raise NoProviderAvailableError("没有可用的 AI 服务商")
+        request = self._chat_request(history, primary.config)
+        key = make_cache_key(request)
+        return await self.chat_flight.do(
+            (feature, key),
+            lambda: self._cached_reply(
+                history, feature, key, request["model"], priority
+            ),
+        )
+
+    async def _cached_reply(
+        self,
+        history: List[Dict[str, Any]],
+        feature: Optional[str],
+        key: str,
+        model: str,
+        priority: str,
+    ) -> Tuple[str, str]:
+        """新鲜的缓存直接返回，否则请求上游
+
+        缓存已过新鲜期时仍先请求上游；只有上游不可用（没有可用服务商、排队失败，
+        或服务商连接失败、超时、限流、5xx）时才退回宽限期内的旧回复。
+        """
+        if response_cache is None or not response_cache.allows(feature):
+            return await self._fetch_reply(history, priority)
+
+        cached = await response_cache.get(key)
+        if cached is not None and cached[1]:
+            logger.debug(f"AI 回复缓存命中 - 功能: {feature}")
+            return cached[0], model
+
+        try:
+            reply, model = await self._fetch_reply(history, priority)
+        except Exception as e:
+            unavailable = isinstance(
+                e, (NoProviderAvailableError, AdmissionError)
+            ) or is_provider_error(e)
+            if cached is None or not unavailable:
+                raise
+            response_cache.record_stale_served()
+            logger.warning(f"AI 上游不可用，使用过期的缓存回复 - 功能: {feature}: {e}")
+            return cached[0], model
+
+        if reply:
+            await response_cache.put(key, reply)
+        return reply, model
+
     async def chat_completion(
         self,
         history: List[Dict[str, Any]],
         user_id: Optional[int] = None,
         enable_md2tg: bool = True,
+        feature: Optional[str] = None,
+        priority: str = PRIORITY_INTERACTIVE,
     ) -> Optional[str]:
         """
         AI 对话完成
@@ -113,46 +338,14 @@ class AIServices:
         Args:
             history: 对话历史列表，格式 [{"role": "user", "content": "消息内容"}]
             user_id: 用户ID，用于日志记录
+            feature: 发起请求的功能名，用于按功能关闭回复缓存
+            priority: 请求的优先级类别：interactive、manual 或 scheduled
 
         Returns:
             AI 回复内容，失败时返回 None
         """
         try:
-            self._setup_openai()
-            if not self.openai_client:
-                return "抱歉，AI 服务暂时不可用。"
-
-            # 获取配置
-            openai_config = config_manager.get_active_openai_config()
-            if not openai_config:
-                return "抱歉，AI 服务配置不正确。"
-
-            model = openai_config.get("model", "gpt-3.5-turbo")
-            max_tokens = openai_config.get("max_tokens", 1000)
-            if not isinstance(max_tokens, int) or max_tokens <= 0:
-                max_tokens = 1000
-            temperature = openai_config.get("temperature")
-            if temperature is None:
-                temperature = 0.7
-
-            # 添加系统提示到历史记录的最前面
-            system_prompt = config_manager.get(
-                "features.chat.system_prompt",
-                "你是一个友善、有帮助的AI助手。请用简洁明了的中文回答用户的问题。",
-            )
-
-            full_messages = [{"role": "system", "content": system_prompt}] + history
-
-            # 调用 OpenAI API
-            response = await self.openai_client.chat.completions.create(
-                model=model,
-                messages=full_messages,  # type: ignore
-                max_tokens=max_tokens,
-                temperature=temperature,
-            )
-
-            content = response.choices[0].message.content
-            reply = content.strip() if content is not None else ""
+            reply, model = await self._coalesced_reply(history, feature, priority)
 
             if enable_md2tg:
                 # 转换为 Telegram MarkdownV2 安全格式
@@ -169,6 +362,12 @@ class AIServices:
                 )
             return safe_reply
 
+        except NoProviderAvailableError:
+            logger.error(f"没有可用的 AI 服务商 - 用户: {user_id}")
+            return "抱歉，AI 服务暂时不可用。"
+        except AdmissionError as e:
+            logger.warning(f"AI 请求排队失败 - 用户: {user_id}, 原因: {e}")
+            return "抱歉，当前请求过多，请稍后再试。"
         except openai.RateLimitError:
             logger.warning(f"OpenAI API 速率限制 - 用户: {user_id}")
             return "抱歉，当前请求过多，请稍后再试。"
@@ -180,6 +379,95 @@ class AIServices:
             logger.error(f"AI 对话失败 - 用户: {user_id}, 错误: {e}")
             return "抱歉，AI 服务暂时出现问题，请稍后再试。"
 
+    async def stream_chat_completion(
+        self, history: List[Dict[str, Any]], user_id: Optional[int] = None
+    ) -> AsyncIterator[str]:
+        """
+        流式 AI 对话完成，按交互请求的优先级排队
+
+        尚未产出内容时服务商出错会切换到下一个服务商，产出内容之后出错则直接结束。
+
+        Args:
+            history: 对话历史列表，格式同 chat_completion
+            user_id: 用户ID，用于日志记录
+
+        Yields:
+            逐段到达的原始回复文本（未转换为 MarkdownV2）；
+            尚未产出内容时出错，则产出与 chat_completion 相同的提示文本
+        """
+        produced = False
+        try:
+            self._setup_openai()
+            deadline = self.scheduler.deadline(PRIORITY_INTERACTIVE)
+            last_error: Optional[BaseException] = None
+            for provider in self.router.candidates():
+                request = self._chat_request(history, provider.config)
+                first_token = None
+                length = 0
+                try:
+                    # 流式回复在整个生成期间占用执行名额
+                    async with self.scheduler.slot(
+                        provider, PRIORITY_INTERACTIVE, deadline
+                    ):
+                        started = time.monotonic()
+                        stream = await provider.client.chat.completions.create(
+                            **request, stream=True
+                        )
+                        async for chunk in stream:
+                            if not chunk.choices:
+                                continue
+                            delta = chunk.choices[0].delta.content
+                            if not delta:
+                                continue
+                            if first_token is None:
+                                first_token = time.monotonic() - started
+                            produced = True
+                            length += len(delta)
+                            yield delta
+                except AdmissionRejectedError as e:
+                    last_error = e
+                    continue
+                except Exception as e:
+                    if not self._record_error(provider, e) or produced:
+                        raise
+                    last_error = e
+                    logger.warning(
+                        f"AI 服务商 {provider.name} 流式请求失败，尝试下一个: {e}"
+                    )
+                    continue
+
+                self.router.record_success(provider, time.monotonic() - started)
+                logger.info(
+                    f"AI 流式对话完成 - 用户: {user_id}, 模型: {request['model']}, "
+                    f"回复长度: {length}, 首个 token 耗时: {first_token or 0:.2f}s, "
+                    f"总耗时: {time.monotonic() - started:.2f}s"
+                )
+                return
+
+            raise last_error
+
+        except NoProviderAvailableError:
+            logger.error(f"没有可用的 AI 服务商 - 用户: {user_id}")
+            if not produced:
+                yield "抱歉，AI 服务暂时不可用。"
+        except AdmissionError as e:
+            logger.warning(f"AI 请求排队失败 - 用户: {user_id}, 原因: {e}")
+            if not produced:
+                yield "抱歉，当前请求过多，请稍后再试。"
+        except openai.RateLimitError:
+            logger.warning(f"OpenAI API 速率限制 - 用户: {user_id}")
+            if not produced:
+                yield "抱歉，当前请求过多，请稍后再试。"
+        except openai.AuthenticationError:
+            logger.error("OpenAI API 认证失败")
+            self._setup_openai()
+            if not produced:
+                yield "抱歉，AI 服务配置有误。"
+        except Exception as e:
+            logger.error(f"AI 流式对话失败 - 用户: {user_id}, 错误: {e}")
+            if not produced:
+                yield "抱歉，AI 服务暂时出现问题，请稍后再试。"
+
     async def generate_image(
         self, prompt: str, user_id: Optional[int] = None
     ) -> Optional[str]:
@@ -233,7 +521,24 @@ class AIServices:
         self, query: str, user_id: Optional[int] = None
     ) -> Optional[str]:
         """
-        联网搜索功能
+        联网搜索功能，并发的相同查询（忽略空白差异）只执行一次
+
+        Args:
+            query: 搜索查询
+            user_id: 用户ID，用于日志记录
+
+        Returns:
+            搜索结果摘要，失败时返回 None
+        """
+        return await self.search_flight.do(
+            " ".join(query.split()), lambda: self._search_web(query, user_id)
+        )
+
+    async def _search_web(
+        self, query: str, user_id: Optional[int] = None
+    ) -> Optional[str]:
+        """
+        执行联网搜索
 
         Args:
             query: 搜索查询
@@ -257,7 +562,7 @@ class AIServices:
             """
 
             messages = [{"role": "user", "content": search_prompt}]
-            result = await self.chat_completion(messages, user_id)
+            result = await self.chat_completion(messages, user_id, feature="search")
 
             if result:
                 logger.info(f"搜索完成 - 用户: {user_id}, 查询: {query}")
@@ -271,7 +576,10 @@ class AIServices:
             return None
 
     async def summarize_messages(
-        self, messages: List[str], chat_title: str = "群聊"
+        self,
+        messages: List[str],
+        chat_title: str = "群聊",
+        priority: str = PRIORITY_MANUAL,
     ) -> Optional[str]:
         """
         总结群聊消息
@@ -279,6 +587,7 @@ class AIServices:
         Args:
             messages: 消息列表
             chat_title: 群聊标题
+            priority: 请求的优先级类别，定时总结任务使用 scheduled
 
         Returns:
             总结内容，失败时返回 None
@@ -293,18 +602,15 @@ class AIServices:
                 "请总结以下群聊对话的主要内容和话题：",
             )
 
-            # 构建总结请求
-            messages_text = "\n".join(messages)
-
-            full_prompt = f"""
+            # 构建总结请求，消息列表只在最终拼接时复制一次
+            header = f"""
             {summary_prompt}
             
             群聊名称: {chat_title}
             消息数量: {len(messages)}
             
-            消息内容:
-            {messages_text}
-            
+            消息内容:"""
+            footer = """
             请提供一个简洁的总结，包括：
             1. 主要讨论话题
             2. 重要信息或决定
@@ -314,9 +620,12 @@ class AIServices:
             请用中文回答，保持简洁明了。不要在开头说“好的，这是对该群聊内容的简洁总结：”这类语句，
             直接给出总结内容即可。
             """
+            full_prompt = "\n".join([header, *messages, footer])
 
             chat_messages = [{"role": "user", "content": full_prompt}]
-            summary = await self.chat_completion(chat_messages)
+            summary = await self.chat_completion(
+                chat_messages, feature="summary", priority=priority
+            )
 
             if summary:
                 logger.info(
@@ -332,7 +641,7 @@ class AIServices:
 
     async def summarize_hotspot_news(self, content: str) -> Optional[str]:
         """
-        总结热点新闻
+        总结热点新闻，按定时任务的优先级排队
 
         Args:
             content: 新闻内容字符串
@@ -357,7 +666,12 @@ class AIServices:
             """
 
             messages = [{"role": "user", "content": prompt}]
-            summary = await self.chat_completion(history=messages, enable_md2tg=False)
+            summary = await self.chat_completion(
+                history=messages,
+                enable_md2tg=False,
+                feature="hotspot_push",
+                priority=PRIORITY_SCHEDULED,
+            )
 
             if summary:
                 logger.info("热点新闻总结成功")
@@ -381,6 +695,15 @@ ai_services = AIServices()
 
 
 async def get_rag_answer(question: str) -> str:
+    """
+    使用 RAG 模型检索答案，并发的相同问题（忽略空白差异）只执行一次。
+    """
+    return await ai_services.rag_flight.do(
+        " ".join(question.split()), lambda: _get_rag_answer(question)
+    )
+
+
+async def _get_rag_answer(question: str) -> str:
     """
     使用 RAG 模型检索答案。
     此实现会读取 'docs' 目录中的所有 markdown 文档，
@@ -430,7 +753,7 @@ async def get_rag_answer(question: str) -> str:
         # 3. 调用大模型
         # 注意：这里我们直接调用了全局实例的 chat_completion 方法
         messages = [{"role": "user", "content": rag_prompt}]
-        answer = await ai_services.chat_completion(messages)
+        answer = await ai_services.chat_completion(messages, feature="ask_gb")
 
         if not answer:
             return "抱歉，AI 服务在处理您的问题时遇到了麻烦。"
@@ -0,0 +1,244 @@
+"""
+消息存储的异步接口
+在专用线程池中执行存储操作，避免文件读写阻塞事件循环
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import partial
+from itertools import islice
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+from loguru import logger
+
+from bot.services.message_index import MessageIndex, create_message_index
+from bot.services.message_store import message_store
+from config.settings import config_manager
+
+
+class AsyncMessageStore:
+    """消息存储的异步包装
+
+    按 chat_id 将操作分配到若干个单线程执行器上：同一聊天的操作总在同一个线程中
+    按提交顺序执行，不同聊天的操作可以并行。不属于某个聊天的操作使用单独的执行器。
+    方法语义与被包装的存储一致，只是需要 await。
+
+    提供消息索引时，新消息在同一执行器中同时写入索引，/find 等检索直接查询索引；
+    批量清理消息后丢弃已建立的索引，下次检索时由存储中剩余的消息重建。
+    """
+
+    # 异步遍历消息时每次在执行器中取出的条数
+    ITER_BATCH_SIZE = 200
+
+    def __init__(self, store, index: Optional[MessageIndex] = None, workers: int = 4):
+        self.store = store
+        self.index = index
+        self.workers = max(1, workers)
+        self._executors = [
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"message-store-{i}")
+            for i in range(self.workers)
+        ]
+        self._global_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="message-store-global"
+        )
+
+    def __getattr__(self, name: str):
+        # 统计、刷新器控制等不涉及磁盘读写的接口直接转发给底层存储
+        return getattr(self.store, name)
+
+    def _run(self, key: Optional[int], fn: Callable, /, *args, **kwargs):
+        """将操作提交到 key（聊天 ID）对应的执行器，key 为空时使用全局执行器"""
+        if key is None:
+            executor = self._global_executor
+        else:
+            executor = self._executors[hash(key) % self.workers]
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(executor, partial(fn, *args, **kwargs))
+
+    async def add_message(
+        self,
+        chat_id: int,
+        user_id: int,
+        username: str,
+        message: str,
+        timestamp: Optional[datetime] = None,
+    ):
+        """添加群聊消息，并同步更新消息索引"""
+        timestamp = timestamp or datetime.now(timezone.utc)
+        return await self._run(
+            chat_id,
+            self._add_message,
+            chat_id,
+            user_id,
+            username,
+            message,
+            timestamp,
+        )
+
+    def _add_message(
+        self,
+        chat_id: int,
+        user_id: int,
+        username: str,
+        message: str,
+        timestamp: datetime,
+    ):
+        """在执行器线程中写入存储和索引"""
+        self.store.add_message(
+            chat_id=chat_id,
+            user_id=user_id,
+            username=username,
+            message=message,
+            timestamp=timestamp,
+        )
+        if self.index is not None:
+            self.index.add(chat_id, username, message, timestamp)
+
+    async def search(
+        self,
+        chat_id: int,
+        query: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        limit: int = 10,
+    ) -> List[Dict[str, Any]]:
+        """在消息索引中检索，未启用索引时返回空列表"""
+        if self.index is None:
+            return []
+        return await self._run(
+            chat_id, self.index.search, chat_id, query, start, end, limit
+        )
+
+    async def get_messages_between(
+        self, chat_id: int, start: datetime, end: Optional[datetime] = None
+    ) -> List[str]:
+        """获取时间位于 [start, end) 内的消息"""
+        return await self._run(
+            chat_id, self.store.get_messages_between, chat_id, start, end
+        )
+
+    async def iter_messages_between(
+        self,
+        chat_id: int,
+        start: datetime,
+        end: Optional[datetime] = None,
+        newest_first: bool = False,
+        max_bytes: int = 0,
+        max_tokens: int = 0,
+    ) -> AsyncIterator[str]:
+        """异步逐条产出时间位于 [start, end) 内的消息
+
+        底层迭代器在聊天对应的执行器中按块推进，每块最多 ITER_BATCH_SIZE 条；
+        调用方提前停止迭代时不会再读取剩余的消息。
+        """
+        lines = await self._run(
+            chat_id,
+            self.store.iter_messages_between,
+            chat_id,
+            start,
+            end,
+            newest_first,
+            max_bytes,
+            max_tokens,
+        )
+        while True:
+            batch = await self._run(
+                chat_id, list, islice(lines, self.ITER_BATCH_SIZE)
+            )
+            if not batch:
+                return
+            for line in batch:
+                yield line
+
+    async def count_messages_between(
+        self, chat_id: int, start: datetime, end: Optional[datetime] = None
+    ) -> int:
+        """统计时间位于 [start, end) 内的消息数量"""
+        return await self._run(
+            chat_id, self.store.count_messages_between, chat_id, start, end
+        )
+
+    async def get_recent_messages(
+        self, chat_id: int, hours: int = 24, min_messages: int = 10
+    ) -> List[str]:
+        """获取最近的消息"""
+        return await self._run(
+            chat_id, self.store.get_recent_messages, chat_id, hours, min_messages
+        )
+
+    async def get_message_count(self, chat_id: int, hours: int = 24) -> int:
+        """获取最近 hours 小时的消息数量"""
+        return await self._run(chat_id, self.store.get_message_count, chat_id, hours)
+
+    async def get_chat_stats(self, chat_id: int) -> Dict[str, Any]:
+        """获取聊天统计信息"""
+        return await self._run(chat_id, self.store.get_chat_stats, chat_id)
+
+    async def add_dialog_message(self, chat_id: int, message: dict):
+        """添加对话消息到历史记录"""
+        return await self._run(chat_id, self.store.add_dialog_message, chat_id, message)
+
+    async def get_dialog_history(self, chat_id: int, limit: int = 10) -> list:
+        """获取对话历史记录"""
+        return await self._run(chat_id, self.store.get_dialog_history, chat_id, limit)
+
+    async def clear_dialog_history(self, chat_id: int):
+        """清除指定聊天的对话历史记录"""
+        return await self._run(chat_id, self.store.clear_dialog_history, chat_id)
+
+    async def get_chat_ids(self) -> List[int]:
+        """获取所有有消息记录的聊天"""
+        return await self._run(None, self.store.get_chat_ids)
+
+    async def get_active_chat_ids(
+        self, since: datetime, min_messages: int = 1
+    ) -> List[int]:
+        """获取 since 之后消息数达到 min_messages 的聊天"""
+        return await self._run(
+            None, self.store.get_active_chat_ids, since, min_messages
+        )
+
+    async def clear_old_messages(self, days: int = 30):
+        """清除旧消息"""
+        result = await self._run(None, self.store.clear_old_messages, days)
+        if self.index is not None:
+            self.index.clear()
+        return result
+
+    async def compact_all(self):
+        """压缩所有聊天的消息日志"""
+        return await self._run(None, self.store.compact_all)
+
+    async def cleanup_expired_files(self, retention_days: int = 30):
+        """清理过期的历史记录"""
+        await self._run(None, self.store.cleanup_expired_files, retention_days)
+        if self.index is not None:
+            self.index.clear()
+
+    async def flush(self) -> int:
+        """立即写入所有待写数据"""
+        return await self._run(None, self.store.flush)
+
+    def start_flusher(self):
+        """启动存储的后台延迟写入任务"""
+        self.store.start_flusher()
+
+    async def stop_flusher(self):
+        """停止存储的后台延迟写入任务并写入剩余数据"""
+        await self.store.stop_flusher()
+
+    async def close(self):
+        """等待已提交的操作完成并关闭执行器"""
+        loop = asyncio.get_running_loop()
+        for executor in self._executors + [self._global_executor]:
+            await loop.run_in_executor(None, executor.shutdown)
+        logger.info("消息存储异步执行器已关闭")
+
+
+# 全局异步消息存储实例
+async_message_store = AsyncMessageStore(
+    message_store,
+    index=create_message_index(message_store),
+    workers=config_manager.get("storage.io_workers", 4),
+)
@@ -0,0 +1,356 @@
+"""
+群聊消息的列式内存结构
+每个聊天一组定长数组，时间戳只在写入时解析一次
+"""
+
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+
+# 时间戳统一为 UTC 微秒整数，保留 ISO 时间中的微秒，同一秒内的消息不丢失先后顺序
+US_PER_SECOND = 1_000_000
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_ONE_US = timedelta(microseconds=1)
+
+
+def to_epoch(timestamp: datetime) -> int:
+    """将时间转换为 UTC 微秒级时间戳，无时区信息时按 UTC 处理"""
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return (timestamp - _EPOCH) // _ONE_US
+
+
+def parse_epoch(value: str) -> int:
+    """将 ISO-8601 时间字符串解析为 UTC 微秒级时间戳"""
+    return to_epoch(datetime.fromisoformat(value))
+
+
+def format_epoch(ts: int) -> str:
+    """将 UTC 微秒级时间戳格式化为 ISO-8601 字符串"""
+    return (_EPOCH + ts * _ONE_US).isoformat()
+
+
+class ChatStats:
+    """单个聊天的增量统计
+
+    随消息写入和删除同步更新，读取时无需扫描消息：
+    按小时分桶的消息数，以及每个用户的最后发言时间和消息数。
+    用户按最后发言时间排序保存，统计活跃用户时只需从最新的一端遍历到窗口起点。
+    """
+
+    __slots__ = ("hour_buckets", "users")
+
+    BUCKET_SIZE = 3600 * US_PER_SECOND  # 一小时
+
+    def __init__(self):
+        self.hour_buckets: Dict[int, int] = {}  # 整点 -> 消息数
+        self.users: "OrderedDict[int, List[int]]" = OrderedDict()  # 用户 -> [最后发言, 消息数]
+
+    def add(self, user_id: int, ts: int):
+        """记录一条新消息"""
+        bucket = ts // self.BUCKET_SIZE
+        self.hour_buckets[bucket] = self.hour_buckets.get(bucket, 0) + 1
+
+        entry = self.users.get(user_id)
+        if entry is None:
+            self.users[user_id] = [ts, 1]
+            if len(self.users) > 1 and ts < self._newest_seen(skip=user_id):
+                self._resort_users()
+            return
+
+        entry[1] += 1
+        if ts >= entry[0]:
+            entry[0] = ts
+            if ts >= self._newest_seen():
+                self.users.move_to_end(user_id)
+            else:
+                self._resort_users()
+
+    def remove(self, user_id: int, ts: int):
+        """撤销一条被删除消息的计数"""
+        bucket = ts // self.BUCKET_SIZE
+        count = self.hour_buckets.get(bucket, 0) - 1
+        if count > 0:
+            self.hour_buckets[bucket] = count
+        else:
+            self.hour_buckets.pop(bucket, None)
+
+        entry = self.users.get(user_id)
+        if entry is not None:
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self.users[user_id]
+
+    def _newest_seen(self, skip: Optional[int] = None) -> int:
+        """返回最近一次发言的时间"""
+        for user_id in reversed(self.users):
+            if user_id != skip:
+                return self.users[user_id][0]
+        return 0
+
+    def _resort_users(self):
+        """乱序消息打乱顺序时，按最后发言时间重新排序"""
+        self.users = OrderedDict(sorted(self.users.items(), key=lambda x: x[1][0]))
+
+    def count_since_upper_bound(self, threshold: int) -> int:
+        """返回 threshold 之后消息数量的上界
+
+        按小时分桶统计 threshold 所在整点及之后的消息，最多多算一小时内的消息，
+        只用于快速筛选候选，展示给用户的数量请使用 ChatHistory.count_since。
+        """
+        first_bucket = threshold // self.BUCKET_SIZE
+        return sum(
+            count for bucket, count in self.hour_buckets.items() if bucket >= first_bucket
+        )
+
+    def active_users_since(self, threshold: int) -> int:
+        """统计在 threshold 之后发过言的用户数"""
+        count = 0
+        for entry in reversed(self.users.values()):
+            if entry[0] < threshold:
+                break
+            count += 1
+        return count
+
+
+class UserTable:
+    """聊天内的用户表
+
+    把 (用户 ID, 用户名) 映射为从 0 开始的小整数编号，消息只保存编号。
+    同一用户只占一个表项，改名时原地更新用户名，不会为每条消息复制。
+    """
+
+    __slots__ = ("user_ids", "usernames", "_refs")
+
+    def __init__(self):
+        self.user_ids = array("q")
+        self.usernames: List[str] = []
+        self._refs: Dict[int, int] = {}  # 用户 ID -> 编号
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+    def assign(
+        self, user_id: int, username: str, refresh: bool = True
+    ) -> Tuple[int, bool]:
+        """返回用户的编号，以及表是否因此变化（新用户，或 refresh 时用户名有变化）"""
+        ref = self._refs.get(user_id)
+        if ref is None:
+            ref = self._refs[user_id] = len(self.user_ids)
+            self.user_ids.append(user_id)
+            self.usernames.append(sys.intern(username))
+            return ref, True
+        if refresh and self.usernames[ref] != username:
+            self.usernames[ref] = sys.intern(username)
+            return ref, True
+        return ref, False
+
+    def define(self, ref: int, user_id: int, username: str):
+        """按持久化的用户表项设置指定编号，编号需按首次出现的顺序连续分配"""
+        if ref == len(self.user_ids):
+            self.user_ids.append(user_id)
+            self.usernames.append(sys.intern(username))
+        elif 0 <= ref < len(self.user_ids):
+            self._refs.pop(self.user_ids[ref], None)
+            self.user_ids[ref] = user_id
+            self.usernames[ref] = sys.intern(username)
+        else:
+            raise ValueError(f"用户编号不连续: {ref}")
+        self._refs[user_id] = ref
+
+    def memory_bytes(self) -> int:
+        """估算占用的内存：int64 数组、用户名指针和字典项"""
+        return len(self.user_ids) * 120
+
+
+class ChatHistory:
+    """单个聊天的消息列存储
+
+    时间戳保存在 int64 数组中，发送者保存为 UserTable 中的 uint32 编号，
+    每个用户的 ID 和用户名只在用户表中保存一份，用户名以最新一条消息为准。
+    超过 max_size 的旧消息通过起始偏移量逻辑删除，偏移量累积到 max_size 时再统一回收，
+    使裁剪的均摊成本为 O(1)。
+
+    时间戳数组始终保持升序，时间窗口查询通过二分查找定位边界，复杂度为 O(log n)。
+
+    提供 spill 列表时，因超过 max_size 被挤出的消息以 (时间戳, 用户ID, 用户名, 内容)
+    追加到该列表，由调用方转存到冷数据归档；按时间清理的消息不会进入 spill。
+    """
+
+    __slots__ = (
+        "max_size",
+        "_start",
+        "timestamps",
+        "user_refs",
+        "users",
+        "texts",
+        "stats",
+        "spill",
+        "text_bytes",
+    )
+
+    def __init__(self, max_size: int = 1000, spill: Optional[list] = None):
+        self.max_size = max_size
+        self._start = 0
+        self.timestamps = array("q")
+        self.user_refs = array("I")
+        self.users = UserTable()
+        self.texts: List[str] = []
+        self.stats = ChatStats()
+        self.spill = spill
+        self.text_bytes = 0  # 未删除消息文本占用的字节数
+
+    def __len__(self) -> int:
+        return len(self.timestamps) - self._start
+
+    def append(self, user_id: int, username: str, message: str, ts: int):
+        """追加一条消息，超过上限时丢弃最旧的消息
+
+        消息通常按时间顺序到达；乱序到达的消息插入到对应位置以保持时间戳有序，
+        且不会用其中较旧的用户名覆盖用户表。
+        """
+        timestamps = self.timestamps
+        if not timestamps or ts >= timestamps[-1]:
+            ref, _ = self.users.assign(user_id, username)
+            timestamps.append(ts)
+            self.user_refs.append(ref)
+            self.texts.append(message)
+        else:
+            ref, _ = self.users.assign(user_id, username, refresh=False)
+            index = bisect_right(timestamps, ts, self._start)
+            timestamps.insert(index, ts)
+            self.user_refs.insert(index, ref)
+            self.texts.insert(index, message)
+        self.stats.add(user_id, ts)
+        self.text_bytes += sys.getsizeof(message)
+
+        if len(self) > self.max_size:
+            self._drop_front(len(self.timestamps) - self.max_size, spill=True)
+            if self._start >= self.max_size:
+                self._reclaim()
+
+    def append_record(self, record: Dict[str, Any]):
+        """追加一条持久化格式的消息记录"""
+        self.append(
+            int(record["user_id"]),
+            record["username"],
+            record["message"],
+            parse_epoch(record["timestamp"]),
+        )
+
+    def _drop_front(self, index: int, spill: bool = False):
+        """逻辑删除 index 之前的消息并撤销其统计，spill 为真时转存到 spill 列表"""
+        spill_list = self.spill if spill else None
+        for i in range(self._start, index):
+            self.stats.remove(self.user_id(i), self.timestamps[i])
+            self.text_bytes -= sys.getsizeof(self.texts[i])
+            if spill_list is not None:
+                spill_list.append(
+                    (self.timestamps[i], self.user_id(i), self.username(i), self.texts[i])
+                )
+        self._start = index
+
+    def _reclaim(self):
+        """回收已逻辑删除的旧消息占用的空间"""
+        start = self._start
+        del self.timestamps[:start]
+        del self.user_refs[:start]
+        del self.texts[:start]
+        self._start = 0
+        if len(self.users) > 2 * len(self.stats.users) + 64:
+            self._compact_users()
+
+    def _compact_users(self):
+        """重建用户表，去掉已没有消息的用户并重新编号"""
+        old, self.users = self.users, UserTable()
+        remap: Dict[int, int] = {}
+        refs = self.user_refs
+        for i, ref in enumerate(refs):
+            new_ref = remap.get(ref)
+            if new_ref is None:
+                new_ref = remap[ref] = self.users.assign(
+                    old.user_ids[ref], old.usernames[ref]
+                )[0]
+            refs[i] = new_ref
+
+    def retain_since(self, threshold: int) -> int:
+        """删除时间早于 threshold 的消息，返回删除的条数"""
+        index = self.index_at(threshold)
+        removed = index - self._start
+        if removed:
+            self._drop_front(index)
+            self._reclaim()
+        return removed
+
+    def memory_bytes(self) -> int:
+        """估算占用的内存：时间戳和用户编号数组、文本指针、消息文本、用户表和增量统计"""
+        slots = len(self.timestamps)
+        return (
+            slots * 20
+            + self.text_bytes
+            + self.users.memory_bytes()
+            + len(self.stats.users) * 120
+            + len(self.stats.hour_buckets) * 70
+        )
+
+    def oldest_ts(self) -> Optional[int]:
+        """最早一条消息的时间，没有消息时返回 None"""
+        return self.timestamps[self._start] if len(self) else None
+
+    def index_at(self, ts: int) -> int:
+        """返回第一条时间不早于 ts 的消息下标"""
+        return bisect_left(self.timestamps, ts, self._start)
+
+    def index_after(self, ts: int) -> int:
+        """返回第一条时间晚于 ts 的消息下标"""
+        return bisect_right(self.timestamps, ts, self._start)
+
+    def range_indices(self, start: int, end: Optional[int] = None) -> range:
+        """返回时间位于 [start, end) 内的消息下标，end 为空表示不设上限"""
+        lo = self.index_at(start)
+        hi = len(self.timestamps) if end is None else bisect_left(
+            self.timestamps, end, lo
+        )
+        return range(lo, hi)
+
+    def indices_since(self, threshold: int) -> range:
+        """按时间顺序返回时间不早于 threshold 的消息下标"""
+        return self.range_indices(threshold)
+
+    def count_since(self, threshold: int) -> int:
+        """统计时间不早于 threshold 的消息数量"""
+        return len(self.timestamps) - self.index_at(threshold)
+
+    def user_id(self, index: int) -> int:
+        """指定下标消息的发送者 ID"""
+        return self.users.user_ids[self.user_refs[index]]
+
+    def username(self, index: int) -> str:
+        """指定下标消息的发送者当前用户名"""
+        return self.users.usernames[self.user_refs[index]]
+
+    def format_line(self, index: int) -> str:
+        """将消息格式化为“用户名: 消息内容”"""
+        return f"{self.username(index)}: {self.texts[index]}"
+
+    def tail_indices(self, count: int) -> range:
+        """返回最后 count 条消息的下标"""
+        end = len(self.timestamps)
+        return range(max(self._start, end - count), end)
+
+    def record(self, index: int) -> Dict[str, Any]:
+        """将指定下标的消息转换为持久化格式"""
+        return {
+            "user_id": self.user_id(index),
+            "username": self.username(index),
+            "message": self.texts[index],
+            "timestamp": format_epoch(self.timestamps[index]),
+        }
+
+    def records(self) -> Iterator[Dict[str, Any]]:
+        """按时间顺序返回所有消息的持久化格式"""
+        return (self.record(i) for i in range(self._start, len(self.timestamps)))
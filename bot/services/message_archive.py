@@ -0,0 +1,361 @@
+"""
+群聊消息的冷数据归档
+热数据之外的旧消息按段压缩保存，并维护按时间排序的段索引
+"""
+
+import gzip
+import json
+import os
+import threading
+import uuid
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from loguru import logger
+
+from bot.services.chat_history import US_PER_SECOND, format_epoch, parse_epoch
+from bot.utils.atomic_io import atomic_write_bytes, atomic_write_text
+
+# 归档记录：(微秒时间戳, 用户ID, 用户名, 消息内容)
+ArchiveRecord = Tuple[int, int, str, str]
+
+# 段索引中起止时间的单位；旧版本没有该字段，起止时间为秒
+TS_UNIT = "us"
+
+
+class MessageArchive:
+    """按聊天划分的 gzip 消息归档
+
+    每个聊天一个目录，包含若干 gzip 压缩的 JSONL 段文件和一个 index.json。
+    索引按时间顺序记录每段的起止时间、消息数和字节数，范围查询只解压与窗口重叠的段，
+    完全落在窗口内的段直接用索引中的消息数计数。
+    段文件和索引都通过原子重命名写入；索引损坏时从段文件重建。
+    read_only 为真时只在内存中重建索引，不删除也不写入任何文件。
+    """
+
+    def __init__(self, root_dir: str, fsync: bool = False, read_only: bool = False):
+        self.root_dir = root_dir
+        self.fsync = fsync
+        self.read_only = read_only
+        self._indexes: Dict[int, List[Dict[str, Any]]] = {}  # chat_id -> 段索引
+        self._lock = threading.RLock()
+
+    def _chat_dir(self, chat_id: int) -> str:
+        """聊天的归档目录"""
+        return os.path.join(self.root_dir, f"chat_{chat_id}")
+
+    def _index_file(self, chat_id: int) -> str:
+        """聊天的段索引文件"""
+        return os.path.join(self._chat_dir(chat_id), "index.json")
+
+    def chat_ids(self) -> List[int]:
+        """获取所有有归档的聊天 ID"""
+        if not os.path.exists(self.root_dir):
+            return []
+
+        chat_ids = []
+        for name in os.listdir(self.root_dir):
+            if name.startswith("chat_"):
+                try:
+                    chat_ids.append(int(name[len("chat_") :]))
+                except ValueError:
+                    continue
+        return chat_ids
+
+    def _index(self, chat_id: int) -> List[Dict[str, Any]]:
+        """获取聊天的段索引，首次访问时从磁盘读取"""
+        with self._lock:
+            index = self._indexes.get(chat_id)
+            if index is None:
+                index = self._indexes[chat_id] = self._load_index(chat_id)
+            return index
+
+    def invalidate(self):
+        """丢弃缓存的段索引，下次访问时重新从磁盘读取"""
+        with self._lock:
+            self._indexes.clear()
+
+    def _load_index(self, chat_id: int) -> List[Dict[str, Any]]:
+        """读取段索引，并删除不在索引中的段文件（写入索引前中断留下的）"""
+        chat_dir = self._chat_dir(chat_id)
+        if not os.path.isdir(chat_dir):
+            return []
+
+        index_file = self._index_file(chat_id)
+        try:
+            with open(index_file, "r", encoding="utf-8") as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            index = []
+        except (ValueError, json.JSONDecodeError) as e:
+            logger.warning(f"归档索引损坏，将从段文件重建 - 聊天: {chat_id}, 错误: {e}")
+            return self._rebuild_index(chat_id)
+
+        if self._upgrade_index(index) and not self.read_only:
+            self._write_index(chat_id, index)
+        if self.read_only:
+            return index
+        indexed = {segment["file"] for segment in index}
+        for name in os.listdir(chat_dir):
+            if name.endswith(".jsonl.gz") and name not in indexed:
+                os.remove(os.path.join(chat_dir, name))
+                logger.warning(f"删除未写入索引的归档段 - 聊天: {chat_id}, 文件: {name}")
+        return index
+
+    @staticmethod
+    def _upgrade_index(index: List[Dict[str, Any]]) -> bool:
+        """把旧版本以秒记录的段起止时间换算为微秒，返回是否有改动
+
+        旧段文件中的时间本身就是整秒，换算没有误差。
+        """
+        upgraded = False
+        for segment in index:
+            if segment.get("ts_unit") != TS_UNIT:
+                segment["start"] *= US_PER_SECOND
+                segment["end"] *= US_PER_SECOND
+                segment["ts_unit"] = TS_UNIT
+                upgraded = True
+        return upgraded
+
+    def _rebuild_index(self, chat_id: int) -> List[Dict[str, Any]]:
+        """扫描段文件重建索引"""
+        chat_dir = self._chat_dir(chat_id)
+        index = []
+        for name in os.listdir(chat_dir):
+            if not name.endswith(".jsonl.gz"):
+                continue
+            path = os.path.join(chat_dir, name)
+            records = self._read_segment(path)
+            if not records:
+                continue
+            index.append(
+                {
+                    "file": name,
+                    "start": records[0][0],
+                    "end": records[-1][0],
+                    "count": len(records),
+                    "bytes": os.path.getsize(path),
+                    "ts_unit": TS_UNIT,
+                }
+            )
+
+        index.sort(key=lambda segment: (segment["start"], segment["end"]))
+        if not self.read_only:
+            self._write_index(chat_id, index)
+        return index
+
+    def _write_index(self, chat_id: int, index: List[Dict[str, Any]]):
+        """原子写入段索引"""
+        atomic_write_text(
+            self._index_file(chat_id),
+            json.dumps(index, ensure_ascii=False),
+            fsync=self.fsync,
+        )
+
+    def _read_segment(self, path: str) -> List[ArchiveRecord]:
+        """解压并读取一个段文件，文件已被删除或损坏时返回能读到的部分"""
+        records: List[ArchiveRecord] = []
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    record = json.loads(line)
+                    records.append(
+                        (
+                            parse_epoch(record["timestamp"]),
+                            int(record["user_id"]),
+                            record["username"],
+                            record["message"],
+                        )
+                    )
+        except FileNotFoundError:
+            pass
+        except (OSError, EOFError, ValueError, KeyError) as e:
+            logger.warning(f"读取归档段时出错: {path}, 错误: {e}")
+        return records
+
+    def write_segment(self, chat_id: int, records: List[ArchiveRecord]) -> bool:
+        """把一批按时间排序的旧消息写成新的归档段"""
+        if not records:
+            return True
+
+        records = sorted(records, key=lambda record: record[0])
+        try:
+            with self._lock:
+                index = self._index(chat_id)
+                chat_dir = self._chat_dir(chat_id)
+                os.makedirs(chat_dir, exist_ok=True)
+
+                lines = "".join(
+                    json.dumps(
+                        {
+                            "user_id": user_id,
+                            "username": username,
+                            "message": message,
+                            "timestamp": format_epoch(ts),
+                        },
+                        ensure_ascii=False,
+                    )
+                    + "\n"
+                    for ts, user_id, username, message in records
+                )
+                data = gzip.compress(lines.encode("utf-8"))
+                name = f"seg_{records[0][0]}_{uuid.uuid4().hex[:8]}.jsonl.gz"
+                atomic_write_bytes(os.path.join(chat_dir, name), data, self.fsync)
+
+                index.append(
+                    {
+                        "file": name,
+                        "start": records[0][0],
+                        "end": records[-1][0],
+                        "count": len(records),
+                        "bytes": len(data),
+                        "ts_unit": TS_UNIT,
+                    }
+                )
+                index.sort(key=lambda segment: (segment["start"], segment["end"]))
+                self._write_index(chat_id, index)
+
+            logger.debug(f"归档聊天 {chat_id} 的 {len(records)} 条消息到 {name}")
+            return True
+
+        except Exception as e:
+            logger.error(f"写入归档段时出错 - 聊天: {chat_id}, 错误: {e}")
+            return False
+
+    def archived_until(self, chat_id: int) -> int:
+        """已归档消息的最晚时间，没有归档时返回 0"""
+        index = self._index(chat_id)
+        return max((segment["end"] for segment in index), default=0)
+
+    def _overlapping(
+        self, chat_id: int, start: int, end: Optional[int]
+    ) -> List[Dict[str, Any]]:
+        """返回与 [start, end) 有重叠的段"""
+        with self._lock:
+            return [
+                dict(segment)
+                for segment in self._index(chat_id)
+                if segment["end"] >= start and (end is None or segment["start"] < end)
+            ]
+
+    def read_range(
+        self, chat_id: int, start: int, end: Optional[int] = None
+    ) -> List[ArchiveRecord]:
+        """读取时间位于 [start, end) 内的归档消息，按时间排序"""
+        records: List[ArchiveRecord] = []
+        for segment in self._overlapping(chat_id, start, end):
+            path = os.path.join(self._chat_dir(chat_id), segment["file"])
+            records.extend(
+                record
+                for record in self._read_segment(path)
+                if record[0] >= start and (end is None or record[0] < end)
+            )
+        records.sort(key=lambda record: record[0])
+        return records
+
+    def iter_range(
+        self,
+        chat_id: int,
+        start: int,
+        end: Optional[int] = None,
+        newest_first: bool = False,
+    ) -> Iterator[ArchiveRecord]:
+        """逐段读取时间位于 [start, end) 内的归档消息
+
+        涉及的段在调用时确定，迭代过程中每次只解压一个段。
+        """
+        segments = self._overlapping(chat_id, start, end)
+        if newest_first:
+            segments.reverse()
+        return self._iter_segments(chat_id, segments, start, end, newest_first)
+
+    def _iter_segments(
+        self,
+        chat_id: int,
+        segments: List[Dict[str, Any]],
+        start: int,
+        end: Optional[int],
+        newest_first: bool,
+    ) -> Iterator[ArchiveRecord]:
+        """按顺序解压各段并产出窗口内的消息"""
+        for segment in segments:
+            path = os.path.join(self._chat_dir(chat_id), segment["file"])
+            records = [
+                record
+                for record in self._read_segment(path)
+                if record[0] >= start and (end is None or record[0] < end)
+            ]
+            records.sort(key=lambda record: record[0])
+            yield from reversed(records) if newest_first else records
+
+    def count_range(self, chat_id: int, start: int, end: Optional[int] = None) -> int:
+        """统计时间位于 [start, end) 内的归档消息数量"""
+        count = 0
+        for segment in self._overlapping(chat_id, start, end):
+            if segment["start"] >= start and (end is None or segment["end"] < end):
+                count += segment["count"]
+                continue
+            path = os.path.join(self._chat_dir(chat_id), segment["file"])
+            count += sum(
+                1
+                for record in self._read_segment(path)
+                if record[0] >= start and (end is None or record[0] < end)
+            )
+        return count
+
+    def total_count(self, chat_id: int) -> int:
+        """聊天已归档的消息总数"""
+        return sum(segment["count"] for segment in self._index(chat_id))
+
+    def enforce_retention(
+        self, chat_id: int, min_ts: Optional[int] = None, max_bytes: int = 0
+    ) -> int:
+        """按保留期限和字节预算删除最旧的段，返回删除的段数
+
+        Args:
+            chat_id: 聊天ID
+            min_ts: 最晚消息早于该时间的段被删除，为空表示不按时间清理
+            max_bytes: 单个聊天归档的字节上限，0 表示不限制
+        """
+        with self._lock:
+            index = self._index(chat_id)
+            kept = list(index)
+            if min_ts is not None:
+                kept = [segment for segment in kept if segment["end"] >= min_ts]
+            if max_bytes > 0:
+                total = sum(segment["bytes"] for segment in kept)
+                while kept and total > max_bytes:
+                    total -= kept.pop(0)["bytes"]
+
+            removed = [segment for segment in index if segment not in kept]
+            if not removed:
+                return 0
+
+            # 先更新索引再删除文件，中断时最多留下会在下次加载时清理的孤立段
+            self._indexes[chat_id] = kept
+            if kept:
+                self._write_index(chat_id, kept)
+            elif os.path.exists(self._index_file(chat_id)):
+                os.remove(self._index_file(chat_id))
+            for segment in removed:
+                try:
+                    os.remove(os.path.join(self._chat_dir(chat_id), segment["file"]))
+                except FileNotFoundError:
+                    pass
+            if not kept:
+                try:
+                    os.rmdir(self._chat_dir(chat_id))
+                except OSError:
+                    pass
+
+        logger.info(f"清理聊天 {chat_id} 的 {len(removed)} 个归档段")
+        return len(removed)
+
+    def get_stats(self, chat_ids: Iterable[int]) -> Dict[str, Any]:
+        """汇总指定聊天的归档段数、消息数和字节数"""
+        segments = messages = total_bytes = 0
+        for chat_id in chat_ids:
+            index = self._index(chat_id)
+            segments += len(index)
+            messages += sum(segment["count"] for segment in index)
+            total_bytes += sum(segment["bytes"] for segment in index)
+        return {"segments": segments, "messages": messages, "bytes": total_bytes}
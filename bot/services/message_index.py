@@ -0,0 +1,391 @@
+"""
+群聊消息的全文索引
+按聊天维护倒排索引，中日韩文字按字符二元组切分，无需分词器即可检索
+"""
+
+import heapq
+import math
+import re
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from loguru import logger
+
+from bot.services.chat_history import format_epoch, to_epoch
+from bot.utils.text_budget import CJK_CHARS
+from config.settings import config_manager
+
+_CJK_RE = re.compile(f"[{CJK_CHARS}]")
+# 连续的中日韩文字，或不含中日韩文字的连续单词字符（字母、数字）
+_TOKEN_RE = re.compile(f"[{CJK_CHARS}]+|[^\\W_{CJK_CHARS}]+")
+
+# 索引文档：(时间戳, 用户名, 消息内容)
+IndexDocument = Tuple[int, str, str]
+
+
+def tokenize(text: str) -> List[str]:
+    """将文本切分为索引词
+
+    字母数字按整词（小写）切分；中日韩文字按相邻两个字符切分为二元组，
+    单独出现的一个字作为一元词保留。
+    """
+    terms: List[str] = []
+    for run in _TOKEN_RE.findall(text.lower()):
+        if not _is_cjk(run[0]):
+            terms.append(run)
+        elif len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i : i + 2] for i in range(len(run) - 1))
+    return terms
+
+
+def _is_cjk(char: str) -> bool:
+    """字符是否属于中日韩文字"""
+    return _CJK_RE.match(char) is not None
+
+
+def make_snippet(text: str, query: str, width: int = 60) -> str:
+    """截取消息中第一个命中查询词附近的片段"""
+    text = " ".join(text.split())
+    if len(text) <= width:
+        return text
+
+    lowered = text.lower()
+    positions = [
+        lowered.find(term) for term in tokenize(query) if lowered.find(term) >= 0
+    ]
+    center = min(positions) if positions else 0
+    start = max(0, min(center - width // 3, len(text) - width))
+    snippet = text[start : start + width]
+    prefix = "…" if start > 0 else ""
+    suffix = "…" if start + width < len(text) else ""
+    return prefix + snippet + suffix
+
+
+class ChatIndex:
+    """单个聊天的倒排索引
+
+    文档按写入顺序编号，编号从 base 开始连续递增；倒排表记录每个词出现在哪些文档
+    以及出现次数，同时保存文档长度用于 BM25 的长度归一化。
+    文档引用消息存储中的文本对象，不另存副本。
+    """
+
+    __slots__ = (
+        "base",
+        "timestamps",
+        "usernames",
+        "texts",
+        "lengths",
+        "postings",
+        "posting_entries",
+        "total_length",
+    )
+
+    def __init__(self):
+        self._reset(0)
+
+    def _reset(self, base: int):
+        """清空所有文档，之后的文档从 base 开始编号"""
+        self.base = base  # 第一篇文档的编号
+        self.timestamps = array("q")
+        self.usernames: List[str] = []
+        self.texts: List[str] = []
+        self.lengths = array("I")
+        self.postings: Dict[str, Dict[int, int]] = {}  # 词 -> {文档编号: 词频}
+        self.posting_entries = 0  # 倒排表中 (文档, 词频) 的总条数
+        self.total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def add(self, ts: int, username: str, text: str):
+        """追加一篇文档并更新倒排表"""
+        doc_id = self.base + len(self.texts)
+        terms = tokenize(text)
+        self.timestamps.append(ts)
+        self.usernames.append(sys.intern(username))
+        self.texts.append(text)
+        self.lengths.append(len(terms))
+        self.total_length += len(terms)
+
+        counts: Dict[str, int] = {}
+        for term in terms:
+            counts[term] = counts.get(term, 0) + 1
+        for term, tf in counts.items():
+            self.postings.setdefault(term, {})[doc_id] = tf
+        self.posting_entries += len(counts)
+
+    def documents(self) -> Iterable[IndexDocument]:
+        """按写入顺序遍历所有文档"""
+        return zip(self.timestamps, self.usernames, self.texts)
+
+    def retain(self, min_ts: Optional[int] = None, max_docs: int = 0) -> int:
+        """只保留不早于 min_ts 的最近 max_docs 篇文档并重建倒排表，返回删除的文档数"""
+        kept = [
+            doc for doc in self.documents() if min_ts is None or doc[0] >= min_ts
+        ]
+        if max_docs > 0:
+            kept = kept[-max_docs:]
+        removed = len(self) - len(kept)
+        if not removed:
+            return 0
+
+        self._reset(self.base + len(self))
+        for doc in kept:
+            self.add(*doc)
+        return removed
+
+    def memory_bytes(self) -> int:
+        """估算占用的内存：文档列、倒排表的字典项和词本身
+
+        消息文本引用存储返回的字符串，不计入。
+        """
+        return len(self) * 40 + self.posting_entries * 100 + len(self.postings) * 150
+
+    def _expand(self, term: str) -> List[str]:
+        """单个中日韩字的查询词扩展为包含该字的所有索引词"""
+        if len(term) == 1 and _is_cjk(term):
+            return [candidate for candidate in self.postings if term in candidate]
+        return [term]
+
+    def search(
+        self,
+        query: str,
+        start: Optional[int] = None,
+        end: Optional[int] = None,
+        limit: int = 10,
+        k1: float = 1.2,
+        b: float = 0.75,
+    ) -> List[Tuple[float, int]]:
+        """按 BM25 对时间位于 [start, end) 内的文档打分，返回 (分数, 文档下标) 列表"""
+        count = len(self)
+        if not count:
+            return []
+
+        terms = set()
+        for term in tokenize(query):
+            terms.update(self._expand(term))
+
+        avg_length = self.total_length / count or 1.0
+        scores: Dict[int, float] = {}
+        for term in terms:
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            df = len(postings)
+            idf = math.log(1 + (count - df + 0.5) / (df + 0.5))
+            for doc_id, tf in postings.items():
+                index = doc_id - self.base
+                ts = self.timestamps[index]
+                if start is not None and ts < start:
+                    continue
+                if end is not None and ts >= end:
+                    continue
+                norm = k1 * (1 - b + b * self.lengths[index] / avg_length)
+                scores[index] = scores.get(index, 0.0) + idf * tf * (k1 + 1) / (
+                    tf + norm
+                )
+
+        # 分数相同时较新的消息排在前面
+        return [
+            (score, index)
+            for index, score in heapq.nlargest(
+                limit, scores.items(), key=lambda item: (item[1], item[0])
+            )
+        ]
+
+
+class MessageIndex:
+    """按聊天划分的消息全文索引
+
+    索引不单独保存消息：某个聊天第一次被检索时，从消息存储中该聊天的记录
+    （包括导入和归档的历史）重建最近 max_docs 条消息的倒排表，之后随新消息增量更新。
+    文档引用存储返回的消息文本，不在磁盘上另存副本，因此存储的后端、归档、
+    写入锁和代数协议同样适用于索引。
+
+    存储支持 attach_index 时（文件存储），索引与存储共用 _state_lock，
+    占用的内存计入存储的内存预算，聊天被卸载或只读进程重新加载时一并丢弃；
+    其他后端按 memory_budget 自行淘汰最久未使用的聊天索引。
+    """
+
+    def __init__(self, store, max_docs: int = 5000, memory_budget: int = 0):
+        self.store = store
+        self.max_docs = max(1, max_docs)
+        self.memory_budget = memory_budget
+        self._indexes: "OrderedDict[int, ChatIndex]" = OrderedDict()  # 按最近使用排序
+        attach = getattr(store, "attach_index", None)
+        if attach is not None:
+            self._state_lock = store._state_lock
+            attach(self)
+        else:
+            self._state_lock = threading.RLock()
+        self._stats = {
+            "searches": 0,
+            "total_search_ms": 0.0,
+            "max_search_ms": 0.0,
+            "builds": 0,
+            "build_docs": 0,
+            "total_build_ms": 0.0,
+            "evictions": 0,
+        }
+
+    def _get_index(self, chat_id: int) -> ChatIndex:
+        """获取聊天的索引，首次访问时由存储中的记录重建"""
+        with self._state_lock:
+            index = self._indexes.get(chat_id)
+            if index is not None:
+                self._indexes.move_to_end(chat_id)
+                return index
+
+        # 在锁外遍历存储：文件存储读取归档时需要先取得其 _io_lock
+        started = time.perf_counter()
+        documents = deque(maxlen=self.max_docs)
+        for ts, _, username, text in self.store.iter_chat_records(chat_id):
+            documents.append((ts, username, text))
+        index = ChatIndex()
+        for doc in documents:
+            index.add(*doc)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        with self._state_lock:
+            existing = self._indexes.get(chat_id)
+            if existing is not None:
+                return existing
+            self._indexes[chat_id] = index
+            self._stats["builds"] += 1
+            self._stats["build_docs"] += len(index)
+            self._stats["total_build_ms"] += elapsed_ms
+            self._enforce_budget()
+        logger.debug(
+            f"重建消息索引 - 聊天: {chat_id}, 文档: {len(index)} 条, "
+            f"耗时: {elapsed_ms:.1f} ms"
+        )
+        return index
+
+    def add(self, chat_id: int, username: str, text: str, timestamp: datetime):
+        """把一条已写入存储的消息加入索引，聊天的索引尚未建立时无需处理"""
+        try:
+            with self._state_lock:
+                index = self._indexes.get(chat_id)
+                if index is None:
+                    return
+                index.add(to_epoch(timestamp), username, text)
+                # 超出保留数量较多时才重建，避免每条消息都触发重建
+                if len(index) > self.max_docs + self.max_docs // 4:
+                    index.retain(max_docs=self.max_docs)
+
+        except Exception as e:
+            logger.error(f"更新消息索引时出错 - 聊天: {chat_id}, 错误: {e}")
+
+    def drop(self, chat_id: int) -> int:
+        """丢弃聊天的索引，下次检索时重建，返回释放的估算字节数"""
+        with self._state_lock:
+            index = self._indexes.pop(chat_id, None)
+        return index.memory_bytes() if index is not None else 0
+
+    def clear(self):
+        """丢弃所有聊天的索引，用于存储中的消息被批量清理或替换之后"""
+        with self._state_lock:
+            self._indexes.clear()
+
+    def memory_bytes(self) -> int:
+        """所有已建立索引的估算内存"""
+        with self._state_lock:
+            return sum(index.memory_bytes() for index in self._indexes.values())
+
+    def _enforce_budget(self):
+        """超出自身的内存预算时丢弃最久未使用的索引，调用方需持有 _state_lock"""
+        if self.memory_budget <= 0:
+            return
+        used = self.memory_bytes()
+        while used > self.memory_budget and len(self._indexes) > 1:
+            _, index = self._indexes.popitem(last=False)
+            used -= index.memory_bytes()
+            self._stats["evictions"] += 1
+
+    def search(
+        self,
+        chat_id: int,
+        query: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        limit: int = 10,
+    ) -> List[Dict[str, Any]]:
+        """检索聊天中与 query 最相关的消息
+
+        Args:
+            chat_id: 聊天ID
+            query: 查询文本
+            start: 只检索该时间之后的消息，为空表示不限
+            end: 只检索该时间之前的消息，为空表示直到当前
+            limit: 最多返回的结果数
+
+        Returns:
+            List[Dict]: 按相关度从高到低排列，包含 timestamp、username、message、score
+        """
+        started = time.perf_counter()
+        try:
+            index = self._get_index(chat_id)
+            lo = None if start is None else to_epoch(start)
+            hi = None if end is None else to_epoch(end)
+            with self._state_lock:
+                results = [
+                    {
+                        "timestamp": format_epoch(index.timestamps[i]),
+                        "username": index.usernames[i],
+                        "message": index.texts[i],
+                        "score": round(score, 4),
+                    }
+                    for score, i in index.search(query, lo, hi, limit)
+                ]
+        except Exception as e:
+            logger.error(f"检索消息索引时出错 - 聊天: {chat_id}, 错误: {e}")
+            return []
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._state_lock:
+            self._stats["searches"] += 1
+            self._stats["total_search_ms"] += elapsed_ms
+            self._stats["max_search_ms"] = max(self._stats["max_search_ms"], elapsed_ms)
+        logger.debug(
+            f"检索消息索引 - 聊天: {chat_id}, 结果: {len(results)} 条, 耗时: {elapsed_ms:.1f} ms"
+        )
+        return results
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取已建立索引的聊天数、文档数、词数、内存和检索耗时"""
+        with self._state_lock:
+            stats = dict(self._stats)
+            stats["loaded_chats"] = len(self._indexes)
+            stats["documents"] = sum(len(index) for index in self._indexes.values())
+            stats["terms"] = sum(len(index.postings) for index in self._indexes.values())
+            stats["memory_bytes"] = self.memory_bytes()
+        searches = stats["searches"]
+        stats["avg_search_ms"] = stats["total_search_ms"] / searches if searches else 0.0
+        return stats
+
+
+def create_message_index(store) -> Optional[MessageIndex]:
+    """根据配置为消息存储创建索引，storage.index_enabled 为 false 时返回 None
+
+    不支持 attach_index 的存储（SQLite、Redis）没有内存预算，
+    索引使用 storage.memory_budget_mb 作为自身的预算。
+    """
+    storage_config = config_manager.get_storage_config()
+    if not storage_config.get("index_enabled", True):
+        return None
+
+    memory_budget = 0
+    if not hasattr(store, "attach_index"):
+        memory_budget = storage_config.get("memory_budget_mb", 256) * 1024 * 1024
+    return MessageIndex(
+        store,
+        max_docs=storage_config.get("index_max_docs", 5000),
+        memory_budget=memory_budget,
+    )
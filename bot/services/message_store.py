@@ -5,59 +5,823 @@
 
 import json
 import os
-from collections import defaultdict
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
-from typing import Any, Dict, List
+from itertools import chain
+from typing import Any, Dict, Iterator, List, Optional
 
 from loguru import logger
 
+from bot.services.chat_history import (
+    US_PER_SECOND,
+    ChatHistory,
+    UserTable,
+    parse_epoch,
+    to_epoch,
+)
+from bot.services.message_archive import ArchiveRecord, MessageArchive
+from bot.services.write_behind import WriteBehindFlusher
+from bot.utils.atomic_io import (
+    atomic_write_text,
+    checksum_line,
+    salvage_json_array,
+    verify_line,
+)
+from bot.utils.file_lock import FileLock, read_generation
+from bot.utils.lru_cache import LRUCache
+from bot.utils.text_budget import limit_by_budget
+from config.settings import config_manager
+
+
+class StoreLockedError(RuntimeError):
+    """数据目录已被另一个写入进程占用"""
 
-class MessageStore:
-    """消息存储器"""
 
-    def __init__(self, storage_dir: str = "data"):
+class MessageStore:
+    """消息存储器
+
+    群聊消息以 JSONL 追加日志持久化：每条消息只追加一行，
+    日志行数超过上限后再整体压缩重写一次。内存中每个聊天使用 ChatHistory 列式保存。
+    日志中的消息行只记录发送者在该日志用户表中的编号，用户首次出现或改名时
+    先追加一行用户表项；旧格式的完整记录仍可正常读取。
+
+    懒加载模式下启动时只扫描目录建立清单（聊天 ID、文件大小、修改时间），
+    某个聊天的消息在第一次被访问时才从磁盘读取。
+
+    所有写盘操作都经过待写队列：修改只更新内存并把聊天标记为脏，
+    由 WriteBehindFlusher 在后台线程中按批次落盘（未启动后台任务时立即同步写入）。
+
+    最近使用的对话历史保存在 LRU 缓存中，每轮对话的读取和追加都不再读文件，
+    刷新时直接用缓存内容覆盖写入对话历史文件。
+
+    整体重写的文件（压缩后的日志、对话历史）都通过临时文件加原子重命名写入；
+    追加日志的每一行带有 CRC32 校验和。加载时跳过校验失败的行、从截断的 JSON 中
+    尽量取回完整记录，并把受损的聊天标记为待压缩，下次刷新时用有效记录重写。
+
+    启用归档时，每个聊天只有最近的消息作为热数据保存在内存和 JSONL 日志中；
+    被挤出的旧消息先暂存在内存，压缩日志时写成 gzip 归档段（见 MessageArchive）。
+    时间窗口查询会同时覆盖热数据和冷数据，归档按保留天数和每个聊天的字节预算清理。
+
+    设置内存预算时，已加载聊天的估算内存超出预算后，按最后活动时间从最久未活动的
+    聊天开始卸载（只卸载已全部写盘且空闲足够久的聊天），卸载的聊天放回清单，
+    下次访问时重新加载。
+
+    多进程访问采用单写多读：写入进程在整个生命周期内持有数据目录的 .writer.lock，
+    第二个写入进程会在启动时失败；每次修改数据文件都在 .commit.lock 的排他锁内完成，
+    结束后递增 .generation 中的代数。read_only 模式的进程（如独立运行的控制面板或
+    分析任务）在共享锁内读取文件，看到的总是某次提交完成后的一致状态；
+    发现代数变化时丢弃已加载的内容，之后按需重新读取。锁基于 fcntl.flock，
+    不支持的平台上不加锁。
+    """
+
+    # 每个聊天在内存中保留的最大消息数（热数据）
+    MAX_MESSAGES_PER_CHAT = 1000
+    # 日志中超出保留数量的冗余行达到该值时触发压缩
+    COMPACT_THRESHOLD = 1000
+    # 每个聊天保存的最大对话消息数
+    MAX_DIALOG_MESSAGES = 100
+    # 流式遍历消息时每次在锁内复制的条数
+    ITER_CHUNK_SIZE = 256
+
+    def __init__(
+        self,
+        storage_dir: str = "data",
+        lazy: bool = False,
+        flush_interval: float = 1.0,
+        flush_max_pending: int = 200,
+        fsync: str = "never",
+        dialog_cache_size: int = 256,
+        dialog_cache_ttl: float = 0,
+        archive: bool = True,
+        archive_max_bytes: int = 20 * 1024 * 1024,
+        memory_budget: int = 0,
+        evict_idle_seconds: float = 300,
+        read_only: bool = False,
+        refresh_interval: float = 1.0,
+    ):
         self.storage_dir = storage_dir
         self.data_dir = storage_dir  # 添加 data_dir 属性以符合任务要求
-        self.messages = defaultdict(list)  # chat_id -> messages
+        self.lazy = lazy
+        self.fsync = fsync
+        self.messages: Dict[int, ChatHistory] = {}  # chat_id -> messages
+        self._log_lines = defaultdict(int)  # chat_id -> 日志文件中的消息行数（含待写）
+        self._log_users: Dict[int, UserTable] = {}  # chat_id -> 日志中已写入的用户表
+        # 待写队列，由 _state_lock 保护；_io_lock 保证读写文件与刷新互斥
+        self._pending_lines: Dict[int, List[str]] = {}  # 待追加的 JSONL 行
+        self._compact_chats: set = set()  # 待整体重写日志的聊天
+        self._pending_dialogs: Dict[int, List[dict]] = {}  # 待写入的对话消息
+        # 被挤出热数据、尚未写入归档的消息，列表对象与 ChatHistory.spill 共享
+        self._archive_buffer: Dict[int, List[ArchiveRecord]] = {}
+        self.archive: Optional[MessageArchive] = (
+            MessageArchive(
+                os.path.join(storage_dir, "archive"), fsync == "flush", read_only
+            )
+            if archive
+            else None
+        )
+        self.archive_max_bytes = archive_max_bytes
+        # 内存预算（字节，0 表示不限制）和按最后活动时间排序的已加载聊天
+        self.memory_budget = memory_budget
+        self.evict_idle_seconds = evict_idle_seconds
+        self._last_active: "OrderedDict[int, float]" = OrderedDict()
+        self._evictions = 0
+        # 附加的消息全文索引（MessageIndex），由 attach_index 设置
+        self._index = None
+        self._state_lock = threading.RLock()
+        self._io_lock = threading.RLock()
+        # chat_id -> 完整对话历史（含待写消息），由 _state_lock 保护其内容
+        self._dialog_cache = LRUCache(dialog_cache_size, dialog_cache_ttl)
+        self._flusher = WriteBehindFlusher(
+            self._write_pending,
+            self._queue_depth,
+            interval=flush_interval,
+            max_pending=flush_max_pending,
+        )
+        self._manifest: Dict[int, Dict[str, Any]] = {}  # 尚未加载的聊天 -> 文件信息
+        self.load_stats: Dict[str, Any] = {
+            "manifest_seconds": 0.0,
+            "chats_loaded": 0,
+            "messages_loaded": 0,
+            "bytes_loaded": 0,
+            "load_seconds": 0.0,
+            "max_chat_load_seconds": 0.0,
+            # 崩溃恢复统计
+            "corrupt_lines": 0,
+            "salvaged_records": 0,
+            "repaired_chats": 0,
+            "tmp_files_removed": 0,
+        }
         self._ensure_storage_dir()
+        self._acquire_locks(read_only, refresh_interval)
         self._load_messages()
 
+    def _acquire_locks(self, read_only: bool, refresh_interval: float):
+        """准备跨进程锁；写入模式下独占数据目录，已被其他进程占用时抛出 StoreLockedError"""
+        self.read_only = read_only
+        self.refresh_interval = refresh_interval
+        self._commit_lock = FileLock(os.path.join(self.storage_dir, ".commit.lock"))
+        self._generation_file = os.path.join(self.storage_dir, ".generation")
+        self._writer_lock: Optional[FileLock] = None
+        if not read_only:
+            self._writer_lock = FileLock(os.path.join(self.storage_dir, ".writer.lock"))
+            if not self._writer_lock.acquire(blocking=False):
+                self._writer_lock.close()
+                raise StoreLockedError(
+                    f"数据目录 {self.storage_dir} 正被另一个进程写入，"
+                    f"其他进程只能以只读模式打开"
+                )
+        if not self._commit_lock.supported:
+            logger.warning("当前平台不支持 fcntl 文件锁，多进程访问数据目录时不受保护")
+        self._generation = read_generation(self._generation_file) or 0
+        self._generation_checked = time.monotonic()
+
+    def close(self):
+        """写入剩余数据并释放跨进程锁，之后不应再使用该实例"""
+        self.flush()
+        self._commit_lock.close()
+        if self._writer_lock is not None:
+            self._writer_lock.close()
+            self._writer_lock = None
+
+    def _check_writable(self):
+        """只读模式下拒绝修改"""
+        if self.read_only:
+            raise PermissionError("消息存储以只读模式打开，不能修改")
+
+    @contextmanager
+    def _committing(self) -> Iterator[None]:
+        """在跨进程排他锁内修改数据文件，结束后递增代数，通知只读进程重新加载"""
+        with self._io_lock, self._commit_lock.exclusive():
+            try:
+                yield
+            finally:
+                self._generation += 1
+                atomic_write_text(self._generation_file, str(self._generation))
+
+    @contextmanager
+    def _reading(self) -> Iterator[None]:
+        """读取数据文件；只读模式下持有跨进程共享锁，不会读到一次提交的中间状态"""
+        with self._io_lock:
+            if self.read_only:
+                with self._commit_lock.shared():
+                    yield
+            else:
+                yield
+
+    def _maybe_refresh(self):
+        """只读模式下定期检查代数，写入进程提交过修改时丢弃已加载的内容并重建清单"""
+        if not self.read_only:
+            return
+        now = time.monotonic()
+        if now - self._generation_checked < self.refresh_interval:
+            return
+        self._generation_checked = now
+        generation = read_generation(self._generation_file) or 0
+        if generation == self._generation:
+            return
+
+        with self._io_lock, self._state_lock:
+            self.messages.clear()
+            self._last_active.clear()
+            self._log_lines.clear()
+            self._log_users.clear()
+            self._archive_buffer.clear()
+            self._manifest.clear()
+            self._dialog_cache.clear()
+            if self._index is not None:
+                self._index.clear()
+            if self.archive is not None:
+                self.archive.invalidate()
+            self._generation = generation
+            self._build_manifest()
+        logger.debug(f"数据目录已更新到第 {generation} 代，重新按需加载")
+
     def _ensure_storage_dir(self):
         """确保存储目录存在"""
         os.makedirs(self.storage_dir, exist_ok=True)
 
     def _get_storage_file(self, chat_id: int) -> str:
-        """获取聊天的存储文件路径"""
+        """获取聊天的旧版快照文件路径（整文件 JSON，仅用于兼容加载）"""
         return os.path.join(self.storage_dir, f"chat_{chat_id}_messages.json")
 
+    def _get_log_file(self, chat_id: int) -> str:
+        """获取聊天的追加日志文件路径（JSONL，每行一条消息）"""
+        return os.path.join(self.storage_dir, f"chat_{chat_id}_messages.jsonl")
+
     def _get_dialog_history_file(self, chat_id: int) -> str:
         """获取对话历史的存储文件路径"""
         return os.path.join(self.storage_dir, f"dialog_history_{chat_id}.json")
 
     def _load_messages(self):
-        """加载所有消息"""
+        """加载所有消息
+
+        先建立文件清单；非懒加载模式下立即加载清单中的所有聊天。
+        """
         try:
-            if not os.path.exists(self.storage_dir):
+            self._build_manifest()
+            if self.lazy:
+                logger.info(
+                    f"消息清单已建立，共 {len(self._manifest)} 个聊天，"
+                    f"耗时 {self.load_stats['manifest_seconds'] * 1000:.1f} ms，将按需加载"
+                )
                 return
 
-            for filename in os.listdir(self.storage_dir):
-                if filename.startswith("chat_") and filename.endswith("_messages.json"):
-                    # 从文件名提取 chat_id
+            with self._reading():
+                for chat_id in list(self._manifest):
+                    self._load_chat(chat_id)
+
+            logger.info(
+                f"已加载 {len(self.messages)} 个聊天的消息记录，"
+                f"耗时 {self.load_stats['load_seconds'] * 1000:.1f} ms"
+            )
+            if self.load_stats["repaired_chats"]:
+                logger.warning(
+                    f"{self.load_stats['repaired_chats']} 个聊天的消息文件已损坏，"
+                    f"跳过 {self.load_stats['corrupt_lines']} 行无效记录，将在下次写盘时修复"
+                )
+
+        except Exception as e:
+            logger.error(f"加载消息时出错: {e}")
+
+    def _build_manifest(self):
+        """扫描存储目录，记录每个聊天的文件大小和最后修改时间"""
+        started = time.perf_counter()
+        if not os.path.exists(self.storage_dir):
+            return
+
+        with os.scandir(self.storage_dir) as entries:
+            for entry in entries:
+                filename = entry.name
+                # 残留的临时文件是中断的写入，目标文件仍是完整的旧版本；
+                # 只读进程看到的可能是写入进程正在写的文件，不能删除
+                if filename.endswith(".tmp"):
+                    if self.read_only:
+                        continue
                     try:
-                        chat_id = int(filename.split("_")[1])
-                        file_path = os.path.join(self.storage_dir, filename)
+                        os.remove(entry.path)
+                        self.load_stats["tmp_files_removed"] += 1
+                        logger.warning(f"删除未完成写入的临时文件: {filename}")
+                    except OSError as e:
+                        logger.warning(f"无法删除临时文件 {filename}: {e}")
+                    continue
+                if not filename.startswith("chat_"):
+                    continue
+                if filename.endswith("_messages.json"):
+                    size_key = "snapshot_bytes"
+                elif filename.endswith("_messages.jsonl"):
+                    size_key = "log_bytes"
+                else:
+                    continue
+
+                # 从文件名提取 chat_id
+                try:
+                    chat_id = int(filename.split("_")[1])
+                except ValueError as e:
+                    logger.warning(f"无法解析消息文件名 {filename}: {e}")
+                    continue
+
+                stat = entry.stat()
+                item = self._manifest.setdefault(
+                    chat_id, {"snapshot_bytes": 0, "log_bytes": 0, "mtime": 0.0}
+                )
+                item[size_key] = stat.st_size
+                item["mtime"] = max(item["mtime"], stat.st_mtime)
+
+        self.load_stats["manifest_seconds"] = time.perf_counter() - started
+
+    def _get_history(self, chat_id: int) -> Optional[ChatHistory]:
+        """获取聊天的消息容器，尚未加载时从磁盘加载，并记录聊天的活动时间"""
+        self._maybe_refresh()
+        history = self.messages.get(chat_id)
+        if history is None and chat_id in self._manifest:
+            with self._reading():
+                if chat_id in self._manifest:
+                    self._load_chat(chat_id)
+            history = self.messages.get(chat_id)
+        if history is not None:
+            self._touch(chat_id)
+        return history
+
+    def _touch(self, chat_id: int):
+        """将聊天标记为最近活动"""
+        with self._state_lock:
+            self._last_active[chat_id] = time.monotonic()
+            self._last_active.move_to_end(chat_id)
+
+    def _manifest_entry(self, chat_id: int) -> Dict[str, Any]:
+        """根据磁盘上的文件生成聊天的清单项"""
+        item = {"snapshot_bytes": 0, "log_bytes": 0, "mtime": 0.0}
+        for size_key, path in (
+            ("snapshot_bytes", self._get_storage_file(chat_id)),
+            ("log_bytes", self._get_log_file(chat_id)),
+        ):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            item[size_key] = stat.st_size
+            item["mtime"] = max(item["mtime"], stat.st_mtime)
+        return item
+
+    def attach_index(self, index):
+        """附加消息全文索引
+
+        索引与存储共用 _state_lock，占用的内存计入内存预算；
+        聊天被卸载、导入新消息或只读进程重新加载时丢弃其索引，下次检索时重建。
+        """
+        self._index = index
+
+    def _memory_used(self) -> int:
+        """已加载聊天及其索引的估算内存总量"""
+        with self._state_lock:
+            used = sum(history.memory_bytes() for history in self.messages.values())
+            if self._index is not None:
+                used += self._index.memory_bytes()
+            return used
 
-                        with open(file_path, "r", encoding="utf-8") as f:
-                            messages = json.load(f)
-                            self.messages[chat_id] = messages
+    def _enforce_memory_budget(self) -> int:
+        """超出内存预算时卸载最久未活动的聊天，返回卸载的聊天数
 
-                    except (ValueError, json.JSONDecodeError) as e:
-                        logger.warning(f"无法加载消息文件 {filename}: {e}")
+        有待写数据的聊天和空闲时间不足 evict_idle_seconds 的聊天不会被卸载，
+        因此正在处理中的聊天不会被卸载，也不会丢失尚未写盘的修改。
+        """
+        if self.memory_budget <= 0:
+            return 0
+
+        evicted = 0
+        with self._state_lock:
+            used = self._memory_used()
+            if used <= self.memory_budget:
+                return 0
 
-            logger.info(f"已加载 {len(self.messages)} 个聊天的消息记录")
+            now = time.monotonic()
+            for chat_id, last_active in list(self._last_active.items()):
+                if used <= self.memory_budget:
+                    break
+                if now - last_active < self.evict_idle_seconds:
+                    break
+                if chat_id in self._pending_lines or chat_id in self._compact_chats:
+                    continue
+
+                freed = self._unload_chat(chat_id)
+                if freed is None:
+                    continue
+                used -= freed
+                evicted += 1
 
+            self._evictions += evicted
+
+        if evicted:
+            logger.debug(
+                f"内存超出预算，已卸载 {evicted} 个空闲聊天，"
+                f"当前估算占用 {used / 1024 / 1024:.1f} MB"
+            )
+        return evicted
+
+    def _unload_chat(self, chat_id: int) -> Optional[int]:
+        """卸载聊天并放回清单，返回释放的估算字节数，聊天未加载时返回 None
+
+        调用方需持有 _state_lock，并确认聊天没有待写数据。
+        """
+        self._last_active.pop(chat_id, None)
+        index_bytes = self._index.drop(chat_id) if self._index is not None else 0
+        history = self.messages.pop(chat_id, None)
+        if history is None:
+            return None
+        # 暂存的待归档消息仍在日志中，重新加载时会再次进入暂存列表
+        self._archive_buffer.pop(chat_id, None)
+        self._log_lines.pop(chat_id, None)
+        self._log_users.pop(chat_id, None)
+        self._manifest[chat_id] = self._manifest_entry(chat_id)
+        return history.memory_bytes() + index_bytes
+
+    def _forget_chat_file(self, chat_id: int):
+        """聊天的消息文件被删除后同步内存状态
+
+        日志中的用户表项随文件一起删除，日志行数和已写入的用户表必须作废，
+        否则之后追加的行会引用文件中不存在的编号。没有待写数据的聊天直接卸载，
+        仍有其他文件时放回清单；有待写数据时改为用内存中的消息整体重写日志。
+        调用方需持有 _io_lock。
+        """
+        with self._state_lock:
+            if chat_id in self._pending_lines or chat_id in self._compact_chats:
+                self._request_compaction(chat_id)
+                return
+            self._unload_chat(chat_id)
+            self._log_lines.pop(chat_id, None)
+            self._log_users.pop(chat_id, None)
+            item = self._manifest_entry(chat_id)
+            if item["mtime"]:
+                self._manifest[chat_id] = item
+            else:
+                self._manifest.pop(chat_id, None)
+
+    def unload_chat(self, chat_id: int) -> bool:
+        """立即卸载一个已全部写盘的聊天，下次访问时重新加载；有待写数据时不卸载"""
+        with self._state_lock:
+            if chat_id in self._pending_lines or chat_id in self._compact_chats:
+                return False
+            return self._unload_chat(chat_id) is not None
+
+    def get_memory_stats(self) -> Dict[str, Any]:
+        """获取内存预算、估算占用和卸载次数"""
+        with self._state_lock:
+            usage = sorted(
+                (
+                    (chat_id, history.memory_bytes())
+                    for chat_id, history in self.messages.items()
+                ),
+                key=lambda item: item[1],
+                reverse=True,
+            )
+        return {
+            "budget_bytes": self.memory_budget,
+            "used_bytes": sum(size for _, size in usage),
+            "loaded_chats": len(usage),
+            "unloaded_chats": len(self._manifest),
+            "evictions": self._evictions,
+            "largest_chats": [
+                {"chat_id": chat_id, "bytes": size} for chat_id, size in usage[:5]
+            ],
+        }
+
+    def _load_chat(self, chat_id: int):
+        """加载单个聊天的快照和追加日志，并记录加载耗时"""
+        started = time.perf_counter()
+        with self._state_lock:
+            item = self._manifest.pop(chat_id, None)
+            history = self._new_history(chat_id)
+        messages = []
+
+        damaged = False
+
+        snapshot_file = self._get_storage_file(chat_id)
+        if os.path.exists(snapshot_file):
+            with open(snapshot_file, "r", encoding="utf-8") as f:
+                text = f.read()
+            try:
+                messages = json.loads(text)
+            except (ValueError, json.JSONDecodeError) as e:
+                messages = salvage_json_array(text)
+                damaged = True
+                self.load_stats["salvaged_records"] += len(messages)
+                logger.warning(
+                    f"消息文件 {snapshot_file} 已损坏，取回 {len(messages)} 条记录: {e}"
+                )
+            if not isinstance(messages, list):
+                messages = []
+
+        log_lines = 0
+        log_users = UserTable()
+        log_file = self._get_log_file(chat_id)
+        if os.path.exists(log_file):
+            with open(log_file, "r", encoding="utf-8") as f:
+                for raw_line in f:
+                    line = raw_line.strip()
+                    if not line:
+                        continue
+                    payload = verify_line(line)
+                    record = (
+                        None if payload is None else self._decode_log(payload, log_users)
+                    )
+                    if record is None:
+                        # 写入中断留下的半行或校验失败的行，跳过即可
+                        damaged = True
+                        self.load_stats["corrupt_lines"] += 1
+                        logger.warning(f"跳过损坏的日志行 - 聊天: {chat_id}")
+                        continue
+                    if not raw_line.endswith("\n"):
+                        # 最后一行缺少换行符，之后追加的行会与它粘连
+                        damaged = True
+                    if "message" in record:
+                        log_lines += 1
+                        messages.append(record)
+
+        # 写入归档段后、重写日志前中断时，日志中会残留已归档的消息
+        archived_until = self.archive.archived_until(chat_id) if self.archive else 0
+        for record in messages:
+            try:
+                ts = parse_epoch(record["timestamp"])
+                if ts < archived_until:
+                    continue
+                history.append(
+                    int(record["user_id"]), record["username"], record["message"], ts
+                )
+            except (ValueError, KeyError, TypeError):
+                continue
+
+        with self._state_lock:
+            if len(history):
+                self.messages[chat_id] = history
+                self._touch(chat_id)
+            self._log_lines[chat_id] = log_lines
+            self._log_users[chat_id] = log_users
+        if damaged and not self.read_only:
+            # 下次刷新时用内存中的有效记录重写日志，新的追加不会接在损坏的行后面
+            self.load_stats["repaired_chats"] += 1
+            self._request_compaction(chat_id)
+
+        elapsed = time.perf_counter() - started
+        stats = self.load_stats
+        stats["chats_loaded"] += 1
+        stats["messages_loaded"] += len(history)
+        stats["load_seconds"] += elapsed
+        stats["max_chat_load_seconds"] = max(stats["max_chat_load_seconds"], elapsed)
+        if item is not None:
+            stats["bytes_loaded"] += item["snapshot_bytes"] + item["log_bytes"]
+        logger.debug(
+            f"加载聊天 {chat_id} 的 {len(history)} 条消息，耗时 {elapsed * 1000:.1f} ms"
+        )
+        self._enforce_memory_budget()
+
+    @staticmethod
+    def _decode_log(payload: str, users: UserTable) -> Optional[Dict[str, Any]]:
+        """解析一行日志：用户表项写入 users 并原样返回，消息行补全发送者信息
+
+        旧格式的消息行自带 user_id 和 username；引用了未定义编号的行返回 None。
+        """
+        try:
+            record = json.loads(payload)
+            if "u" not in record:
+                return record
+            ref = int(record["u"])
+            if "message" not in record:
+                users.define(ref, int(record["user_id"]), record["username"])
+                return record
+            record["user_id"] = users.user_ids[ref]
+            record["username"] = users.usernames[ref]
+            return record
+        except (ValueError, KeyError, TypeError, IndexError):
+            return None
+
+    @staticmethod
+    def _encode_user(ref: int, user_id: int, username: str) -> str:
+        """把一个用户表项编码为日志行"""
+        return checksum_line(
+            json.dumps(
+                {"u": ref, "user_id": user_id, "username": username},
+                ensure_ascii=False,
+            )
+        )
+
+    @classmethod
+    def _encode_users(cls, users: UserTable) -> List[str]:
+        """把整个用户表按编号顺序编码为日志行"""
+        return [
+            cls._encode_user(ref, users.user_ids[ref], users.usernames[ref])
+            for ref in range(len(users))
+        ]
+
+    @classmethod
+    def _encode_log(
+        cls,
+        users: UserTable,
+        user_id: int,
+        username: str,
+        message: str,
+        timestamp: str,
+    ) -> List[str]:
+        """把一条消息编码为日志行，用户首次出现或改名时先加一行用户表项"""
+        ref, changed = users.assign(user_id, username)
+        lines = []
+        if changed:
+            lines.append(cls._encode_user(ref, user_id, username))
+        lines.append(
+            checksum_line(
+                json.dumps(
+                    {"u": ref, "message": message, "timestamp": timestamp},
+                    ensure_ascii=False,
+                )
+            )
+        )
+        return lines
+
+    def get_load_stats(self) -> Dict[str, Any]:
+        """获取消息加载的统计信息"""
+        return {
+            **self.load_stats,
+            "lazy": self.lazy,
+            "chats_pending": len(self._manifest),
+        }
+
+    def _new_history(self, chat_id: Optional[int] = None) -> ChatHistory:
+        """创建一个按上限裁剪的聊天消息容器
+
+        指定 chat_id 且启用归档时，被挤出的消息进入该聊天的归档暂存列表。
+        """
+        spill = None
+        if self.archive is not None and chat_id is not None:
+            spill = self._archive_buffer.setdefault(chat_id, [])
+        return ChatHistory(self.MAX_MESSAGES_PER_CHAT, spill)
+
+    def _archive_min_ts(self) -> Optional[int]:
+        """归档按时间清理的阈值，历史清理功能禁用时返回 None"""
+        cleanup_config = config_manager.get("features.history_cleanup", {})
+        if not cleanup_config.get("enabled", True):
+            return None
+        return self._threshold(cleanup_config.get("retention_days", 30) * 24)
+
+    @staticmethod
+    def _threshold(hours: float) -> int:
+        """计算 hours 小时之前的 UTC 秒级时间戳"""
+        return to_epoch(datetime.now(timezone.utc) - timedelta(hours=hours))
+
+    def flush(self) -> int:
+        """立即写入待写队列中的所有数据，返回写入的记录数"""
+        return self._flusher.flush_now()
+
+    def start_flusher(self):
+        """在当前事件循环中启动后台延迟写入任务"""
+        self._flusher.start()
+
+    async def stop_flusher(self):
+        """停止后台延迟写入任务并写入剩余数据"""
+        await self._flusher.stop()
+
+    def get_flush_stats(self) -> Dict[str, Any]:
+        """获取延迟写入的刷新延迟、队列深度等指标"""
+        stats = self._flusher.get_stats()
+        with self._state_lock:
+            stats["dirty_chats"] = len(
+                self._pending_lines.keys() | self._compact_chats
+            ) + len(self._pending_dialogs)
+        return stats
+
+    def _queue_depth(self) -> int:
+        """待写队列中的记录数"""
+        with self._state_lock:
+            return (
+                sum(len(lines) for lines in self._pending_lines.values())
+                + len(self._compact_chats)
+                + sum(len(msgs) for msgs in self._pending_dialogs.values())
+            )
+
+    def _write_pending(self) -> int:
+        """将待写队列落盘，返回写入的记录数"""
+        with self._io_lock:
+            with self._state_lock:
+                lines, self._pending_lines = self._pending_lines, {}
+                compact, self._compact_chats = self._compact_chats, set()
+                dialogs, self._pending_dialogs = self._pending_dialogs, {}
+
+                # 对话历史仍在缓存中时直接写入缓存快照，无需再读文件合并
+                dialog_snapshots = {}
+                for chat_id in dialogs:
+                    cached = self._dialog_cache.peek(chat_id)
+                    if cached is not None:
+                        dialog_snapshots[chat_id] = list(cached)
+
+                # 需要整体重写的聊天直接以内存快照为准，丢弃其待追加行；
+                # 日志中被挤出热数据的消息先写入归档段，再重写日志
+                snapshots = {}
+                archive_batches = {}
+                for chat_id in compact:
+                    lines.pop(chat_id, None)
+                    buffer = self._archive_buffer.get(chat_id)
+                    if buffer:
+                        archive_batches[chat_id] = buffer[:]
+                        buffer.clear()
+                    history = self.messages.get(chat_id) or self._new_history()
+                    users = self._log_users[chat_id] = UserTable()
+                    snapshots[chat_id] = [
+                        line
+                        for record in history.records()
+                        for line in self._encode_log(
+                            users,
+                            record["user_id"],
+                            record["username"],
+                            record["message"],
+                            record["timestamp"],
+                        )
+                    ]
+
+            if not (lines or snapshots or dialogs):
+                return 0
+
+            # 在跨进程排他锁内落盘，只读进程不会看到写了一半的批次
+            with self._committing():
+                written = 0
+                for chat_id, chat_lines in lines.items():
+                    if self._append_lines(chat_id, chat_lines):
+                        written += len(chat_lines)
+                    else:
+                        with self._state_lock:
+                            self._pending_lines[chat_id] = (
+                                chat_lines + self._pending_lines.get(chat_id, [])
+                            )
+
+                for chat_id, records in snapshots.items():
+                    batch = archive_batches.get(chat_id)
+                    if batch and not self._archive_segment(chat_id, batch):
+                        # 归档失败时保留日志，消息仍可从日志恢复
+                        with self._state_lock:
+                            self._archive_buffer.setdefault(chat_id, [])[:0] = batch
+                            self._compact_chats.add(chat_id)
+                        continue
+                    if self._rewrite_log(chat_id, records):
+                        written += 1
+                    else:
+                        with self._state_lock:
+                            self._compact_chats.add(chat_id)
+
+                for chat_id, messages in dialogs.items():
+                    snapshot = dialog_snapshots.get(chat_id)
+                    if self._write_dialog(chat_id, messages, snapshot):
+                        written += len(messages)
+                    else:
+                        with self._state_lock:
+                            self._pending_dialogs[chat_id] = (
+                                messages + self._pending_dialogs.get(chat_id, [])
+                            )
+
+        # 刷新后更多聊天变为可卸载状态，顺带检查内存预算
+        self._enforce_memory_budget()
+        return written
+
+    def _archive_segment(self, chat_id: int, batch: List[ArchiveRecord]) -> bool:
+        """写入一个归档段，并按保留天数和字节预算清理该聊天的旧段"""
+        if not self.archive.write_segment(chat_id, batch):
+            return False
+        try:
+            self.archive.enforce_retention(
+                chat_id, self._archive_min_ts(), self.archive_max_bytes
+            )
         except Exception as e:
-            logger.error(f"加载消息时出错: {e}")
+            logger.error(f"清理归档时出错 - 聊天: {chat_id}, 错误: {e}")
+        return True
+
+    def get_archive_stats(self) -> Dict[str, Any]:
+        """获取冷数据归档的段数、消息数、字节数和待归档消息数"""
+        if self.archive is None:
+            return {"enabled": False}
+
+        stats = self.archive.get_stats(self.archive.chat_ids())
+        with self._state_lock:
+            stats["buffered"] = sum(len(buf) for buf in self._archive_buffer.values())
+        stats["enabled"] = True
+        return stats
+
+    def get_dialog_cache_stats(self) -> Dict[str, Any]:
+        """获取对话历史缓存的容量和命中率"""
+        return self._dialog_cache.get_stats()
+
+    def _sync_file(self, f):
+        """按 fsync 策略将文件内容刷到磁盘"""
+        if self.fsync == "flush":
+            f.flush()
+            os.fsync(f.fileno())
+
+    def get_chat_ids(self) -> List[int]:
+        """获取所有有消息记录的聊天 ID（包括尚未加载的聊天）"""
+        self._maybe_refresh()
+        with self._state_lock:
+            loaded = [
+                chat_id for chat_id, history in self.messages.items() if len(history)
+            ]
+            return loaded + list(self._manifest)
 
     def add_message(
         self,
@@ -69,71 +833,402 @@ class MessageStore:
     ):
         """添加消息"""
         try:
-            message_data = {
-                "user_id": user_id,
-                "username": username,
-                "message": message,
-                "timestamp": timestamp.isoformat(),
-            }
+            self._check_writable()
+            # 限制每个聊天最多保存1000条消息，超出部分由 ChatHistory 自动丢弃
+            history = self._get_history(chat_id)
+            with self._state_lock:
+                if history is None:
+                    history = self.messages[chat_id] = self._new_history(chat_id)
+                    self._touch(chat_id)
+                history.append(user_id, username, message, to_epoch(timestamp))
+
+            # 追加一行到待写队列，日志过长时改为整体压缩
+            with self._state_lock:
+                self._pending_lines.setdefault(chat_id, []).extend(
+                    self._encode_log(
+                        self._log_users.setdefault(chat_id, UserTable()),
+                        user_id,
+                        username,
+                        message,
+                        timestamp.isoformat(),
+                    )
+                )
+                self._log_lines[chat_id] += 1
+                if self._log_lines[chat_id] > (
+                    self.MAX_MESSAGES_PER_CHAT + self.COMPACT_THRESHOLD
+                ):
+                    self._request_compaction(chat_id)
+            self._flusher.notify()
 
-            self.messages[chat_id].append(message_data)
+            logger.debug(f"添加消息 - 聊天: {chat_id}, 用户: {user_id}")
 
-            # 限制每个聊天最多保存1000条消息
-            if len(self.messages[chat_id]) > 1000:
-                self.messages[chat_id] = self.messages[chat_id][-1000:]
+        except Exception as e:
+            logger.error(f"添加消息时出错: {e}")
 
-            # 异步保存到文件
-            self._save_messages(chat_id)
+    def import_messages(self, chat_id: int, records: List[ArchiveRecord]):
+        """批量导入一个聊天的消息，用于从快照恢复
 
-            logger.debug(f"添加消息 - 聊天: {chat_id}, 用户: {user_id}")
+        records 为按时间排序的 (时间戳, 用户ID, 用户名, 消息内容)，需晚于该聊天已有的消息。
+        消息直接追加到内存并整体重写日志，超出热数据的部分随刷新写入归档。
+        """
+        self._check_writable()
+        history = self._get_history(chat_id)
+        with self._state_lock:
+            if history is None:
+                history = self.messages[chat_id] = self._new_history(chat_id)
+                self._touch(chat_id)
+            for ts, user_id, username, message in records:
+                history.append(user_id, username, message, ts)
+            self._request_compaction(chat_id)
+            if self._index is not None:
+                self._index.drop(chat_id)
+        self._flusher.notify()
+
+    def _request_compaction(self, chat_id: int):
+        """标记聊天需要用内存中的消息重写日志，其待追加行随之作废"""
+        with self._state_lock:
+            self._compact_chats.add(chat_id)
+            self._pending_lines.pop(chat_id, None)
+            self._log_lines[chat_id] = len(self.messages.get(chat_id) or ())
+
+    def _append_lines(self, chat_id: int, lines: List[str]) -> bool:
+        """将多行消息一次性追加到聊天的 JSONL 日志
+
+        日志文件不存在或为空时（新聊天，或旧文件已被清理），之前写入的用户表项
+        不在文件中，先写入完整的用户表，待追加行引用的编号才能在重新加载时解析。
+        调用方需持有 _io_lock。
+        """
+        try:
+            with open(self._get_log_file(chat_id), "a", encoding="utf-8") as f:
+                if f.tell() == 0:
+                    lines = self._user_table_header(chat_id, lines) + lines
+                f.write("\n".join(lines) + "\n")
+                self._sync_file(f)
+            return True
 
         except Exception as e:
-            logger.error(f"添加消息时出错: {e}")
+            logger.error(f"追加消息时出错 - 聊天: {chat_id}, 错误: {e}")
+            return False
 
-    def _save_messages(self, chat_id: int):
-        """保存指定聊天的消息到文件"""
+    def _user_table_header(self, chat_id: int, lines: List[str]) -> List[str]:
+        """新日志文件开头需要补写的用户表项
+
+        待追加行已包含用户表的全部表项时（如新聊天）返回空列表，否则返回完整的用户表。
+        """
+        with self._state_lock:
+            users = self._log_users.get(chat_id)
+            if not users:
+                return []
+            header = self._encode_users(users)
+
+        defined = set()
+        for line in lines:
+            if '"user_id"' in line:
+                payload = verify_line(line)
+                if payload is not None:
+                    defined.add(json.loads(payload)["u"])
+        return [] if len(defined) >= len(header) else header
+
+    def _rewrite_log(self, chat_id: int, lines: List[str]) -> bool:
+        """压缩指定聊天的日志：重写 JSONL 并移除旧版快照"""
         try:
-            file_path = self._get_storage_file(chat_id)
+            atomic_write_text(
+                self._get_log_file(chat_id),
+                "\n".join(lines) + "\n" if lines else "",
+                fsync=self.fsync == "flush",
+            )
+
+            snapshot_file = self._get_storage_file(chat_id)
+            if os.path.exists(snapshot_file):
+                os.remove(snapshot_file)
 
-            with open(file_path, "w", encoding="utf-8") as f:
-                json.dump(self.messages[chat_id], f, ensure_ascii=False, indent=2)
+            logger.debug(f"压缩消息日志 - 聊天: {chat_id}, 保留 {len(lines)} 条")
+            return True
 
         except Exception as e:
             logger.error(f"保存消息时出错 - 聊天: {chat_id}, 错误: {e}")
+            return False
+
+    def compact_all(self):
+        """压缩所有存在冗余日志行的聊天并立即写盘"""
+        self._check_writable()
+        with self._state_lock:
+            for chat_id, history in list(self.messages.items()):
+                if self._log_lines[chat_id] != len(history):
+                    self._request_compaction(chat_id)
+        self.flush()
+
+    def get_active_chat_ids(self, since: datetime, min_messages: int = 1) -> List[int]:
+        """根据增量统计筛选 since 之后消息数可能达到 min_messages 的聊天
+
+        统计按小时粒度计算，结果可能多出少量聊天，但不会遗漏；
+        调用方需要精确数量时再使用 count_messages_between 确认。
+        """
+        threshold = to_epoch(since)
+        self._maybe_refresh()
+
+        # 在锁内取快照，其他线程同时写入或加载聊天时不会改变正在遍历的字典；
+        # 未加载的聊天只有在文件修改时间晚于窗口起点时才可能有新消息
+        with self._state_lock:
+            histories = list(self.messages.items())
+            unloaded = [
+                chat_id
+                for chat_id, item in self._manifest.items()
+                if item["mtime"] * US_PER_SECOND >= threshold
+            ]
+        histories += [(chat_id, self._get_history(chat_id)) for chat_id in unloaded]
+
+        with self._state_lock:
+            return [
+                chat_id
+                for chat_id, history in histories
+                if history is not None
+                and history.stats.count_since_upper_bound(threshold) >= min_messages
+            ]
+
+    def get_messages_between(
+        self, chat_id: int, start: datetime, end: Optional[datetime] = None
+    ) -> List[str]:
+        """获取时间位于 [start, end) 内的消息，end 为空表示直到当前
+
+        Returns:
+            List[str]: 按时间顺序排列的“用户名: 消息内容”列表
+        """
+        try:
+            history = self._get_history(chat_id)
+            lo, hi = to_epoch(start), None if end is None else to_epoch(end)
+
+            messages = [
+                f"{username}: {message}"
+                for _, _, username, message in self._cold_records(
+                    chat_id, history, lo, hi
+                )
+            ]
+            if history is not None:
+                messages.extend(
+                    history.format_line(i) for i in history.range_indices(lo, hi)
+                )
+            return messages
+
+        except Exception as e:
+            logger.error(f"获取时间窗口消息时出错 - 聊天: {chat_id}, 错误: {e}")
+            return []
+
+    def count_messages_between(
+        self, chat_id: int, start: datetime, end: Optional[datetime] = None
+    ) -> int:
+        """统计时间位于 [start, end) 内的消息数量，end 为空表示直到当前"""
+        try:
+            history = self._get_history(chat_id)
+            lo, hi = to_epoch(start), None if end is None else to_epoch(end)
+
+            count = self._cold_count(chat_id, history, lo, hi)
+            if history is not None:
+                count += len(history.range_indices(lo, hi))
+            return count
+
+        except Exception as e:
+            logger.error(f"统计时间窗口消息时出错 - 聊天: {chat_id}, 错误: {e}")
+            return 0
+
+    def iter_messages_between(
+        self,
+        chat_id: int,
+        start: datetime,
+        end: Optional[datetime] = None,
+        newest_first: bool = False,
+        max_bytes: int = 0,
+        max_tokens: int = 0,
+    ) -> Iterator[str]:
+        """逐条产出时间位于 [start, end) 内的“用户名: 消息内容”
+
+        消息按块从内存和归档中读取，不会一次性构造整个窗口的列表；
+        newest_first 为 True 时从最新的消息开始产出。
+        设置 max_bytes 或 max_tokens 时，累计超出预算前停止，不再读取更早（或更晚）的消息。
+        """
+        lo, hi = to_epoch(start), None if end is None else to_epoch(end)
+        lines = (
+            f"{username}: {message}"
+            for _, _, username, message in self._iter_records_between(
+                chat_id, lo, hi, newest_first
+            )
+        )
+        return limit_by_budget(lines, max_bytes, max_tokens)
+
+    def iter_chat_records(self, chat_id: int) -> Iterator[ArchiveRecord]:
+        """按时间顺序逐条产出聊天的全部消息（含归档），用于导出快照"""
+        return self._iter_records_between(chat_id, 0, None, False)
+
+    def _iter_records_between(
+        self, chat_id: int, start: int, end: Optional[int], newest_first: bool
+    ) -> Iterator[ArchiveRecord]:
+        """按时间顺序（或倒序）依次产出冷数据和热数据"""
+        try:
+            history = self._get_history(chat_id)
+            cold = self._iter_cold_records(chat_id, history, start, end, newest_first)
+            hot = self._iter_hot_records(history, start, end, newest_first)
+            if newest_first:
+                yield from hot
+                yield from cold
+            else:
+                yield from cold
+                yield from hot
+
+        except Exception as e:
+            logger.error(f"遍历时间窗口消息时出错 - 聊天: {chat_id}, 错误: {e}")
+
+    def _iter_hot_records(
+        self,
+        history: Optional[ChatHistory],
+        start: int,
+        end: Optional[int],
+        newest_first: bool,
+    ) -> Iterator[ArchiveRecord]:
+        """分块读取内存中 [start, end) 内的消息
+
+        每块在锁内复制，块之间用（时间戳，该时间戳下已产出的条数）作为游标，
+        迭代期间写入新消息或丢弃最旧的消息不会导致下标错位。
+        冷数据在迭代开始时确定，迭代期间才被挤出热数据的消息不会再被产出。
+        """
+        if history is None:
+            return
+
+        cursor_ts: Optional[int] = None
+        skip = 0
+        while True:
+            with self._state_lock:
+                lo = history.index_at(start)
+                if newest_first:
+                    if cursor_ts is None:
+                        hi = history.range_indices(start, end).stop
+                    else:
+                        hi = history.index_after(cursor_ts) - skip
+                    indices = range(hi - 1, max(lo, hi - self.ITER_CHUNK_SIZE) - 1, -1)
+                else:
+                    if cursor_ts is not None:
+                        lo = history.index_at(cursor_ts) + skip
+                    hi = min(
+                        history.range_indices(start, end).stop,
+                        lo + self.ITER_CHUNK_SIZE,
+                    )
+                    indices = range(lo, hi)
+                chunk = [
+                    (
+                        history.timestamps[i],
+                        history.user_id(i),
+                        history.username(i),
+                        history.texts[i],
+                    )
+                    for i in indices
+                ]
+
+            if not chunk:
+                return
+            yield from chunk
+
+            last_ts = chunk[-1][0]
+            same = sum(1 for record in chunk if record[0] == last_ts)
+            skip = skip + same if last_ts == cursor_ts else same
+            cursor_ts = last_ts
+
+    def _iter_cold_records(
+        self,
+        chat_id: int,
+        history: Optional[ChatHistory],
+        start: int,
+        end: Optional[int],
+        newest_first: bool,
+    ) -> Iterator[ArchiveRecord]:
+        """逐段读取 [start, end) 内的冷数据，归档段在迭代中按需解压"""
+        if not self._reaches_cold(history, start):
+            return iter(())
+
+        # 同时确定归档段列表和暂存消息，避免刷新时消息从暂存列表移入归档而被漏读或重复读取
+        with self._reading():
+            segments = self.archive.iter_range(chat_id, start, end, newest_first)
+            with self._state_lock:
+                buffered = sorted(
+                    (
+                        record
+                        for record in self._archive_buffer.get(chat_id, ())
+                        if record[0] >= start and (end is None or record[0] < end)
+                    ),
+                    key=lambda record: record[0],
+                )
+        if newest_first:
+            return chain(reversed(buffered), segments)
+        return chain(segments, buffered)
+
+    def _reaches_cold(self, history: Optional[ChatHistory], start: int) -> bool:
+        """时间窗口是否可能包含热数据之前的冷数据"""
+        if self.archive is None:
+            return False
+        oldest = history.oldest_ts() if history is not None else None
+        return oldest is None or start <= oldest
+
+    def _cold_records(
+        self,
+        chat_id: int,
+        history: Optional[ChatHistory],
+        start: int,
+        end: Optional[int],
+    ) -> List[ArchiveRecord]:
+        """读取 [start, end) 内的冷数据：归档段和尚未归档的被挤出消息"""
+        if not self._reaches_cold(history, start):
+            return []
+
+        # 持有 _io_lock，避免刷新时消息从暂存列表移入归档而被漏读或重复读取
+        with self._reading():
+            records = self.archive.read_range(chat_id, start, end)
+            with self._state_lock:
+                records.extend(
+                    record
+                    for record in self._archive_buffer.get(chat_id, ())
+                    if record[0] >= start and (end is None or record[0] < end)
+                )
+        records.sort(key=lambda record: record[0])
+        return records
+
+    def _cold_count(
+        self,
+        chat_id: int,
+        history: Optional[ChatHistory],
+        start: int,
+        end: Optional[int],
+    ) -> int:
+        """统计 [start, end) 内的冷数据数量"""
+        if not self._reaches_cold(history, start):
+            return 0
+
+        with self._reading():
+            count = self.archive.count_range(chat_id, start, end)
+            with self._state_lock:
+                count += sum(
+                    1
+                    for record in self._archive_buffer.get(chat_id, ())
+                    if record[0] >= start and (end is None or record[0] < end)
+                )
+        return count
 
     def get_recent_messages(
         self, chat_id: int, hours: int = 24, min_messages: int = 10
     ) -> List[str]:
         """获取最近的消息"""
         try:
-            if chat_id not in self.messages:
+            history = self._get_history(chat_id)
+            if history is None:
                 return []
 
-            # 计算时间阈值
-            time_threshold = datetime.now(timezone.utc) - timedelta(hours=hours)
-
-            # 过滤最近的消息
-            recent_messages = []
-            for msg in self.messages[chat_id]:
-                try:
-                    msg_time = datetime.fromisoformat(msg["timestamp"])
-                    if msg_time >= time_threshold:
-                        # 格式化消息：用户名: 消息内容
-                        formatted_msg = f"{msg['username']}: {msg['message']}"
-                        recent_messages.append(formatted_msg)
-                except (ValueError, KeyError):
-                    continue
+            # 过滤最近的消息，格式化为“用户名: 消息内容”
+            recent_messages = self.get_messages_between(
+                chat_id, datetime.now(timezone.utc) - timedelta(hours=hours)
+            )
 
             # 如果消息数量不足最小要求，返回最近的消息
             if len(recent_messages) < min_messages:
-                all_messages = []
-                for msg in self.messages[chat_id][-min_messages:]:
-                    try:
-                        formatted_msg = f"{msg['username']}: {msg['message']}"
-                        all_messages.append(formatted_msg)
-                    except KeyError:
-                        continue
-                return all_messages
+                return [
+                    history.format_line(i) for i in history.tail_indices(min_messages)
+                ]
 
             return recent_messages
 
@@ -143,47 +1238,41 @@ class MessageStore:
 
     def get_message_count(self, chat_id: int, hours: int = 24) -> int:
         """获取指定时间内的消息数量"""
-        try:
-            if chat_id not in self.messages:
-                return 0
-
-            time_threshold = datetime.now(timezone.utc) - timedelta(hours=hours)
-            count = 0
-
-            for msg in self.messages[chat_id]:
-                try:
-                    msg_time = datetime.fromisoformat(msg["timestamp"])
-                    if msg_time >= time_threshold:
-                        count += 1
-                except (ValueError, KeyError):
-                    continue
-
-            return count
-
-        except Exception as e:
-            logger.error(f"获取消息数量时出错 - 聊天: {chat_id}, 错误: {e}")
-            return 0
+        return self.count_messages_between(
+            chat_id, datetime.now(timezone.utc) - timedelta(hours=hours)
+        )
 
     def clear_old_messages(self, days: int = 30):
         """清理旧消息"""
         try:
-            time_threshold = datetime.now(timezone.utc) - timedelta(days=days)
+            self._check_writable()
+            threshold = self._threshold(days * 24)
 
-            for chat_id in list(self.messages.keys()):
-                original_count = len(self.messages[chat_id])
+            with self._state_lock:
+                chat_ids = list(self.messages) + list(self._manifest)
 
+            for chat_id in chat_ids:
+                history = self._get_history(chat_id)
+                if history is None:
+                    continue
                 # 过滤掉旧消息
-                self.messages[chat_id] = [
-                    msg
-                    for msg in self.messages[chat_id]
-                    if datetime.fromisoformat(msg["timestamp"]).astimezone(timezone.utc)
-                    >= time_threshold
-                ]
-
-                cleaned_count = original_count - len(self.messages[chat_id])
+                with self._state_lock:
+                    cleaned_count = history.retain_since(threshold)
+                    buffer = self._archive_buffer.get(chat_id)
+                    if buffer:
+                        kept = [record for record in buffer if record[0] >= threshold]
+                        cleaned_count += len(buffer) - len(kept)
+                        buffer[:] = kept
+                    if cleaned_count > 0:
+                        self._request_compaction(chat_id)
                 if cleaned_count > 0:
                     logger.info(f"清理聊天 {chat_id} 的 {cleaned_count} 条旧消息")
-                    self._save_messages(chat_id)
+                    self._flusher.notify()
+
+            if self.archive is not None:
+                with self._committing():
+                    for chat_id in self.archive.chat_ids():
+                        self.archive.enforce_retention(chat_id, threshold)
 
         except Exception as e:
             logger.error(f"清理旧消息时出错: {e}")
@@ -191,28 +1280,28 @@ class MessageStore:
     def get_chat_stats(self, chat_id: int) -> Dict[str, Any]:
         """获取聊天统计信息"""
         try:
-            if chat_id not in self.messages:
+            history = self._get_history(chat_id)
+            if history is None:
                 return {"total_messages": 0, "recent_24h": 0, "active_users": 0}
 
-            total_messages = len(self.messages[chat_id])
-            recent_24h = self.get_message_count(chat_id, 24)
+            # 最近24小时的消息数按时间戳二分精确统计，窗口早于热数据时加上冷数据；
+            # 活跃用户直接读取增量统计
+            threshold = self._threshold(24)
+            total_messages = len(history)
+            if self.archive is not None:
+                with self._state_lock:
+                    total_messages += len(self._archive_buffer.get(chat_id, ()))
+                total_messages += self.archive.total_count(chat_id)
 
-            # 统计活跃用户（最近24小时）
-            time_threshold = datetime.now(timezone.utc) - timedelta(hours=24)
-            active_users = set()
-
-            for msg in self.messages[chat_id]:
-                try:
-                    msg_time = datetime.fromisoformat(msg["timestamp"])
-                    if msg_time >= time_threshold:
-                        active_users.add(msg["user_id"])
-                except (ValueError, KeyError):
-                    continue
+            recent_24h = self._cold_count(chat_id, history, threshold, None)
+            with self._state_lock:
+                recent_24h += history.count_since(threshold)
+                active_users = history.stats.active_users_since(threshold)
 
             return {
                 "total_messages": total_messages,
                 "recent_24h": recent_24h,
-                "active_users": len(active_users),
+                "active_users": active_users,
             }
 
         except Exception as e:
@@ -227,6 +1316,7 @@ class MessageStore:
             message: OpenAI格式的消息字典，例如 {'role': 'user', 'content': '你好'}
         """
         try:
+            self._check_writable()
             # 验证消息格式
             if (
                 not isinstance(message, dict)
@@ -242,35 +1332,115 @@ class MessageStore:
                 "timestamp": datetime.now(timezone.utc).isoformat(),
             }
 
-            dialog_file = self._get_dialog_history_file(chat_id)
+            # 更新缓存并放入待写队列，由刷新器写入文件
+            with self._state_lock:
+                self._pending_dialogs.setdefault(chat_id, []).append(
+                    message_with_timestamp
+                )
+                cached = self._dialog_cache.peek(chat_id)
+                if cached is not None:
+                    cached.append(message_with_timestamp)
+                    del cached[: -self.MAX_DIALOG_MESSAGES]
+            self._flusher.notify()
 
-            # 读取现有的对话历史
-            dialog_history = []
-            if os.path.exists(dialog_file):
-                try:
-                    with open(dialog_file, "r", encoding="utf-8") as f:
-                        dialog_history = json.load(f)
-                except json.JSONDecodeError as e:
-                    logger.warning(
-                        f"对话历史文件损坏，将重新创建: {dialog_file}, 错误: {e}"
-                    )
-                    dialog_history = []
+            logger.debug(f"添加对话消息 - 聊天: {chat_id}, 角色: {message.get('role')}")
+
+        except Exception as e:
+            logger.error(f"添加对话消息时出错 - 聊天: {chat_id}, 错误: {e}")
 
-            # 添加新消息
-            dialog_history.append(message_with_timestamp)
+    def _read_dialog_file(self, chat_id: int) -> list:
+        """读取对话历史文件，文件不存在或损坏时返回空列表"""
+        dialog_file = self._get_dialog_history_file(chat_id)
+        if not os.path.exists(dialog_file):
+            return []
 
-            # 限制对话历史最多保存100条消息
-            if len(dialog_history) > 100:
-                dialog_history = dialog_history[-100:]
+        with open(dialog_file, "r", encoding="utf-8") as f:
+            text = f.read()
+        try:
+            dialog_history = json.loads(text)
+        except json.JSONDecodeError as e:
+            # 旧版本直接覆盖写入时可能被截断，尽量取回完整的消息
+            dialog_history = salvage_json_array(text)
+            self.load_stats["salvaged_records"] += len(dialog_history)
+            logger.warning(
+                f"对话历史文件损坏，取回 {len(dialog_history)} 条消息: {dialog_file}, 错误: {e}"
+            )
 
-            # 保存到文件
-            with open(dialog_file, "w", encoding="utf-8") as f:
-                json.dump(dialog_history, f, ensure_ascii=False, indent=2)
+        return dialog_history if isinstance(dialog_history, list) else []
 
-            logger.debug(f"添加对话消息 - 聊天: {chat_id}, 角色: {message.get('role')}")
+    def _write_dialog(
+        self,
+        chat_id: int,
+        messages: List[dict],
+        snapshot: Optional[List[dict]] = None,
+    ) -> bool:
+        """将一批对话消息写入对话历史文件
+
+        提供 snapshot（缓存中的完整历史）时直接覆盖写入，否则与文件内容合并。
+        """
+        try:
+            if snapshot is not None:
+                dialog_history = snapshot
+            else:
+                dialog_history = self._read_dialog_file(chat_id) + messages
+
+            # 限制对话历史最多保存100条消息
+            dialog_history = dialog_history[-self.MAX_DIALOG_MESSAGES :]
+
+            # 通过临时文件原子替换，写入中断不会截断原有历史
+            atomic_write_text(
+                self._get_dialog_history_file(chat_id),
+                json.dumps(dialog_history, ensure_ascii=False, indent=2),
+                fsync=self.fsync == "flush",
+            )
+            return True
 
         except Exception as e:
-            logger.error(f"添加对话消息时出错 - 聊天: {chat_id}, 错误: {e}")
+            logger.error(f"写入对话历史时出错 - 聊天: {chat_id}, 错误: {e}")
+            return False
+
+    def get_dialog_chat_ids(self) -> List[int]:
+        """获取所有有对话历史的聊天 ID"""
+        self._maybe_refresh()
+        chat_ids = set()
+        for filename in os.listdir(self.storage_dir):
+            if filename.startswith("dialog_history_") and filename.endswith(".json"):
+                try:
+                    chat_ids.add(int(filename[len("dialog_history_") : -len(".json")]))
+                except ValueError:
+                    continue
+        with self._state_lock:
+            chat_ids.update(self._pending_dialogs)
+        return sorted(chat_ids)
+
+    def _load_dialog(self, chat_id: int) -> list:
+        """获取缓存中的完整对话历史，未命中时读取文件并合并尚未写盘的消息"""
+        self._maybe_refresh()
+        dialog_history = self._dialog_cache.get(chat_id)
+        if dialog_history is None:
+            with self._reading():
+                dialog_history = self._read_dialog_file(chat_id)
+                with self._state_lock:
+                    dialog_history += self._pending_dialogs.get(chat_id, [])
+                    del dialog_history[: -self.MAX_DIALOG_MESSAGES]
+                    self._dialog_cache.put(chat_id, dialog_history)
+        return dialog_history
+
+    def export_dialog(self, chat_id: int) -> List[dict]:
+        """获取完整的对话历史（包含时间戳），用于导出快照"""
+        dialog_history = self._load_dialog(chat_id)
+        with self._state_lock:
+            return [dict(msg) for msg in dialog_history]
+
+    def import_dialog(self, chat_id: int, messages: List[dict]):
+        """用快照中的对话历史替换聊天现有的对话历史"""
+        self._check_writable()
+        messages = [dict(msg) for msg in messages[-self.MAX_DIALOG_MESSAGES :]]
+        with self._committing():
+            with self._state_lock:
+                self._pending_dialogs.pop(chat_id, None)
+                self._dialog_cache.put(chat_id, messages)
+            self._write_dialog(chat_id, [], snapshot=messages)
 
     def get_dialog_history(self, chat_id: int, limit: int = 10) -> list:
         """获取对话历史记录
@@ -283,15 +1453,10 @@ class MessageStore:
             list: OpenAI格式的消息列表，如果文件不存在或为空则返回空列表
         """
         try:
-            dialog_file = self._get_dialog_history_file(chat_id)
-
-            # 如果文件不存在，返回空列表
-            if not os.path.exists(dialog_file):
-                return []
-
-            # 读取对话历史
-            with open(dialog_file, "r", encoding="utf-8") as f:
-                dialog_history = json.load(f)
+            # 优先读取缓存；未命中时读取文件并合并尚未写盘的消息
+            dialog_history = self._load_dialog(chat_id)
+            with self._state_lock:
+                dialog_history = list(dialog_history)
 
             # 如果历史记录为空，返回空列表
             if not dialog_history:
@@ -313,9 +1478,6 @@ class MessageStore:
             )
             return cleaned_history
 
-        except json.JSONDecodeError as e:
-            logger.error(f"解析对话历史文件时出错 - 聊天: {chat_id}, 错误: {e}")
-            return []
         except Exception as e:
             logger.error(f"获取对话历史时出错 - 聊天: {chat_id}, 错误: {e}")
             return []
@@ -327,14 +1489,22 @@ class MessageStore:
             chat_id: 聊天ID
         """
         try:
+            self._check_writable()
             dialog_file = self._get_dialog_history_file(chat_id)
 
-            # 检查文件是否存在
-            if os.path.exists(dialog_file):
-                os.remove(dialog_file)
-                logger.info(f"已清除聊天 {chat_id} 的对话历史记录")
-            else:
-                logger.info(f"聊天 {chat_id} 的对话历史文件不存在，无需清除")
+            with self._committing():
+                with self._state_lock:
+                    pending = self._pending_dialogs.pop(chat_id, None)
+                    self._dialog_cache.pop(chat_id)
+
+                # 检查文件是否存在
+                if os.path.exists(dialog_file):
+                    os.remove(dialog_file)
+                    logger.info(f"已清除聊天 {chat_id} 的对话历史记录")
+                elif pending:
+                    logger.info(f"已清除聊天 {chat_id} 尚未写盘的对话历史记录")
+                else:
+                    logger.info(f"聊天 {chat_id} 的对话历史文件不存在，无需清除")
 
         except Exception as e:
             logger.error(f"清除对话历史时出错 - 聊天: {chat_id}, 错误: {e}")
@@ -347,13 +1517,12 @@ class MessageStore:
             retention_days: 保留天数，默认30天
         """
         try:
-            from config.settings import config_manager
-
             # 获取配置
             cleanup_config = config_manager.get("features.history_cleanup", {})
             if not cleanup_config.get("enabled", True):
                 logger.info("历史文件清理功能已禁用")
                 return
+            self._check_writable()
 
             # 使用配置中的保留天数
             retention_days = cleanup_config.get("retention_days", retention_days)
@@ -362,6 +1531,9 @@ class MessageStore:
                 logger.warning(f"数据目录不存在: {self.data_dir}")
                 return
 
+            # 先写入待写数据，避免按修改时间误删刚有更新的文件
+            self.flush()
+
             # 计算过期时间阈值
             cutoff_time = datetime.now(timezone.utc) - timedelta(days=retention_days)
             deleted_files = []
@@ -370,34 +1542,43 @@ class MessageStore:
             logger.info(f"开始清理 {retention_days} 天前的历史文件...")
 
             # 扫描目录中的文件
-            for filename in os.listdir(self.data_dir):
-                file_path = os.path.join(self.data_dir, filename)
-
-                # 检查是否为目标文件格式
-                if (
-                    filename.startswith("dialog_history_")
-                    and filename.endswith(".json")
-                ) or (
-                    filename.startswith("chat_") and filename.endswith("_messages.json")
-                ):
-
-                    try:
-                        # 获取文件的最后修改时间
-                        file_mtime = datetime.fromtimestamp(
-                            os.path.getmtime(file_path), timezone.utc
+            with self._committing():
+                for filename in os.listdir(self.data_dir):
+                    file_path = os.path.join(self.data_dir, filename)
+
+                    # 检查是否为目标文件格式
+                    if (
+                        filename.startswith("dialog_history_")
+                        and filename.endswith(".json")
+                    ) or (
+                        filename.startswith("chat_")
+                        and (
+                            filename.endswith("_messages.json")
+                            or filename.endswith("_messages.jsonl")
                         )
+                    ):
 
-                        # 如果文件比保留期限更早，则删除
-                        if file_mtime < cutoff_time:
-                            os.remove(file_path)
-                            deleted_files.append(filename)
-                            logger.info(
-                                f"已删除过期文件: {filename} (修改时间: {file_mtime.strftime('%Y-%m-%d %H:%M:%S')})"
+                        try:
+                            # 获取文件的最后修改时间
+                            file_mtime = datetime.fromtimestamp(
+                                os.path.getmtime(file_path), timezone.utc
                             )
 
-                    except Exception as e:
-                        error_files.append((filename, str(e)))
-                        logger.error(f"删除文件 {filename} 时出错: {e}")
+                            # 如果文件比保留期限更早，则删除
+                            if file_mtime < cutoff_time:
+                                os.remove(file_path)
+                                deleted_files.append(filename)
+                                if filename.startswith("chat_"):
+                                    self._forget_chat_file(
+                                        int(filename.split("_")[1])
+                                    )
+                                logger.info(
+                                    f"已删除过期文件: {filename} (修改时间: {file_mtime.strftime('%Y-%m-%d %H:%M:%S')})"
+                                )
+
+                        except Exception as e:
+                            error_files.append((filename, str(e)))
+                            logger.error(f"删除文件 {filename} 时出错: {e}")
 
             # 记录清理结果
             if deleted_files:
@@ -408,9 +1589,103 @@ class MessageStore:
             if error_files:
                 logger.warning(f"清理过程中有 {len(error_files)} 个文件处理失败")
 
+            # 按保留天数和字节预算清理冷数据归档
+            if self.archive is not None:
+                cutoff_ts = to_epoch(cutoff_time)
+                with self._committing():
+                    removed_segments = sum(
+                        self.archive.enforce_retention(
+                            chat_id, cutoff_ts, self.archive_max_bytes
+                        )
+                        for chat_id in self.archive.chat_ids()
+                    )
+                if removed_segments:
+                    logger.info(f"归档清理完成，共删除 {removed_segments} 个归档段")
+
         except Exception as e:
             logger.error(f"清理过期文件时出错: {e}")
 
 
-# 全局消息存储实例
-message_store = MessageStore()
+def create_message_store(read_only: Optional[bool] = None):
+    """根据配置创建消息存储实例
+
+    storage.backend 为 sqlite 时使用 SQLiteMessageStore，为 redis 时使用
+    RedisMessageStore（Redis 不可用时回退到文件存储），否则使用文件存储。
+    read_only 为空时使用 storage.read_only 配置，只对文件存储生效。
+
+    Raises:
+        StoreLockedError: 以写入模式打开文件存储，但数据目录正被另一个进程写入
+    """
+    storage_config = config_manager.get_storage_config()
+    backend = storage_config.get("backend", "file")
+
+    if backend == "sqlite":
+        from bot.services.sqlite_message_store import SQLiteMessageStore
+
+        return SQLiteMessageStore(
+            db_path=storage_config.get("sqlite_path", "data/messages.db"),
+            batch_size=storage_config.get("sqlite_batch_size", 50),
+            flush_interval=storage_config.get("flush_interval", 1.0),
+            fsync=storage_config.get("fsync", "never"),
+            dialog_cache_size=storage_config.get("dialog_cache_size", 256),
+            dialog_cache_ttl=storage_config.get("dialog_cache_ttl", 0),
+        )
+
+    if backend == "redis":
+        if config_manager.redis_client is not None:
+            from bot.services.redis_message_store import RedisMessageStore
+
+            return RedisMessageStore(
+                config_manager.redis_client,
+                key_prefix=storage_config.get("redis_key_prefix", "snaily:"),
+                batch_size=storage_config.get("redis_batch_size", 50),
+                flush_interval=storage_config.get("flush_interval", 1.0),
+            )
+        logger.warning("Redis 不可用，消息存储将使用文件存储")
+    elif backend != "file":
+        logger.warning(f"未知的消息存储后端 {backend}，将使用文件存储")
+
+    options = dict(
+        lazy=storage_config.get("lazy_load", True),
+        flush_interval=storage_config.get("flush_interval", 1.0),
+        refresh_interval=storage_config.get("flush_interval", 1.0),
+        flush_max_pending=storage_config.get("flush_max_pending", 200),
+        fsync=storage_config.get("fsync", "never"),
+        dialog_cache_size=storage_config.get("dialog_cache_size", 256),
+        dialog_cache_ttl=storage_config.get("dialog_cache_ttl", 0),
+        archive=storage_config.get("archive_enabled", True),
+        archive_max_bytes=storage_config.get("archive_max_bytes", 20 * 1024 * 1024),
+        memory_budget=storage_config.get("memory_budget_mb", 256) * 1024 * 1024,
+        evict_idle_seconds=storage_config.get("evict_idle_seconds", 300),
+    )
+    if read_only is None:
+        read_only = storage_config.get("read_only", False)
+    try:
+        return MessageStore(read_only=read_only, **options)
+    except StoreLockedError as e:
+        # 不自动退化为只读：写入进程以只读模式运行时，收到的每条消息都会被丢弃
+        logger.error(f"{e}；辅助进程请设置 MESSAGE_STORE_READ_ONLY=true")
+        raise
+
+
+_message_store = None
+
+
+def get_message_store():
+    """获取全局消息存储实例，首次调用时按配置创建
+
+    Raises:
+        StoreLockedError: 数据目录正被另一个进程写入，且未配置只读模式
+    """
+    global _message_store
+    if _message_store is None:
+        _message_store = create_message_store()
+    return _message_store
+
+
+def __getattr__(name: str):
+    # 全局实例 message_store 在首次使用时才创建，只导入 MessageStore 等类的脚本
+    # （如基准测试）不会打开数据目录、占用写入锁
+    if name == "message_store":
+        return get_message_store()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
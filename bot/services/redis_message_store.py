@@ -0,0 +1,559 @@
+"""
+Redis 消息存储模块
+与 MessageStore 提供相同的公共方法，数据保存在 Redis 中，可供多个机器人实例共享
+"""
+
+import json
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from loguru import logger
+
+from bot.services.chat_history import US_PER_SECOND
+from bot.services.write_behind import WriteBehindFlusher
+from bot.utils.lru_cache import LRUCache
+from bot.utils.text_budget import limit_by_budget
+from config.settings import config_manager
+
+
+class RedisMessageStore:
+    """基于 Redis 的消息存储器
+
+    每个聊天的群消息保存在一个有序集合中，分数为 UTC 时间戳，
+    时间窗口查询和过期清理均为按分数的范围操作；有消息的聊天 ID 记录在一个集合中。
+    对话历史保存在定长列表中，并设置与历史清理保留天数一致的过期时间。
+
+    群聊消息先进入内存缓冲，达到批量大小、后台刷新间隔到期或发生读取时
+    通过 pipeline 一次性写入。多个实例共享数据，因此不在本地缓存对话历史。
+    """
+
+    # 每个聊天最多保留的消息数，与文件存储保持一致
+    MAX_MESSAGES_PER_CHAT = 1000
+    # 每个聊天最多保留的对话历史条数
+    MAX_DIALOG_MESSAGES = 100
+    # 流式遍历消息时每页读取的条数
+    ITER_PAGE_SIZE = 256
+
+    def __init__(
+        self,
+        client,
+        key_prefix: str = "snaily:",
+        batch_size: int = 50,
+        flush_interval: float = 1.0,
+    ):
+        self.client = client
+        self.key_prefix = key_prefix
+        self.batch_size = max(1, batch_size)
+        self._pending: List[Tuple[int, str, float]] = []  # (chat_id, 成员, 时间戳)
+        self._lock = threading.RLock()
+        # 仅为与其他后端保持相同的统计接口，容量为 0 不缓存任何内容
+        self._dialog_cache = LRUCache(0)
+        self._flusher = WriteBehindFlusher(
+            self._flush_pending,
+            lambda: len(self._pending),
+            interval=flush_interval,
+            max_pending=self.batch_size,
+        )
+        logger.info(f"Redis 消息存储已就绪，键前缀: {self.key_prefix}")
+
+    def _chats_key(self) -> str:
+        """有消息记录的聊天 ID 集合"""
+        return f"{self.key_prefix}chats"
+
+    def _messages_key(self, chat_id: int) -> str:
+        """聊天消息的有序集合"""
+        return f"{self.key_prefix}messages:{chat_id}"
+
+    def _dialog_key(self, chat_id: int) -> str:
+        """对话历史列表"""
+        return f"{self.key_prefix}dialog:{chat_id}"
+
+    @staticmethod
+    def _to_epoch(timestamp: datetime) -> float:
+        """将时间转换为 UTC 时间戳"""
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        return timestamp.timestamp()
+
+    @staticmethod
+    def _since(hours: float) -> float:
+        """计算 hours 小时之前的时间戳"""
+        return (datetime.now(timezone.utc) - timedelta(hours=hours)).timestamp()
+
+    @staticmethod
+    def _retention_seconds() -> Optional[int]:
+        """历史清理的保留时长（秒），用作键的过期时间；清理功能禁用时返回 None"""
+        cleanup_config = config_manager.get("features.history_cleanup", {})
+        if not cleanup_config.get("enabled", True):
+            return None
+        return int(cleanup_config.get("retention_days", 30) * 86400)
+
+    @staticmethod
+    def _format(member: str) -> str:
+        """将有序集合成员格式化为“用户名: 消息内容”"""
+        record = json.loads(member)
+        return f"{record['username']}: {record['message']}"
+
+    def _flush_pending(self) -> int:
+        """将缓冲中的消息通过 pipeline 批量写入，并按上限裁剪涉及的聊天，返回写入条数"""
+        with self._lock:
+            if not self._pending:
+                return 0
+            rows, self._pending = self._pending, []
+
+            by_chat: Dict[int, Dict[str, float]] = {}
+            for chat_id, member, ts in rows:
+                by_chat.setdefault(chat_id, {})[member] = ts
+
+            ttl = self._retention_seconds()
+            try:
+                pipe = self.client.pipeline(transaction=False)
+                for chat_id, members in by_chat.items():
+                    key = self._messages_key(chat_id)
+                    pipe.zadd(key, members)
+                    pipe.zremrangebyrank(key, 0, -self.MAX_MESSAGES_PER_CHAT - 1)
+                    if ttl:
+                        pipe.expire(key, ttl)
+                pipe.sadd(self._chats_key(), *by_chat.keys())
+                pipe.execute()
+                return len(rows)
+            except Exception as e:
+                self._pending = rows + self._pending
+                logger.error(f"批量写入消息时出错: {e}")
+                return 0
+
+    def flush(self) -> int:
+        """立即写入缓冲中的所有消息，返回写入的条数"""
+        return self._flusher.flush_now()
+
+    def start_flusher(self):
+        """在当前事件循环中启动后台批量写入任务"""
+        self._flusher.start()
+
+    async def stop_flusher(self):
+        """停止后台批量写入任务并写入剩余消息"""
+        await self._flusher.stop()
+
+    def get_flush_stats(self) -> Dict[str, Any]:
+        """获取批量写入的刷新延迟、队列深度等指标"""
+        stats = self._flusher.get_stats()
+        with self._lock:
+            stats["dirty_chats"] = len({row[0] for row in self._pending})
+        return stats
+
+    def get_dialog_cache_stats(self) -> Dict[str, Any]:
+        """获取对话历史缓存的容量和命中率（Redis 后端不缓存）"""
+        return self._dialog_cache.get_stats()
+
+    def get_memory_stats(self) -> Dict[str, Any]:
+        """获取内存占用信息；消息保存在数据库中，进程内只有写入缓冲"""
+        with self._lock:
+            pending = len(self._pending)
+        return {"budget_bytes": 0, "pending_messages": pending}
+
+    def get_chat_ids(self) -> List[int]:
+        """获取所有有消息记录的聊天 ID"""
+        self.flush()
+        return [int(chat_id) for chat_id in self.client.smembers(self._chats_key())]
+
+    def add_message(
+        self,
+        chat_id: int,
+        user_id: int,
+        username: str,
+        message: str,
+        timestamp: datetime,
+    ):
+        """添加消息"""
+        try:
+            # 成员中带上随机 ID，避免同一时刻的相同内容被有序集合合并
+            member = json.dumps(
+                {
+                    "id": uuid.uuid4().hex,
+                    "user_id": user_id,
+                    "username": username,
+                    "message": message,
+                },
+                ensure_ascii=False,
+            )
+            with self._lock:
+                self._pending.append((chat_id, member, self._to_epoch(timestamp)))
+                batch_full = len(self._pending) >= self.batch_size
+
+            # 达到批量大小时交给刷新器：后台任务运行时异步写入，否则立即写入
+            if batch_full:
+                self._flusher.notify()
+
+            logger.debug(f"添加消息 - 聊天: {chat_id}, 用户: {user_id}")
+
+        except Exception as e:
+            logger.error(f"添加消息时出错: {e}")
+
+    def import_messages(self, chat_id: int, records: List[Tuple[int, int, str, str]]):
+        """批量导入一个聊天的消息 (微秒时间戳, 用户ID, 用户名, 消息内容)，用于从快照恢复"""
+        with self._lock:
+            for ts, user_id, username, message in records:
+                member = json.dumps(
+                    {
+                        "id": uuid.uuid4().hex,
+                        "user_id": user_id,
+                        "username": username,
+                        "message": message,
+                    },
+                    ensure_ascii=False,
+                )
+                self._pending.append((chat_id, member, ts / US_PER_SECOND))
+        self.flush()
+
+    def get_active_chat_ids(self, since: datetime, min_messages: int = 1) -> List[int]:
+        """获取 since 之后消息数达到 min_messages 的聊天"""
+        try:
+            chat_ids = self.get_chat_ids()
+            pipe = self.client.pipeline(transaction=False)
+            for chat_id in chat_ids:
+                pipe.zcount(self._messages_key(chat_id), self._to_epoch(since), "+inf")
+            counts = pipe.execute()
+            return [
+                chat_id
+                for chat_id, count in zip(chat_ids, counts)
+                if count >= min_messages
+            ]
+
+        except Exception as e:
+            logger.error(f"筛选活跃聊天时出错: {e}")
+            return []
+
+    def _range_bounds(
+        self, start: datetime, end: Optional[datetime]
+    ) -> Tuple[float, Any]:
+        """构造 [start, end) 时间窗口的分数范围"""
+        if end is None:
+            return self._to_epoch(start), "+inf"
+        return self._to_epoch(start), f"({self._to_epoch(end)}"
+
+    def get_messages_between(
+        self, chat_id: int, start: datetime, end: Optional[datetime] = None
+    ) -> List[str]:
+        """获取时间位于 [start, end) 内的消息，end 为空表示直到当前"""
+        try:
+            self.flush()
+            low, high = self._range_bounds(start, end)
+            members = self.client.zrangebyscore(self._messages_key(chat_id), low, high)
+            return [self._format(member) for member in members]
+
+        except Exception as e:
+            logger.error(f"获取时间窗口消息时出错 - 聊天: {chat_id}, 错误: {e}")
+            return []
+
+    def iter_messages_between(
+        self,
+        chat_id: int,
+        start: datetime,
+        end: Optional[datetime] = None,
+        newest_first: bool = False,
+        max_bytes: int = 0,
+        max_tokens: int = 0,
+    ) -> Iterator[str]:
+        """逐条产出时间位于 [start, end) 内的“用户名: 消息内容”
+
+        按分数范围分页读取有序集合；预算语义与 MessageStore 相同。
+        """
+        lines = (
+            self._format(member)
+            for member, _ in self._iter_members_between(
+                chat_id, start, end, newest_first
+            )
+        )
+        return limit_by_budget(lines, max_bytes, max_tokens)
+
+    def iter_chat_records(self, chat_id: int) -> Iterator[Tuple[int, int, str, str]]:
+        """按时间顺序逐条产出聊天的全部消息 (微秒时间戳, 用户ID, 用户名, 消息内容)"""
+        start = datetime.fromtimestamp(0, timezone.utc)
+        for member, score in self._iter_members_between(chat_id, start, None, False):
+            record = json.loads(member)
+            yield (
+                round(score * US_PER_SECOND),
+                int(record["user_id"]),
+                record["username"],
+                record["message"],
+            )
+
+    def _iter_members_between(
+        self,
+        chat_id: int,
+        start: datetime,
+        end: Optional[datetime],
+        newest_first: bool,
+    ) -> Iterator[Tuple[str, float]]:
+        """用 ZRANGEBYSCORE / ZREVRANGEBYSCORE 的 LIMIT 逐页读取 (成员, 时间戳)"""
+        try:
+            self.flush()
+            key = self._messages_key(chat_id)
+            low, high = self._range_bounds(start, end)
+            offset = 0
+            while True:
+                if newest_first:
+                    members = self.client.zrevrangebyscore(
+                        key,
+                        high,
+                        low,
+                        start=offset,
+                        num=self.ITER_PAGE_SIZE,
+                        withscores=True,
+                    )
+                else:
+                    members = self.client.zrangebyscore(
+                        key,
+                        low,
+                        high,
+                        start=offset,
+                        num=self.ITER_PAGE_SIZE,
+                        withscores=True,
+                    )
+                if not members:
+                    return
+                yield from members
+                offset += len(members)
+
+        except Exception as e:
+            logger.error(f"遍历时间窗口消息时出错 - 聊天: {chat_id}, 错误: {e}")
+
+    def count_messages_between(
+        self, chat_id: int, start: datetime, end: Optional[datetime] = None
+    ) -> int:
+        """统计时间位于 [start, end) 内的消息数量，end 为空表示直到当前"""
+        try:
+            self.flush()
+            low, high = self._range_bounds(start, end)
+            return self.client.zcount(self._messages_key(chat_id), low, high)
+
+        except Exception as e:
+            logger.error(f"统计时间窗口消息时出错 - 聊天: {chat_id}, 错误: {e}")
+            return 0
+
+    def get_recent_messages(
+        self, chat_id: int, hours: int = 24, min_messages: int = 10
+    ) -> List[str]:
+        """获取最近的消息"""
+        try:
+            self.flush()
+            key = self._messages_key(chat_id)
+            members = self.client.zrangebyscore(key, self._since(hours), "+inf")
+
+            # 如果消息数量不足最小要求，返回最近的消息
+            if len(members) < min_messages:
+                members = self.client.zrange(key, -min_messages, -1)
+
+            return [self._format(member) for member in members]
+
+        except Exception as e:
+            logger.error(f"获取最近消息时出错 - 聊天: {chat_id}, 错误: {e}")
+            return []
+
+    def get_message_count(self, chat_id: int, hours: int = 24) -> int:
+        """获取指定时间内的消息数量"""
+        return self.count_messages_between(
+            chat_id, datetime.now(timezone.utc) - timedelta(hours=hours)
+        )
+
+    def _remove_before(self, cutoff: float) -> int:
+        """删除所有聊天中早于 cutoff 的消息，并移除已经没有消息的聊天，返回删除条数"""
+        chat_ids = self.get_chat_ids()
+        if not chat_ids:
+            return 0
+
+        pipe = self.client.pipeline(transaction=False)
+        for chat_id in chat_ids:
+            key = self._messages_key(chat_id)
+            pipe.zremrangebyscore(key, "-inf", f"({cutoff}")
+            pipe.exists(key)
+        results = pipe.execute()
+
+        removed = sum(results[0::2])
+        empty_chats = [
+            chat_id for chat_id, exists in zip(chat_ids, results[1::2]) if not exists
+        ]
+        if empty_chats:
+            self.client.srem(self._chats_key(), *empty_chats)
+        return removed
+
+    def clear_old_messages(self, days: int = 30):
+        """清理旧消息"""
+        try:
+            removed = self._remove_before(self._since(days * 24))
+            if removed > 0:
+                logger.info(f"清理 {removed} 条旧消息")
+
+        except Exception as e:
+            logger.error(f"清理旧消息时出错: {e}")
+
+    def get_chat_stats(self, chat_id: int) -> Dict[str, Any]:
+        """获取聊天统计信息"""
+        try:
+            self.flush()
+            key = self._messages_key(chat_id)
+            pipe = self.client.pipeline(transaction=False)
+            pipe.zcard(key)
+            pipe.zrangebyscore(key, self._since(24), "+inf")
+            total_messages, recent = pipe.execute()
+
+            return {
+                "total_messages": total_messages,
+                "recent_24h": len(recent),
+                "active_users": len(
+                    {json.loads(member)["user_id"] for member in recent}
+                ),
+            }
+
+        except Exception as e:
+            logger.error(f"获取聊天统计时出错 - 聊天: {chat_id}, 错误: {e}")
+            return {"total_messages": 0, "recent_24h": 0, "active_users": 0}
+
+    def compact_all(self):
+        """写入缓冲中的消息（Redis 无需压缩）"""
+        self.flush()
+
+    def add_dialog_message(self, chat_id: int, message: dict):
+        """添加对话消息到历史记录
+
+        Args:
+            chat_id: 聊天ID
+            message: OpenAI格式的消息字典，例如 {'role': 'user', 'content': '你好'}
+        """
+        try:
+            # 验证消息格式
+            if (
+                not isinstance(message, dict)
+                or "role" not in message
+                or "content" not in message
+            ):
+                logger.error(f"无效的消息格式: {message}")
+                return
+
+            entry = json.dumps(
+                {
+                    "role": message["role"],
+                    "content": message["content"],
+                    "timestamp": datetime.now(timezone.utc).isoformat(),
+                },
+                ensure_ascii=False,
+            )
+            key = self._dialog_key(chat_id)
+            pipe = self.client.pipeline(transaction=False)
+            pipe.rpush(key, entry)
+            # 限制对话历史最多保存100条消息
+            pipe.ltrim(key, -self.MAX_DIALOG_MESSAGES, -1)
+            ttl = self._retention_seconds()
+            if ttl:
+                pipe.expire(key, ttl)
+            pipe.execute()
+
+            logger.debug(f"添加对话消息 - 聊天: {chat_id}, 角色: {message.get('role')}")
+
+        except Exception as e:
+            logger.error(f"添加对话消息时出错 - 聊天: {chat_id}, 错误: {e}")
+
+    def get_dialog_chat_ids(self) -> List[int]:
+        """获取所有有对话历史的聊天 ID"""
+        prefix = self._dialog_key(0)[:-1]
+        chat_ids = []
+        for key in self.client.scan_iter(match=f"{prefix}*"):
+            try:
+                chat_ids.append(int(key[len(prefix) :]))
+            except ValueError:
+                continue
+        return chat_ids
+
+    def export_dialog(self, chat_id: int) -> List[dict]:
+        """获取完整的对话历史（包含时间戳），用于导出快照"""
+        entries = self.client.lrange(self._dialog_key(chat_id), 0, -1)
+        return [json.loads(entry) for entry in entries]
+
+    def import_dialog(self, chat_id: int, messages: List[dict]):
+        """用快照中的对话历史替换聊天现有的对话历史"""
+        key = self._dialog_key(chat_id)
+        entries = [
+            json.dumps(
+                {
+                    "role": msg["role"],
+                    "content": msg["content"],
+                    "timestamp": msg.get("timestamp")
+                    or datetime.now(timezone.utc).isoformat(),
+                },
+                ensure_ascii=False,
+            )
+            for msg in messages[-self.MAX_DIALOG_MESSAGES :]
+        ]
+        pipe = self.client.pipeline(transaction=True)
+        pipe.delete(key)
+        if entries:
+            pipe.rpush(key, *entries)
+            ttl = self._retention_seconds()
+            if ttl:
+                pipe.expire(key, ttl)
+        pipe.execute()
+
+    def get_dialog_history(self, chat_id: int, limit: int = 10) -> list:
+        """获取对话历史记录
+
+        Args:
+            chat_id: 聊天ID
+            limit: 返回的最大消息数量，默认为10
+
+        Returns:
+            list: OpenAI格式的消息列表
+        """
+        try:
+            start = -limit if limit > 0 else 0
+            entries = self.client.lrange(self._dialog_key(chat_id), start, -1)
+
+            dialog_history = []
+            for entry in entries:
+                msg = json.loads(entry)
+                dialog_history.append({"role": msg["role"], "content": msg["content"]})
+            return dialog_history
+
+        except Exception as e:
+            logger.error(f"获取对话历史时出错 - 聊天: {chat_id}, 错误: {e}")
+            return []
+
+    def clear_dialog_history(self, chat_id: int):
+        """清除指定聊天的对话历史记录
+
+        Args:
+            chat_id: 聊天ID
+        """
+        try:
+            self.client.delete(self._dialog_key(chat_id))
+            logger.info(f"已清除聊天 {chat_id} 的对话历史记录")
+
+        except Exception as e:
+            logger.error(f"清除对话历史时出错 - 聊天: {chat_id}, 错误: {e}")
+            raise
+
+    def cleanup_expired_files(self, retention_days: int = 30):
+        """清理过期的群消息记录
+
+        对话历史列表通过过期时间自动清理，这里只删除早于保留期的群消息。
+
+        Args:
+            retention_days: 保留天数，默认30天
+        """
+        try:
+            # 获取配置
+            cleanup_config = config_manager.get("features.history_cleanup", {})
+            if not cleanup_config.get("enabled", True):
+                logger.info("历史文件清理功能已禁用")
+                return
+
+            # 使用配置中的保留天数
+            retention_days = cleanup_config.get("retention_days", retention_days)
+
+            logger.info(f"开始清理 {retention_days} 天前的历史记录...")
+            removed = self._remove_before(self._since(retention_days * 24))
+            logger.info(f"历史记录清理完成，共删除 {removed} 条群消息")
+
+        except Exception as e:
+            logger.error(f"清理过期记录时出错: {e}")
@@ -0,0 +1,202 @@
+"""
+AI 回复缓存
+按规范化后的请求（模型、系统提示、消息、采样参数）缓存对话回复，
+进程内 LRU 为第一级，可选的 Redis 为多个实例共享的第二级；
+过期后的回复在一段宽限期内保留，上游不可用时作为后备
+"""
+
+import asyncio
+import hashlib
+import json
+import re
+import threading
+import time
+from typing import Any, Dict, Iterable, Optional, Set, Tuple
+
+from loguru import logger
+
+from bot.utils.lru_cache import LRUCache
+from config.settings import config_manager
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def _normalize_content(content: Any) -> Any:
+    """合并连续空白并去掉首尾空白，使排版不同的相同提问命中同一条缓存"""
+    if isinstance(content, str):
+        return _WHITESPACE_RE.sub(" ", content).strip()
+    return content
+
+
+def make_cache_key(request: Dict[str, Any]) -> str:
+    """根据对话请求参数计算缓存键
+
+    参与计算的有模型、全部消息（包括系统提示）、temperature 和 max_tokens，
+    消息内容先规范化空白，其余字段按键排序后序列化。
+    """
+    temperature = request.get("temperature")
+    normalized = {
+        "model": request.get("model"),
+        "messages": [
+            {"role": m.get("role"), "content": _normalize_content(m.get("content"))}
+            for m in request.get("messages", [])
+        ],
+        "temperature": round(float(temperature), 3)
+        if temperature is not None
+        else None,
+        "max_tokens": request.get("max_tokens"),
+    }
+    payload = json.dumps(
+        normalized, ensure_ascii=False, sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """两级的 AI 回复缓存
+
+    条目写入后 ttl 秒内为新鲜，直接返回；之后 stale_ttl 秒内为陈旧，
+    调用方应先请求上游，只在上游不可用时退回旧回复（stale-if-error）。
+    超过宽限期的条目视为不存在。Redis 读写失败只记录日志，不影响进程内缓存。
+    """
+
+    def __init__(
+        self,
+        max_size: int = 512,
+        ttl: float = 3600,
+        stale_ttl: float = 86400,
+        redis_client=None,
+        key_prefix: str = "snaily:ai_cache:",
+        disabled_features: Iterable[str] = (),
+    ):
+        self.ttl = max(0.0, ttl)
+        self.stale_ttl = max(0.0, stale_ttl)
+        # 条目在宽限期结束后才真正从 LRU 中失效，新鲜度由写入时间判断
+        self._local = LRUCache(max_size=max_size, ttl=self.ttl + self.stale_ttl)
+        self.redis_client = redis_client
+        self.key_prefix = key_prefix
+        self.disabled_features: Set[str] = {f.strip() for f in disabled_features}
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.stale_served = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.redis_errors = 0
+
+    def allows(self, feature: Optional[str]) -> bool:
+        """判断某个功能的请求是否使用缓存"""
+        return feature not in self.disabled_features
+
+    def _count(self, name: str):
+        """累加一个统计计数"""
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    async def get(self, key: str) -> Optional[Tuple[str, bool]]:
+        """读取缓存，返回 (回复, 是否新鲜)，不存在或已超过宽限期时返回 None
+
+        陈旧的条目计为未命中，调用方实际使用它时再调用 record_stale_served。
+        """
+        item = self._local.get(key)
+        from_redis = False
+        if item is None and self.redis_client is not None:
+            item = await self._redis_get(key)
+            from_redis = item is not None
+
+        if item is None or time.time() - item[0] > self.ttl + self.stale_ttl:
+            self._count("misses")
+            return None
+
+        if from_redis:
+            self._local.put(key, item)
+            self._count("redis_hits")
+        stored_at, reply = item
+        age = time.time() - stored_at
+        if age > self.ttl:
+            self._count("misses")
+            return reply, False
+        self._count("hits")
+        return reply, True
+
+    def record_stale_served(self):
+        """记录一次上游不可用时退回陈旧回复"""
+        self._count("stale_served")
+
+    async def put(self, key: str, reply: str):
+        """写入两级缓存"""
+        item = (time.time(), reply)
+        self._local.put(key, item)
+        if self.redis_client is not None:
+            await self._redis_put(key, item)
+
+    async def _redis_get(self, key: str) -> Optional[Tuple[float, str]]:
+        """从 Redis 读取条目"""
+        try:
+            raw = await asyncio.to_thread(self.redis_client.get, self.key_prefix + key)
+            if raw is None:
+                return None
+            data = json.loads(raw)
+            return float(data["t"]), data["v"]
+        except Exception as e:
+            self._count("redis_errors")
+            logger.warning(f"读取 Redis 中的 AI 回复缓存失败: {e}")
+            return None
+
+    async def _redis_put(self, key: str, item: Tuple[float, str]):
+        """写入 Redis，过期时间为新鲜期加宽限期"""
+        expire = max(1, int(self.ttl + self.stale_ttl))
+        payload = json.dumps({"t": item[0], "v": item[1]}, ensure_ascii=False)
+        try:
+            await asyncio.to_thread(
+                self.redis_client.set, self.key_prefix + key, payload, ex=expire
+            )
+        except Exception as e:
+            self._count("redis_errors")
+            logger.warning(f"写入 Redis 中的 AI 回复缓存失败: {e}")
+
+    def clear(self):
+        """清空进程内缓存，Redis 中的条目由过期时间自然淘汰"""
+        self._local.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取命中率等统计，命中率只计新鲜命中"""
+        with self._stats_lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._local),
+                "max_size": self._local.max_size,
+                "ttl": self.ttl,
+                "stale_ttl": self.stale_ttl,
+                "redis": self.redis_client is not None,
+                "hits": self.hits,
+                "stale_served": self.stale_served,
+                "redis_hits": self.redis_hits,
+                "misses": self.misses,
+                "redis_errors": self.redis_errors,
+                "hit_ratio": self.hits / total if total else 0.0,
+                "disabled_features": sorted(self.disabled_features),
+            }
+
+
+def create_response_cache() -> Optional[ResponseCache]:
+    """根据配置创建回复缓存，ai_services.response_cache.enabled 为 false 时返回 None"""
+    cache_config = config_manager.get("ai_services.response_cache", {})
+    if not cache_config.get("enabled", True):
+        return None
+
+    redis_client = None
+    if cache_config.get("redis_enabled", True):
+        redis_client = config_manager.redis_client
+
+    return ResponseCache(
+        max_size=cache_config.get("max_size", 512),
+        ttl=cache_config.get("ttl", 3600),
+        stale_ttl=cache_config.get("stale_ttl", 86400),
+        redis_client=redis_client,
+        key_prefix=cache_config.get("redis_key_prefix", "snaily:ai_cache:"),
+        disabled_features=cache_config.get("disabled_features", ["chat", "search"]),
+    )
+
+
+# 全局回复缓存实例
+response_cache = create_response_cache()
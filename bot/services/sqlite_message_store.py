@@ -0,0 +1,614 @@
+"""
+SQLite 消息存储模块
+与 MessageStore 提供相同的公共方法，数据保存在单个 SQLite 数据库中
+"""
+
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from loguru import logger
+
+from bot.services.chat_history import US_PER_SECOND
+from bot.services.write_behind import WriteBehindFlusher
+from bot.utils.lru_cache import LRUCache
+from bot.utils.text_budget import limit_by_budget
+from config.settings import config_manager
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    username TEXT NOT NULL,
+    message TEXT NOT NULL,
+    ts REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_messages_chat_ts ON messages (chat_id, ts);
+CREATE TABLE IF NOT EXISTS dialog_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    ts REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_dialog_chat_id ON dialog_history (chat_id, id);
+"""
+
+
+class SQLiteMessageStore:
+    """基于 SQLite 的消息存储器
+
+    使用 WAL 模式和 (chat_id, ts) 索引，时间窗口查询和过期清理均为索引范围扫描。
+    群聊消息先进入内存缓冲，达到批量大小、后台刷新间隔到期或发生读取时再批量写入。
+    最近使用的对话历史保存在 LRU 缓存中，写入时同步更新数据库和缓存。
+    """
+
+    # 每个聊天最多保留的消息数，与文件存储保持一致
+    MAX_MESSAGES_PER_CHAT = 1000
+    # 每个聊天最多保留的对话历史条数
+    MAX_DIALOG_MESSAGES = 100
+    # 流式遍历消息时每页读取的行数
+    ITER_PAGE_SIZE = 256
+
+    def __init__(
+        self,
+        db_path: str = "data/messages.db",
+        batch_size: int = 50,
+        flush_interval: float = 1.0,
+        fsync: str = "never",
+        dialog_cache_size: int = 256,
+        dialog_cache_ttl: float = 0,
+    ):
+        self.db_path = db_path
+        self.storage_dir = os.path.dirname(db_path) or "."
+        self.data_dir = self.storage_dir
+        self.batch_size = max(1, batch_size)
+        self.fsync = fsync
+        self._pending: List[Tuple[int, int, str, str, float]] = []
+        self._lock = threading.RLock()
+        # chat_id -> 完整对话历史，由 _lock 保护其内容
+        self._dialog_cache = LRUCache(dialog_cache_size, dialog_cache_ttl)
+        self._flusher = WriteBehindFlusher(
+            self._flush_pending,
+            lambda: len(self._pending),
+            interval=flush_interval,
+            max_pending=self.batch_size,
+        )
+        os.makedirs(self.storage_dir, exist_ok=True)
+        self._conn = self._connect()
+        logger.info(f"SQLite 消息存储已就绪: {self.db_path}")
+
+    def _connect(self) -> sqlite3.Connection:
+        """打开数据库连接并初始化表结构"""
+        conn = sqlite3.connect(
+            self.db_path, check_same_thread=False, isolation_level=None
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        # fsync 策略为 flush 时每次提交都同步到磁盘
+        conn.execute(
+            "PRAGMA synchronous=FULL"
+            if self.fsync == "flush"
+            else "PRAGMA synchronous=NORMAL"
+        )
+        conn.executescript(_SCHEMA)
+        return conn
+
+    @staticmethod
+    def _to_epoch(timestamp: datetime) -> float:
+        """将时间转换为 UTC 时间戳"""
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        return timestamp.timestamp()
+
+    @staticmethod
+    def _since(hours: float) -> float:
+        """计算 hours 小时之前的时间戳"""
+        return (datetime.now(timezone.utc) - timedelta(hours=hours)).timestamp()
+
+    def _flush_pending(self) -> int:
+        """将缓冲中的消息批量写入数据库，并按上限裁剪涉及的聊天，返回写入条数"""
+        with self._lock:
+            if not self._pending:
+                return 0
+            rows, self._pending = self._pending, []
+            chat_ids = {row[0] for row in rows}
+            try:
+                self._conn.execute("BEGIN")
+                self._conn.executemany(
+                    "INSERT INTO messages (chat_id, user_id, username, message, ts) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    rows,
+                )
+                for chat_id in chat_ids:
+                    self._conn.execute(
+                        "DELETE FROM messages WHERE chat_id = ? AND id < ("
+                        "SELECT id FROM messages WHERE chat_id = ? "
+                        "ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                        (chat_id, chat_id, self.MAX_MESSAGES_PER_CHAT - 1),
+                    )
+                self._conn.execute("COMMIT")
+                return len(rows)
+            except Exception as e:
+                self._conn.execute("ROLLBACK")
+                self._pending = rows + self._pending
+                logger.error(f"批量写入消息时出错: {e}")
+                return 0
+
+    def flush(self) -> int:
+        """立即写入缓冲中的所有消息，返回写入的条数"""
+        return self._flusher.flush_now()
+
+    def start_flusher(self):
+        """在当前事件循环中启动后台批量写入任务"""
+        self._flusher.start()
+
+    async def stop_flusher(self):
+        """停止后台批量写入任务并写入剩余消息"""
+        await self._flusher.stop()
+
+    def close(self):
+        """写入缓冲中的消息并关闭数据库连接"""
+        with self._lock:
+            self._flush_pending()
+            self._conn.close()
+
+    def get_flush_stats(self) -> Dict[str, Any]:
+        """获取批量写入的刷新延迟、队列深度等指标"""
+        stats = self._flusher.get_stats()
+        with self._lock:
+            stats["dirty_chats"] = len({row[0] for row in self._pending})
+        return stats
+
+    def get_dialog_cache_stats(self) -> Dict[str, Any]:
+        """获取对话历史缓存的容量和命中率"""
+        return self._dialog_cache.get_stats()
+
+    def get_memory_stats(self) -> Dict[str, Any]:
+        """获取内存占用信息；消息保存在数据库中，进程内只有写入缓冲"""
+        with self._lock:
+            pending = len(self._pending)
+        return {"budget_bytes": 0, "pending_messages": pending}
+
+    def get_chat_ids(self) -> List[int]:
+        """获取所有有消息记录的聊天 ID"""
+        with self._lock:
+            self._flush_pending()
+            rows = self._conn.execute(
+                "SELECT DISTINCT chat_id FROM messages"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def add_message(
+        self,
+        chat_id: int,
+        user_id: int,
+        username: str,
+        message: str,
+        timestamp: datetime,
+    ):
+        """添加消息"""
+        try:
+            with self._lock:
+                self._pending.append(
+                    (chat_id, user_id, username, message, self._to_epoch(timestamp))
+                )
+                batch_full = len(self._pending) >= self.batch_size
+
+            # 达到批量大小时交给刷新器：后台任务运行时异步写入，否则立即写入
+            if batch_full:
+                self._flusher.notify()
+
+            logger.debug(f"添加消息 - 聊天: {chat_id}, 用户: {user_id}")
+
+        except Exception as e:
+            logger.error(f"添加消息时出错: {e}")
+
+    def import_messages(self, chat_id: int, records: List[Tuple[int, int, str, str]]):
+        """批量导入一个聊天的消息 (微秒时间戳, 用户ID, 用户名, 消息内容)，用于从快照恢复"""
+        with self._lock:
+            self._pending.extend(
+                (chat_id, user_id, username, message, ts / US_PER_SECOND)
+                for ts, user_id, username, message in records
+            )
+            self._flush_pending()
+
+    def get_active_chat_ids(self, since: datetime, min_messages: int = 1) -> List[int]:
+        """获取 since 之后消息数达到 min_messages 的聊天"""
+        try:
+            with self._lock:
+                self._flush_pending()
+                rows = self._conn.execute(
+                    "SELECT chat_id FROM messages WHERE ts >= ? "
+                    "GROUP BY chat_id HAVING COUNT(*) >= ?",
+                    (self._to_epoch(since), min_messages),
+                ).fetchall()
+            return [row[0] for row in rows]
+
+        except Exception as e:
+            logger.error(f"筛选活跃聊天时出错: {e}")
+            return []
+
+    def _range_clause(
+        self, chat_id: int, start: datetime, end: Optional[datetime]
+    ) -> Tuple[str, tuple]:
+        """构造 [start, end) 时间窗口的查询条件"""
+        if end is None:
+            return "chat_id = ? AND ts >= ?", (chat_id, self._to_epoch(start))
+        return "chat_id = ? AND ts >= ? AND ts < ?", (
+            chat_id,
+            self._to_epoch(start),
+            self._to_epoch(end),
+        )
+
+    def get_messages_between(
+        self, chat_id: int, start: datetime, end: Optional[datetime] = None
+    ) -> List[str]:
+        """获取时间位于 [start, end) 内的消息，end 为空表示直到当前"""
+        try:
+            clause, params = self._range_clause(chat_id, start, end)
+            with self._lock:
+                self._flush_pending()
+                rows = self._conn.execute(
+                    f"SELECT username, message FROM messages WHERE {clause} "
+                    "ORDER BY ts, id",
+                    params,
+                ).fetchall()
+            return [f"{username}: {message}" for username, message in rows]
+
+        except Exception as e:
+            logger.error(f"获取时间窗口消息时出错 - 聊天: {chat_id}, 错误: {e}")
+            return []
+
+    def iter_messages_between(
+        self,
+        chat_id: int,
+        start: datetime,
+        end: Optional[datetime] = None,
+        newest_first: bool = False,
+        max_bytes: int = 0,
+        max_tokens: int = 0,
+    ) -> Iterator[str]:
+        """逐条产出时间位于 [start, end) 内的“用户名: 消息内容”
+
+        按 (ts, id) 分页查询，每页单独持锁；预算语义与 MessageStore 相同。
+        """
+        lines = (
+            f"{username}: {message}"
+            for _, _, username, message in self._iter_rows_between(
+                chat_id, start, end, newest_first
+            )
+        )
+        return limit_by_budget(lines, max_bytes, max_tokens)
+
+    def iter_chat_records(self, chat_id: int) -> Iterator[Tuple[int, int, str, str]]:
+        """按时间顺序逐条产出聊天的全部消息 (微秒时间戳, 用户ID, 用户名, 消息内容)"""
+        return self._iter_rows_between(
+            chat_id, datetime.fromtimestamp(0, timezone.utc), None, False
+        )
+
+    def _iter_rows_between(
+        self,
+        chat_id: int,
+        start: datetime,
+        end: Optional[datetime],
+        newest_first: bool,
+    ) -> Iterator[Tuple[int, int, str, str]]:
+        """以上一页最后一行的 (ts, id) 为游标逐页读取"""
+        clause, params = self._range_clause(chat_id, start, end)
+        order, op = ("DESC", "<") if newest_first else ("ASC", ">")
+        cursor: Optional[Tuple[float, int]] = None
+        try:
+            while True:
+                page_clause, page_params = clause, params
+                if cursor is not None:
+                    page_clause += f" AND (ts {op} ? OR (ts = ? AND id {op} ?))"
+                    page_params = params + (cursor[0], cursor[0], cursor[1])
+                with self._lock:
+                    if cursor is None:
+                        self._flush_pending()
+                    rows = self._conn.execute(
+                        f"SELECT ts, id, user_id, username, message FROM messages "
+                        f"WHERE {page_clause} ORDER BY ts {order}, id {order} LIMIT ?",
+                        page_params + (self.ITER_PAGE_SIZE,),
+                    ).fetchall()
+                if not rows:
+                    return
+                for ts, _, user_id, username, message in rows:
+                    yield round(ts * US_PER_SECOND), user_id, username, message
+                cursor = (rows[-1][0], rows[-1][1])
+
+        except Exception as e:
+            logger.error(f"遍历时间窗口消息时出错 - 聊天: {chat_id}, 错误: {e}")
+
+    def count_messages_between(
+        self, chat_id: int, start: datetime, end: Optional[datetime] = None
+    ) -> int:
+        """统计时间位于 [start, end) 内的消息数量，end 为空表示直到当前"""
+        try:
+            clause, params = self._range_clause(chat_id, start, end)
+            with self._lock:
+                self._flush_pending()
+                row = self._conn.execute(
+                    f"SELECT COUNT(*) FROM messages WHERE {clause}", params
+                ).fetchone()
+            return row[0]
+
+        except Exception as e:
+            logger.error(f"统计时间窗口消息时出错 - 聊天: {chat_id}, 错误: {e}")
+            return 0
+
+    def get_recent_messages(
+        self, chat_id: int, hours: int = 24, min_messages: int = 10
+    ) -> List[str]:
+        """获取最近的消息"""
+        try:
+            with self._lock:
+                self._flush_pending()
+                rows = self._conn.execute(
+                    "SELECT username, message FROM messages "
+                    "WHERE chat_id = ? AND ts >= ? ORDER BY ts, id",
+                    (chat_id, self._since(hours)),
+                ).fetchall()
+
+                # 如果消息数量不足最小要求，返回最近的消息
+                if len(rows) < min_messages:
+                    rows = self._conn.execute(
+                        "SELECT username, message FROM messages WHERE chat_id = ? "
+                        "ORDER BY ts DESC, id DESC LIMIT ?",
+                        (chat_id, min_messages),
+                    ).fetchall()
+                    rows.reverse()
+
+            return [f"{username}: {message}" for username, message in rows]
+
+        except Exception as e:
+            logger.error(f"获取最近消息时出错 - 聊天: {chat_id}, 错误: {e}")
+            return []
+
+    def get_message_count(self, chat_id: int, hours: int = 24) -> int:
+        """获取指定时间内的消息数量"""
+        return self.count_messages_between(
+            chat_id, datetime.now(timezone.utc) - timedelta(hours=hours)
+        )
+
+    def clear_old_messages(self, days: int = 30):
+        """清理旧消息"""
+        try:
+            with self._lock:
+                self._flush_pending()
+                cursor = self._conn.execute(
+                    "DELETE FROM messages WHERE ts < ?", (self._since(days * 24),)
+                )
+            if cursor.rowcount > 0:
+                logger.info(f"清理 {cursor.rowcount} 条旧消息")
+
+        except Exception as e:
+            logger.error(f"清理旧消息时出错: {e}")
+
+    def get_chat_stats(self, chat_id: int) -> Dict[str, Any]:
+        """获取聊天统计信息"""
+        try:
+            with self._lock:
+                self._flush_pending()
+                total_messages = self._conn.execute(
+                    "SELECT COUNT(*) FROM messages WHERE chat_id = ?", (chat_id,)
+                ).fetchone()[0]
+                recent_24h, active_users = self._conn.execute(
+                    "SELECT COUNT(*), COUNT(DISTINCT user_id) FROM messages "
+                    "WHERE chat_id = ? AND ts >= ?",
+                    (chat_id, self._since(24)),
+                ).fetchone()
+
+            return {
+                "total_messages": total_messages,
+                "recent_24h": recent_24h,
+                "active_users": active_users,
+            }
+
+        except Exception as e:
+            logger.error(f"获取聊天统计时出错 - 聊天: {chat_id}, 错误: {e}")
+            return {"total_messages": 0, "recent_24h": 0, "active_users": 0}
+
+    def compact_all(self):
+        """写入缓冲并截断 WAL 文件"""
+        try:
+            with self._lock:
+                self._flush_pending()
+                self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except Exception as e:
+            logger.error(f"压缩 SQLite 数据库时出错: {e}")
+
+    def add_dialog_message(self, chat_id: int, message: dict):
+        """添加对话消息到历史记录
+
+        Args:
+            chat_id: 聊天ID
+            message: OpenAI格式的消息字典，例如 {'role': 'user', 'content': '你好'}
+        """
+        try:
+            # 验证消息格式
+            if (
+                not isinstance(message, dict)
+                or "role" not in message
+                or "content" not in message
+            ):
+                logger.error(f"无效的消息格式: {message}")
+                return
+
+            with self._lock:
+                self._conn.execute("BEGIN")
+                self._conn.execute(
+                    "INSERT INTO dialog_history (chat_id, role, content, ts) "
+                    "VALUES (?, ?, ?, ?)",
+                    (
+                        chat_id,
+                        message["role"],
+                        message["content"],
+                        datetime.now(timezone.utc).timestamp(),
+                    ),
+                )
+                # 限制对话历史最多保存100条消息
+                self._conn.execute(
+                    "DELETE FROM dialog_history WHERE chat_id = ? AND id < ("
+                    "SELECT id FROM dialog_history WHERE chat_id = ? "
+                    "ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                    (chat_id, chat_id, self.MAX_DIALOG_MESSAGES - 1),
+                )
+                self._conn.execute("COMMIT")
+
+                cached = self._dialog_cache.peek(chat_id)
+                if cached is not None:
+                    cached.append({"role": message["role"], "content": message["content"]})
+                    del cached[: -self.MAX_DIALOG_MESSAGES]
+
+            logger.debug(f"添加对话消息 - 聊天: {chat_id}, 角色: {message.get('role')}")
+
+        except Exception as e:
+            logger.error(f"添加对话消息时出错 - 聊天: {chat_id}, 错误: {e}")
+
+    def get_dialog_chat_ids(self) -> List[int]:
+        """获取所有有对话历史的聊天 ID"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT DISTINCT chat_id FROM dialog_history"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def export_dialog(self, chat_id: int) -> List[dict]:
+        """获取完整的对话历史（包含时间戳），用于导出快照"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT role, content, ts FROM dialog_history WHERE chat_id = ? "
+                "ORDER BY id",
+                (chat_id,),
+            ).fetchall()
+        return [
+            {
+                "role": role,
+                "content": content,
+                "timestamp": datetime.fromtimestamp(ts, timezone.utc).isoformat(),
+            }
+            for role, content, ts in rows
+        ]
+
+    def import_dialog(self, chat_id: int, messages: List[dict]):
+        """用快照中的对话历史替换聊天现有的对话历史"""
+        messages = messages[-self.MAX_DIALOG_MESSAGES :]
+        now = datetime.now(timezone.utc).timestamp()
+        rows = [
+            (
+                chat_id,
+                msg["role"],
+                msg["content"],
+                self._to_epoch(datetime.fromisoformat(msg["timestamp"]))
+                if msg.get("timestamp")
+                else now,
+            )
+            for msg in messages
+        ]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute(
+                    "DELETE FROM dialog_history WHERE chat_id = ?", (chat_id,)
+                )
+                self._conn.executemany(
+                    "INSERT INTO dialog_history (chat_id, role, content, ts) "
+                    "VALUES (?, ?, ?, ?)",
+                    rows,
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._dialog_cache.pop(chat_id)
+
+    def get_dialog_history(self, chat_id: int, limit: int = 10) -> list:
+        """获取对话历史记录
+
+        Args:
+            chat_id: 聊天ID
+            limit: 返回的最大消息数量，默认为10
+
+        Returns:
+            list: OpenAI格式的消息列表
+        """
+        try:
+            with self._lock:
+                dialog_history = self._dialog_cache.get(chat_id)
+                if dialog_history is None:
+                    rows = self._conn.execute(
+                        "SELECT role, content FROM dialog_history WHERE chat_id = ? "
+                        "ORDER BY id",
+                        (chat_id,),
+                    ).fetchall()
+                    dialog_history = [
+                        {"role": role, "content": content} for role, content in rows
+                    ]
+                    self._dialog_cache.put(chat_id, dialog_history)
+
+                if limit > 0:
+                    dialog_history = dialog_history[-limit:]
+                return [dict(msg) for msg in dialog_history]
+
+        except Exception as e:
+            logger.error(f"获取对话历史时出错 - 聊天: {chat_id}, 错误: {e}")
+            return []
+
+    def clear_dialog_history(self, chat_id: int):
+        """清除指定聊天的对话历史记录
+
+        Args:
+            chat_id: 聊天ID
+        """
+        try:
+            with self._lock:
+                self._conn.execute(
+                    "DELETE FROM dialog_history WHERE chat_id = ?", (chat_id,)
+                )
+                self._dialog_cache.pop(chat_id)
+            logger.info(f"已清除聊天 {chat_id} 的对话历史记录")
+
+        except Exception as e:
+            logger.error(f"清除对话历史时出错 - 聊天: {chat_id}, 错误: {e}")
+            raise
+
+    def cleanup_expired_files(self, retention_days: int = 30):
+        """清理过期的对话历史和群消息记录
+
+        Args:
+            retention_days: 保留天数，默认30天
+        """
+        try:
+            # 获取配置
+            cleanup_config = config_manager.get("features.history_cleanup", {})
+            if not cleanup_config.get("enabled", True):
+                logger.info("历史文件清理功能已禁用")
+                return
+
+            # 使用配置中的保留天数
+            retention_days = cleanup_config.get("retention_days", retention_days)
+            cutoff = self._since(retention_days * 24)
+
+            logger.info(f"开始清理 {retention_days} 天前的历史记录...")
+
+            with self._lock:
+                self._flush_pending()
+                deleted_messages = self._conn.execute(
+                    "DELETE FROM messages WHERE ts < ?", (cutoff,)
+                ).rowcount
+                deleted_dialogs = self._conn.execute(
+                    "DELETE FROM dialog_history WHERE ts < ?", (cutoff,)
+                ).rowcount
+                if deleted_dialogs:
+                    self._dialog_cache.clear()
+
+            logger.info(
+                f"历史记录清理完成，共删除 {deleted_messages} 条群消息、{deleted_dialogs} 条对话历史"
+            )
+
+        except Exception as e:
+            logger.error(f"清理过期记录时出错: {e}")
@@ -0,0 +1,267 @@
+"""
+消息存储快照
+把群消息和对话历史流式导出为紧凑的二进制快照，并能批量导入到任意存储后端，
+可用于备份恢复和在文件、SQLite、Redis 后端之间迁移
+"""
+
+import json
+import os
+import struct
+import zlib
+from datetime import datetime, timezone
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+from loguru import logger
+
+from bot.services.chat_history import US_PER_SECOND
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# 文件头：魔数 + 格式版本 + 负载编码（m 为 msgpack，j 为 JSON）
+# 版本 2 的消息时间戳为微秒，版本 1 为秒，导入时换算
+SNAPSHOT_MAGIC = b"SNLYSNAP"
+SNAPSHOT_VERSION = 2
+_TS_SCALE = {1: US_PER_SECOND, 2: 1}
+CODEC_MSGPACK = b"m"
+CODEC_JSON = b"j"
+
+# 帧头：帧类型、压缩后负载长度、负载 CRC32
+_FRAME_HEADER = struct.Struct(">BII")
+FRAME_END = 0
+FRAME_MESSAGES = 1
+FRAME_DIALOG = 2
+
+# 每个消息帧最多包含的消息数，决定导出和导入时的内存上限
+RECORDS_PER_FRAME = 1000
+
+
+class SnapshotError(Exception):
+    """快照文件格式错误或损坏"""
+
+
+def _encode(codec: bytes, payload: Any) -> bytes:
+    """按编码序列化负载"""
+    if codec == CODEC_MSGPACK:
+        return msgpack.packb(payload, use_bin_type=True)
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode(
+        "utf-8"
+    )
+
+
+def _decode(codec: bytes, data: bytes) -> Any:
+    """按编码反序列化负载"""
+    if codec == CODEC_MSGPACK:
+        return msgpack.unpackb(data, raw=False)
+    return json.loads(data.decode("utf-8"))
+
+
+def _write_frame(f: BinaryIO, codec: bytes, frame_type: int, payload: Any) -> int:
+    """写入一帧，返回写入的字节数"""
+    data = zlib.compress(_encode(codec, payload))
+    f.write(_FRAME_HEADER.pack(frame_type, len(data), zlib.crc32(data)))
+    f.write(data)
+    return _FRAME_HEADER.size + len(data)
+
+
+def _read_exact(f: BinaryIO, size: int) -> bytes:
+    """读取恰好 size 个字节，文件提前结束时报错"""
+    data = f.read(size)
+    if len(data) != size:
+        raise SnapshotError("快照文件被截断")
+    return data
+
+
+def _iter_frames(f: BinaryIO, codec: bytes) -> Iterator[Tuple[int, Any]]:
+    """逐帧读取并校验快照，读到结束帧为止"""
+    while True:
+        frame_type, length, crc = _FRAME_HEADER.unpack(
+            _read_exact(f, _FRAME_HEADER.size)
+        )
+        data = _read_exact(f, length)
+        if zlib.crc32(data) != crc:
+            raise SnapshotError("快照帧校验失败")
+        payload = _decode(codec, zlib.decompress(data))
+        yield frame_type, payload
+        if frame_type == FRAME_END:
+            return
+
+
+def _chunks(records: Iterator[Any], size: int) -> Iterator[List[Any]]:
+    """把记录流切分为最多 size 条一组"""
+    chunk: List[Any] = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def export_snapshot(store, path: str) -> Dict[str, int]:
+    """把存储中的全部群消息和对话历史导出到快照文件
+
+    逐个聊天流式读取，每帧最多 RECORDS_PER_FRAME 条消息，内存占用与聊天规模无关。
+    先写入临时文件，完成后原子替换目标文件。
+
+    Returns:
+        Dict[str, int]: 导出的聊天数、消息数、对话数和文件字节数
+    """
+    codec = CODEC_MSGPACK if msgpack is not None else CODEC_JSON
+    store.flush()
+    counts = {"chats": 0, "messages": 0, "dialogs": 0, "bytes": 0}
+
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(SNAPSHOT_MAGIC + bytes([SNAPSHOT_VERSION]) + codec)
+            counts["bytes"] += len(SNAPSHOT_MAGIC) + 2
+
+            for chat_id in sorted(set(store.get_chat_ids())):
+                exported = 0
+                records = store.iter_chat_records(chat_id)
+                for chunk in _chunks(records, RECORDS_PER_FRAME):
+                    counts["bytes"] += _write_frame(
+                        f,
+                        codec,
+                        FRAME_MESSAGES,
+                        {"chat_id": chat_id, "records": [list(r) for r in chunk]},
+                    )
+                    exported += len(chunk)
+                if exported:
+                    counts["chats"] += 1
+                    counts["messages"] += exported
+                _release(store, chat_id)
+
+            for chat_id in sorted(set(store.get_dialog_chat_ids())):
+                messages = store.export_dialog(chat_id)
+                if not messages:
+                    continue
+                counts["bytes"] += _write_frame(
+                    f, codec, FRAME_DIALOG, {"chat_id": chat_id, "messages": messages}
+                )
+                counts["dialogs"] += 1
+
+            counts["bytes"] += _write_frame(
+                f, codec, FRAME_END, {k: v for k, v in counts.items() if k != "bytes"}
+            )
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    logger.info(
+        f"快照导出完成: {path}, 聊天 {counts['chats']} 个, 消息 {counts['messages']} 条, "
+        f"对话 {counts['dialogs']} 个, {counts['bytes']} 字节"
+    )
+    return counts
+
+
+def import_snapshot(store, path: str, force: bool = False) -> Dict[str, int]:
+    """把快照文件批量导入存储
+
+    逐帧读取和写入，每帧写入后立即刷新，一个聊天导入完成后尝试把它移出内存。
+    目标存储已有消息时默认拒绝导入，force 为 True 时追加到已有数据之后。
+    每个聊天导入后核对存储中的消息数，被目标后端按保留上限裁剪掉的条数
+    记录警告并计入返回值的 dropped。
+
+    Raises:
+        SnapshotError: 快照格式错误、损坏或需要未安装的 msgpack
+        ValueError: 目标存储非空且未指定 force
+    """
+    if not force and (store.get_chat_ids() or store.get_dialog_chat_ids()):
+        raise ValueError("目标存储中已有数据，如需追加请使用 force")
+
+    counts = {"chats": 0, "messages": 0, "dialogs": 0}
+    dropped = 0
+    current_chat: Optional[int] = None
+    expected_total = 0  # 当前聊天导入后应有的消息数
+    with open(path, "rb") as f:
+        header = f.read(len(SNAPSHOT_MAGIC) + 2)
+        if len(header) != len(SNAPSHOT_MAGIC) + 2 or not header.startswith(
+            SNAPSHOT_MAGIC
+        ):
+            raise SnapshotError("不是有效的快照文件")
+        version, codec = header[-2], header[-1:]
+        if version not in _TS_SCALE:
+            raise SnapshotError(f"不支持的快照版本: {version}")
+        if codec not in (CODEC_MSGPACK, CODEC_JSON):
+            raise SnapshotError(f"未知的快照编码: {codec!r}")
+        if codec == CODEC_MSGPACK and msgpack is None:
+            raise SnapshotError("该快照使用 msgpack 编码，请先安装 msgpack")
+
+        scale = _TS_SCALE[version]
+        expected = None
+        for frame_type, payload in _iter_frames(f, codec):
+            if frame_type == FRAME_MESSAGES:
+                chat_id = int(payload["chat_id"])
+                if chat_id != current_chat:
+                    if current_chat is not None:
+                        dropped += _check_trimmed(store, current_chat, expected_total)
+                        _release(store, current_chat)
+                    current_chat = chat_id
+                    counts["chats"] += 1
+                    expected_total = _count_all(store, chat_id)
+                records = [
+                    (int(ts) * scale, int(user_id), username, message)
+                    for ts, user_id, username, message in payload["records"]
+                ]
+                store.import_messages(chat_id, records)
+                store.flush()
+                counts["messages"] += len(records)
+                expected_total += len(records)
+            elif frame_type == FRAME_DIALOG:
+                store.import_dialog(int(payload["chat_id"]), payload["messages"])
+                counts["dialogs"] += 1
+            elif frame_type == FRAME_END:
+                expected = payload
+            else:
+                raise SnapshotError(f"未知的快照帧类型: {frame_type}")
+
+    if current_chat is not None:
+        dropped += _check_trimmed(store, current_chat, expected_total)
+        _release(store, current_chat)
+    store.flush()
+
+    if expected != counts:
+        logger.warning(f"快照导入数量与记录不一致 - 导入: {counts}, 记录: {expected}")
+    logger.info(
+        f"快照导入完成: {path}, 聊天 {counts['chats']} 个, 消息 {counts['messages']} 条, "
+        f"对话 {counts['dialogs']} 个"
+    )
+    if dropped:
+        logger.warning(f"目标存储按保留上限裁剪了 {dropped} 条较早的消息")
+    counts["dropped"] = dropped
+    return counts
+
+
+def _count_all(store, chat_id: int) -> int:
+    """聊天在存储中的全部消息数"""
+    epoch = datetime.fromtimestamp(0, timezone.utc)
+    return store.count_messages_between(chat_id, epoch)
+
+
+def _check_trimmed(store, chat_id: int, expected: int) -> int:
+    """核对聊天导入后的消息数，返回被裁剪的条数
+
+    SQLite 和 Redis 后端每个聊天只保留最近 MAX_MESSAGES_PER_CHAT 条消息，
+    文件存储的归档也可能按字节预算删除旧段。
+    """
+    store.flush()
+    trimmed = expected - _count_all(store, chat_id)
+    if trimmed > 0:
+        logger.warning(f"聊天 {chat_id} 导入后被裁剪 {trimmed} 条较早的消息")
+    return max(0, trimmed)
+
+
+def _release(store, chat_id: int):
+    """刷新并卸载一个聊天，使导出和导入过程中常驻内存的聊天保持在一个左右"""
+    unload_chat = getattr(store, "unload_chat", None)
+    if unload_chat is None:
+        return
+    store.flush()
+    unload_chat(chat_id)
@@ -0,0 +1,124 @@
+"""
+延迟写入（write-behind）调度模块
+修改先记录在存储的待写队列中，由后台任务按时间间隔或队列长度批量写盘
+"""
+
+import asyncio
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from loguru import logger
+
+
+class WriteBehindFlusher:
+    """后台批量刷新器
+
+    flush_fn 负责把存储中所有待写数据落盘并返回写入的记录数，
+    depth_fn 返回当前尚未落盘的记录数。
+    后台任务未启动时，notify 会立即同步刷新，保持逐条写入的行为。
+    """
+
+    def __init__(
+        self,
+        flush_fn: Callable[[], int],
+        depth_fn: Callable[[], int],
+        interval: float = 1.0,
+        max_pending: int = 200,
+    ):
+        self.flush_fn = flush_fn
+        self.depth_fn = depth_fn
+        self.interval = max(0.05, interval)
+        self.max_pending = max(1, max_pending)
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stats: Dict[str, Any] = {
+            "flushes": 0,
+            "records_flushed": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "total_flush_ms": 0.0,
+            "errors": 0,
+        }
+
+    @property
+    def running(self) -> bool:
+        """后台任务是否在运行"""
+        return self._task is not None and not self._task.done()
+
+    def notify(self):
+        """有新的待写数据；队列达到阈值时唤醒后台任务"""
+        if not self.running:
+            self.flush_now()
+            return
+
+        if self.depth_fn() >= self.max_pending and self._loop and self._wakeup:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def flush_now(self) -> int:
+        """同步刷新所有待写数据，并记录耗时"""
+        with self._lock:
+            started = time.perf_counter()
+            try:
+                written = self.flush_fn()
+            except Exception as e:
+                self._stats["errors"] += 1
+                logger.error(f"批量写入数据时出错: {e}")
+                return 0
+
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            if written:
+                stats = self._stats
+                stats["flushes"] += 1
+                stats["records_flushed"] += written
+                stats["last_flush_ms"] = elapsed_ms
+                stats["max_flush_ms"] = max(stats["max_flush_ms"], elapsed_ms)
+                stats["total_flush_ms"] += elapsed_ms
+            return written
+
+    def start(self):
+        """在当前事件循环中启动后台刷新任务"""
+        if self.running:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = self._loop.create_task(self._run())
+        logger.info(
+            f"延迟写入已启动 - 间隔: {self.interval}s, 队列阈值: {self.max_pending}"
+        )
+
+    async def stop(self):
+        """停止后台任务并执行最后一次刷新"""
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        written = self.flush_now()
+        logger.info(f"延迟写入已停止，最终写入 {written} 条记录")
+
+    async def _run(self):
+        """后台循环：等待间隔或唤醒后在线程池中刷新"""
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            if self.depth_fn():
+                await loop.run_in_executor(None, self.flush_now)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取刷新延迟和队列深度等指标"""
+        stats = dict(self._stats)
+        flushes = stats["flushes"]
+        stats["avg_flush_ms"] = stats["total_flush_ms"] / flushes if flushes else 0.0
+        stats["queue_depth"] = self.depth_fn()
+        stats["running"] = self.running
+        return stats
@@ -0,0 +1,109 @@
+"""
+崩溃安全的文件读写工具
+整体写入通过临时文件加原子重命名完成，追加日志的每一行带有 CRC32 校验和
+"""
+
+import json
+import os
+import zlib
+from typing import Any, List, Optional
+
+
+def atomic_write_text(path: str, text: str, fsync: bool = False):
+    """原子地写入文本文件，参见 atomic_write_bytes"""
+    atomic_write_bytes(path, text.encode("utf-8"), fsync)
+
+
+def atomic_write_bytes(path: str, data: bytes, fsync: bool = False):
+    """原子地写入文件
+
+    先写入同目录下的临时文件，再用 os.replace 替换目标文件。
+    进程在任意时刻中断时，目标文件要么是旧内容，要么是完整的新内容。
+    fsync 为 True 时在替换前后分别同步文件和所在目录。
+    """
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    if fsync:
+        fsync_dir(os.path.dirname(path) or ".")
+
+
+def fsync_dir(path: str):
+    """同步目录项，确保重命名在断电后仍然生效（不支持的平台上忽略）"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def checksum_line(payload: str) -> str:
+    """为一行日志加上校验和前缀：“8 位十六进制 CRC32<TAB>内容”"""
+    return f"{zlib.crc32(payload.encode('utf-8')):08x}\t{payload}"
+
+
+def verify_line(line: str) -> Optional[str]:
+    """校验一行日志并返回其内容，校验失败时返回 None
+
+    兼容旧版不带校验和的 JSON 行：以 { 开头且能完整解析时视为有效。
+    """
+    if len(line) > 9 and line[8] == "\t":
+        payload = line[9:]
+        try:
+            expected = int(line[:8], 16)
+        except ValueError:
+            return None
+        if zlib.crc32(payload.encode("utf-8")) == expected:
+            return payload
+        return None
+
+    if line.startswith("{"):
+        try:
+            json.loads(line)
+        except json.JSONDecodeError:
+            return None
+        return line
+
+    return None
+
+
+def salvage_json_array(text: str) -> List[Any]:
+    """从可能被截断的 JSON 数组文本中尽量取出完整的元素
+
+    逐个解码数组元素，遇到第一个无法解析的位置即停止，返回此前的所有元素。
+    """
+    decoder = json.JSONDecoder()
+    items: List[Any] = []
+    pos = text.find("[")
+    if pos < 0:
+        return items
+    pos += 1
+
+    length = len(text)
+    while pos < length:
+        while pos < length and text[pos] in " \t\r\n,":
+            pos += 1
+        if pos >= length or text[pos] == "]":
+            break
+        try:
+            item, pos = decoder.raw_decode(text, pos)
+        except json.JSONDecodeError:
+            break
+        items.append(item)
+
+    return items
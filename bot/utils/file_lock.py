@@ -0,0 +1,102 @@
+"""
+跨进程的文件锁
+基于 fcntl.flock 的建议锁，用于协调多个进程对同一数据目录的读写；
+不支持 fcntl 的平台（Windows）上退化为不加锁
+"""
+
+import os
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class FileLock:
+    """基于锁文件的共享 / 排他锁
+
+    同一实例可在同一线程中重入，只有最外层的获取和释放会真正调用 flock；
+    重入时锁的模式以最外层为准。flock 锁属于打开的文件，同一进程中对同一锁文件
+    创建的多个实例之间也会互斥。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+        self._depth = 0
+        self._lock = threading.RLock()
+
+    @property
+    def supported(self) -> bool:
+        """当前平台是否支持跨进程加锁"""
+        return fcntl is not None
+
+    def _open(self):
+        """打开锁文件，不截断已有内容"""
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._file = open(self.path, "a+b")
+        return self._file
+
+    def acquire(self, shared: bool = False, blocking: bool = True) -> bool:
+        """获取锁，blocking 为 False 且锁被其他进程持有时立即返回 False"""
+        self._lock.acquire()
+        if self._depth == 0 and fcntl is not None:
+            flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+            if not blocking:
+                flags |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(self._open().fileno(), flags)
+            except BlockingIOError:
+                self._lock.release()
+                return False
+            except BaseException:
+                self._lock.release()
+                raise
+        self._depth += 1
+        return True
+
+    def release(self):
+        """释放一层锁，最外层释放时解除 flock"""
+        self._depth -= 1
+        if self._depth == 0 and self._file is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._lock.release()
+
+    @contextmanager
+    def shared(self) -> Iterator[None]:
+        """在共享锁内执行，多个读者可以同时持有"""
+        self.acquire(shared=True)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @contextmanager
+    def exclusive(self) -> Iterator[None]:
+        """在排他锁内执行，与所有共享锁和排他锁互斥"""
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def close(self):
+        """关闭锁文件，同时释放仍持有的锁"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self._depth = 0
+
+
+def read_generation(path: str) -> Optional[int]:
+    """读取代数文件中的整数，文件不存在或内容无效时返回 None"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
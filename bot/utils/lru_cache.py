@@ -0,0 +1,96 @@
+"""
+线程安全的 LRU 缓存
+支持容量上限、可选的过期时间以及命中率统计
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable
+
+
+class LRUCache:
+    """有界 LRU 缓存
+
+    超过 max_size 时淘汰最久未使用的条目；ttl 大于 0 时，
+    超过 ttl 秒未写入的条目在读取时视为过期。max_size 为 0 时不缓存任何内容。
+    """
+
+    def __init__(self, max_size: int = 256, ttl: float = 0):
+        self.max_size = max(0, max_size)
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()  # key -> (写入时间, 值)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.peek(key) is not None
+
+    def _expired(self, stored_at: float) -> bool:
+        """判断写入时间为 stored_at 的条目是否已过期"""
+        return self.ttl > 0 and time.monotonic() - stored_at > self.ttl
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """读取缓存并更新最近使用顺序，计入命中率统计"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or self._expired(item[0]):
+                if item is not None:
+                    del self._data[key]
+                    self.evictions += 1
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """读取缓存但不改变使用顺序，也不计入统计"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or self._expired(item[0]):
+                return default
+            return item[1]
+
+    def put(self, key: Hashable, value: Any):
+        """写入缓存，必要时淘汰最久未使用的条目"""
+        if self.max_size == 0:
+            return
+
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """移除并返回缓存条目"""
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[1]
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._data.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取容量和命中率统计"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / total if total else 0.0,
+            }
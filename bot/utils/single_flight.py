@@ -0,0 +1,48 @@
+"""
+单飞（single-flight）请求合并
+同一个键同时只执行一次异步调用，并发到达的相同请求等待同一个结果
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """合并并发的相同异步调用
+
+    第一个到达的调用创建共享任务，键相同的后续调用在任务完成前直接等待它，
+    结果或异常分发给所有等待者；任务完成后键即释放，之后的调用重新执行。
+    某个等待者被取消不会取消共享任务，其他等待者照常得到结果。
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self.calls = 0
+        self.executions = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        """执行 fn，或等待键相同的进行中调用的结果"""
+        self.calls += 1
+        task = self._inflight.get(key)
+        if task is None:
+            self.executions += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取调用次数、实际执行次数和被合并的次数"""
+        return {
+            "calls": self.calls,
+            "executions": self.executions,
+            "coalesced": self.coalesced,
+            "inflight": len(self._inflight),
+            "coalesced_ratio": self.coalesced / self.calls if self.calls else 0.0,
+        }
@@ -0,0 +1,146 @@
+"""
+流式回复
+把逐段到达的 AI 回复节流地编辑到 Telegram 消息中，超过单条消息长度时续发新消息
+"""
+
+import asyncio
+import time
+from typing import List, Optional
+
+from loguru import logger
+from md2tgmd import escape
+from telegram import Message
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+# Telegram 单条消息的最大长度
+TELEGRAM_MESSAGE_LIMIT = 4096
+# 续发的消息以未闭合的代码块开头时，重新打开代码块
+_CODE_FENCE = "```"
+
+
+def render_markdown_v2(text: str) -> str:
+    """把可能不完整的 Markdown 转换为 MarkdownV2，未闭合的代码块先补上结束标记"""
+    if text.count(_CODE_FENCE) % 2:
+        text += "\n" + _CODE_FENCE
+    return escape(text)
+
+
+def split_point(text: str, limit: int) -> int:
+    """返回切分位置，使 text[:位置] 渲染后不超过 limit，尽量在换行处切分"""
+    end = len(text)
+    rendered = len(render_markdown_v2(text))
+    while end > 1 and rendered > limit:
+        end = max(1, min(end - 1, end * limit // rendered))
+        rendered = len(render_markdown_v2(text[:end]))
+    newline = text.rfind("\n", 0, end)
+    if newline > end // 2:
+        return newline + 1
+    return end
+
+
+class StreamingReply:
+    """把流式生成的回复渐进地显示在一条或多条 Telegram 消息中
+
+    第一段内容立即显示，之后每隔 min_interval 秒最多编辑一次；遇到 RetryAfter 时
+    推迟到 Telegram 允许的时间，最终内容总会写入。每次编辑都把到目前为止的完整文本
+    重新转换为 MarkdownV2，Telegram 仍拒绝解析时退回纯文本。
+    当前消息渲染后超过 limit 时在换行处切分：前半部分定稿，其余内容续发到新消息。
+    """
+
+    def __init__(
+        self,
+        placeholder: Message,
+        min_interval: float = 1.0,
+        limit: int = TELEGRAM_MESSAGE_LIMIT,
+    ):
+        self.messages: List[Message] = [placeholder]
+        self.min_interval = min_interval
+        self.limit = limit
+        self.text = ""
+        self._offset = 0  # 当前消息从 text 的哪个位置开始
+        self._prefix = ""  # 当前消息开头补上的代码块标记
+        self._shown = ""  # 当前消息最近一次成功显示的内容
+        self._next_edit = 0.0
+        self.started = time.monotonic()
+        self.first_visible: Optional[float] = None  # 首次显示内容的耗时（秒）
+        self.edits = 0
+
+    async def append(self, delta: str):
+        """追加一段回复，距上次编辑超过间隔时更新显示"""
+        if not delta:
+            return
+        self.text += delta
+        if time.monotonic() >= self._next_edit:
+            await self._render(final=False)
+
+    async def finish(self) -> str:
+        """显示完整回复并返回原始文本"""
+        await self._render(final=True)
+        if self.first_visible is not None:
+            logger.info(
+                f"流式回复完成 - 首次显示耗时: {self.first_visible:.2f}s, "
+                f"总耗时: {time.monotonic() - self.started:.2f}s, "
+                f"编辑次数: {self.edits}, 消息数: {len(self.messages)}"
+            )
+        return self.text
+
+    async def _render(self, final: bool):
+        """更新当前消息，超出长度时先定稿并续发新消息"""
+        body = self._prefix + self.text[self._offset :]
+        while len(render_markdown_v2(body)) > self.limit:
+            cut = split_point(body, self.limit)
+            head = body[:cut]
+            if not await self._edit(head, wait=True):
+                return
+            self._offset += max(1, cut - len(self._prefix))
+            self._prefix = _CODE_FENCE + "\n" if head.count(_CODE_FENCE) % 2 else ""
+            try:
+                self.messages.append(await self.messages[-1].reply_text("…"))
+            except TelegramError as e:
+                logger.warning(f"续发流式回复消息失败: {e}")
+                return
+            self._shown = ""
+            body = self._prefix + self.text[self._offset :]
+
+        await self._edit(body, wait=final)
+
+    async def _edit(self, body: str, wait: bool) -> bool:
+        """把当前消息编辑为 body；wait 为真时遇到限流等待后重试，否则推迟下次编辑"""
+        if not body.strip() or body == self._shown:
+            return True
+
+        message = self.messages[-1]
+        while True:
+            try:
+                try:
+                    await message.edit_text(
+                        render_markdown_v2(body), parse_mode="MarkdownV2"
+                    )
+                except BadRequest as e:
+                    if "not modified" in str(e).lower():
+                        return True
+                    # 转换结果仍无法解析时退回纯文本，保证内容可见
+                    await message.edit_text(body[: self.limit])
+                break
+            except RetryAfter as e:
+                delay = float(e.retry_after)
+                if not wait:
+                    self._next_edit = time.monotonic() + delay
+                    return False
+                await asyncio.sleep(delay)
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    return True
+                logger.warning(f"编辑流式回复消息失败: {e}")
+                return False
+            except TelegramError as e:
+                logger.warning(f"编辑流式回复消息失败: {e}")
+                self._next_edit = time.monotonic() + self.min_interval
+                return False
+
+        self._shown = body
+        self.edits += 1
+        self._next_edit = time.monotonic() + self.min_interval
+        if self.first_visible is None:
+            self.first_visible = time.monotonic() - self.started
+        return True
@@ -0,0 +1,37 @@
+"""
+文本预算工具
+按字节数或估算的 token 数截断逐行产出的文本，调用方可以在预算用完时提前停止读取
+"""
+
+import re
+from typing import Iterable, Iterator
+
+# 中日韩文字（汉字、假名、谚文）的字符范围，每个字大约对应一个 token
+CJK_CHARS = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af"
+_CJK_RE = re.compile(f"[{CJK_CHARS}]")
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算文本的 token 数：中日韩文字按每字 1 个，其余字符按每 4 个 1 个"""
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def limit_by_budget(
+    lines: Iterable[str], max_bytes: int = 0, max_tokens: int = 0
+) -> Iterator[str]:
+    """依次产出文本行，直到下一行会超出字节或 token 预算为止
+
+    每行额外计入一个换行符。预算为 0 表示不限制；预算用完后不再从 lines 读取。
+    """
+    used_bytes = used_tokens = 0
+    for line in lines:
+        if max_bytes > 0:
+            used_bytes += len(line.encode("utf-8")) + 1
+            if used_bytes > max_bytes:
+                return
+        if max_tokens > 0:
+            used_tokens += estimate_tokens(line) + 1
+            if used_tokens > max_tokens:
+                return
+        yield line
@@ -32,6 +32,8 @@ class ConfigManager:
         self.env_path = env_path
         self.config: Dict[str, Any] = {}
         self._lock = threading.Lock()
+        # 配置版本号，每次修改或重新加载配置时递增
+        self._version = 0
         self.redis_client = None
         self._init_redis()
         self.load_config()
@@ -118,6 +120,7 @@ class ConfigManager:
                     elif not isinstance(config_data, str):
                         config_data = str(config_data)
                     self.config = json.loads(config_data)
+                    self._version += 1
                 return True
             return False
         except Exception as e:
@@ -192,6 +195,80 @@ class ConfigManager:
                         == "true",
                         "max_results": int(os.getenv("SEARCH_MAX_RESULTS", "5")),
                     },
+                    "routing": {
+                        "strategy": os.getenv("AI_ROUTING_STRATEGY", "priority").lower(),
+                        "failure_threshold": int(
+                            os.getenv("AI_BREAKER_FAILURE_THRESHOLD", "5")
+                        ),
+                        "recovery_timeout": float(
+                            os.getenv("AI_BREAKER_RECOVERY_TIMEOUT", "30")
+                        ),
+                        "ewma_alpha": float(os.getenv("AI_ROUTING_EWMA_ALPHA", "0.3")),
+                        "probe_interval": float(
+                            os.getenv("AI_HEALTH_PROBE_INTERVAL", "60")
+                        ),
+                        "probe_timeout": float(
+                            os.getenv("AI_HEALTH_PROBE_TIMEOUT", "10")
+                        ),
+                    },
+                    "scheduler": {
+                        "max_concurrency": int(os.getenv("AI_MAX_CONCURRENCY", "8")),
+                        "scheduled_share": float(
+                            os.getenv("AI_SCHEDULED_SHARE", "0.5")
+                        ),
+                        "queue_limits": {
+                            "interactive": int(
+                                os.getenv("AI_QUEUE_INTERACTIVE", "50")
+                            ),
+                            "manual": int(os.getenv("AI_QUEUE_MANUAL", "20")),
+                            "scheduled": int(os.getenv("AI_QUEUE_SCHEDULED", "200")),
+                        },
+                        "deadlines": {
+                            "interactive": float(
+                                os.getenv("AI_DEADLINE_INTERACTIVE", "30")
+                            ),
+                            "manual": float(os.getenv("AI_DEADLINE_MANUAL", "120")),
+                            "scheduled": float(
+                                os.getenv("AI_DEADLINE_SCHEDULED", "900")
+                            ),
+                        },
+                    },
+                    "http": {
+                        "max_connections": int(
+                            os.getenv("OPENAI_HTTP_MAX_CONNECTIONS", "50")
+                        ),
+                        "max_keepalive_connections": int(
+                            os.getenv("OPENAI_HTTP_MAX_KEEPALIVE", "20")
+                        ),
+                        "keepalive_expiry": float(
+                            os.getenv("OPENAI_HTTP_KEEPALIVE_EXPIRY", "60")
+                        ),
+                        "timeout": float(os.getenv("OPENAI_HTTP_TIMEOUT", "120")),
+                        "connect_timeout": float(
+                            os.getenv("OPENAI_HTTP_CONNECT_TIMEOUT", "5")
+                        ),
+                    },
+                    "response_cache": {
+                        "enabled": os.getenv("AI_CACHE_ENABLED", "true").lower()
+                        == "true",
+                        "max_size": int(os.getenv("AI_CACHE_MAX_SIZE", "512")),
+                        "ttl": float(os.getenv("AI_CACHE_TTL", "3600")),
+                        "stale_ttl": float(os.getenv("AI_CACHE_STALE_TTL", "86400")),
+                        "redis_enabled": os.getenv(
+                            "AI_CACHE_REDIS_ENABLED", "true"
+                        ).lower()
+                        == "true",
+                        "redis_key_prefix": os.getenv(
+                            "AI_CACHE_REDIS_PREFIX", "snaily:ai_cache:"
+                        ),
+                        "disabled_features": [
+                            x.strip()
+                            for x in os.getenv(
+                                "AI_CACHE_DISABLED_FEATURES", "chat,search"
+                            ).split(",")
+                            if x.strip()
+                        ],
+                    },
                 },
                 "features": {
                     "welcome_message": {
@@ -218,6 +295,9 @@ class ConfigManager:
                             "AUTO_SUMMARY_PROMPT",
                             "请总结以下群聊对话的主要内容和话题：",
                         ).replace("\\n", "\n"),
+                        "max_input_tokens": int(
+                            os.getenv("AUTO_SUMMARY_MAX_INPUT_TOKENS", "16000")
+                        ),
                     },
                     "chat": {
                         "enabled": os.getenv("CHAT_ENABLED", "true").lower() == "true",
@@ -239,6 +319,13 @@ class ConfigManager:
                         "short_message_threshold": int(
                             os.getenv("SHORT_MESSAGE_THRESHOLD", "1024")
                         ),
+                        "stream_enabled": os.getenv(
+                            "CHAT_STREAM_ENABLED", "true"
+                        ).lower()
+                        == "true",
+                        "stream_edit_interval": float(
+                            os.getenv("CHAT_STREAM_EDIT_INTERVAL", "1.0")
+                        ),
                     },
                     "drawing": {
                         "enabled": os.getenv("DRAWING_ENABLED", "true").lower()
@@ -281,6 +368,63 @@ class ConfigManager:
                         ),
                     },
                 },
+                "storage": {
+                    "backend": os.getenv("MESSAGE_STORE_BACKEND", "file").lower(),
+                    "sqlite_path": os.getenv(
+                        "MESSAGE_STORE_SQLITE_PATH", "data/messages.db"
+                    ),
+                    "sqlite_batch_size": int(
+                        os.getenv("MESSAGE_STORE_SQLITE_BATCH_SIZE", "50")
+                    ),
+                    "redis_key_prefix": os.getenv(
+                        "MESSAGE_STORE_REDIS_PREFIX", "snaily:"
+                    ),
+                    "redis_batch_size": int(
+                        os.getenv("MESSAGE_STORE_REDIS_BATCH_SIZE", "50")
+                    ),
+                    "lazy_load": os.getenv("MESSAGE_STORE_LAZY_LOAD", "true").lower()
+                    == "true",
+                    "read_only": os.getenv(
+                        "MESSAGE_STORE_READ_ONLY", "false"
+                    ).lower()
+                    == "true",
+                    "write_behind": os.getenv(
+                        "MESSAGE_STORE_WRITE_BEHIND", "true"
+                    ).lower()
+                    == "true",
+                    "flush_interval": float(
+                        os.getenv("MESSAGE_STORE_FLUSH_INTERVAL", "1.0")
+                    ),
+                    "flush_max_pending": int(
+                        os.getenv("MESSAGE_STORE_FLUSH_MAX_PENDING", "200")
+                    ),
+                    "fsync": os.getenv("MESSAGE_STORE_FSYNC", "never").lower(),
+                    "dialog_cache_size": int(
+                        os.getenv("MESSAGE_STORE_DIALOG_CACHE_SIZE", "256")
+                    ),
+                    "dialog_cache_ttl": float(
+                        os.getenv("MESSAGE_STORE_DIALOG_CACHE_TTL", "0")
+                    ),
+                    "io_workers": int(os.getenv("MESSAGE_STORE_IO_WORKERS", "4")),
+                    "archive_enabled": os.getenv(
+                        "MESSAGE_STORE_ARCHIVE", "true"
+                    ).lower()
+                    == "true",
+                    "archive_max_bytes": int(
+                        os.getenv("MESSAGE_STORE_ARCHIVE_MAX_BYTES", "20971520")
+                    ),
+                    "memory_budget_mb": int(
+                        os.getenv("MESSAGE_STORE_MEMORY_BUDGET_MB", "256")
+                    ),
+                    "evict_idle_seconds": float(
+                        os.getenv("MESSAGE_STORE_EVICT_IDLE_SECONDS", "300")
+                    ),
+                    "index_enabled": os.getenv("MESSAGE_STORE_INDEX", "true").lower()
+                    == "true",
+                    "index_max_docs": int(
+                        os.getenv("MESSAGE_STORE_INDEX_MAX_DOCS", "5000")
+                    ),
+                },
                 "webapp": {
                     "host": os.getenv("WEBAPP_HOST", "0.0.0.0"),
                     "port": int(os.getenv("WEBAPP_PORT", "5000")),
@@ -297,6 +441,7 @@ class ConfigManager:
                 },
             }
 
+            self._version += 1
             logger.info("配置从环境变量加载成功")
 
     def _get_secret_key(self) -> str:
@@ -337,6 +482,15 @@ class ConfigManager:
             logger.error(f"从环境变量重新加载配置失败: {e}")
             raise
 
+    @property
+    def version(self) -> int:
+        """配置版本号
+
+        单调递增，配置被修改或重新加载后变化。依赖配置构建的对象（如 AI 客户端）
+        可以记录构建时的版本，版本不变时直接复用，无需加锁读取并比较配置。
+        """
+        return self._version
+
     def get(self, key: str, default: Any = None) -> Any:
         """获取配置值，支持点号分隔的嵌套键"""
         with self._lock:
@@ -364,6 +518,7 @@ class ConfigManager:
 
             # 设置值
             config[keys[-1]] = value
+            self._version += 1
 
     def get_telegram_config(self) -> Dict[str, Any]:
         """获取 Telegram 相关配置"""
@@ -377,6 +532,10 @@ class ConfigManager:
         """获取功能配置"""
         return self.get("features", {})
 
+    def get_storage_config(self) -> Dict[str, Any]:
+        """获取消息存储配置"""
+        return self.get("storage", {})
+
     def get_webapp_config(self) -> Dict[str, Any]:
         """获取 Web 应用配置"""
         return self.get("webapp", {})
@@ -429,6 +588,7 @@ class ConfigManager:
                     else:
                         # 如果是部分更新，递归合并到现有配置
                         self._merge_config(self.config, updated_config)
+                self._version += 1
 
                 # 同步到 Redis
                 if self.redis_client:
@@ -183,6 +183,21 @@ def main():
         logger.warning(f"⚠️ {e}")
         logger.info("AI 功能将不可用，请在配置中设置 OpenAI API Key")
 
+    # 检查消息存储：数据目录已被其他进程写入或配置为只读时拒绝启动，
+    # 否则机器人收到的消息都无法保存
+    from bot.services.message_store import StoreLockedError, get_message_store
+
+    try:
+        if getattr(get_message_store(), "read_only", False):
+            logger.error("❌ 消息存储配置为只读模式，机器人无法保存消息")
+            logger.info("请在机器人进程中设置 MESSAGE_STORE_READ_ONLY=false")
+            sys.exit(1)
+        logger.info("✅ 消息存储已打开")
+    except StoreLockedError as e:
+        logger.error(f"❌ {e}")
+        logger.info("请先停止占用数据目录的进程（如另一个机器人实例或快照导入脚本）")
+        sys.exit(1)
+
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
 
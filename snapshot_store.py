@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+消息存储快照工具
+把当前配置的存储后端导出为快照文件，或从快照文件恢复；
+导出后修改 MESSAGE_STORE_BACKEND 再导入，即可在不同后端之间迁移数据
+"""
+
+import argparse
+import sys
+
+from loguru import logger
+
+from bot.services.store_snapshot import SnapshotError, export_snapshot, import_snapshot
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="消息存储快照导出与恢复")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="导出全部群消息和对话历史")
+    export_parser.add_argument("path", help="快照文件路径")
+
+    import_parser = subparsers.add_parser("import", help="从快照文件恢复")
+    import_parser.add_argument("path", help="快照文件路径")
+    import_parser.add_argument(
+        "--force", action="store_true", help="目标存储已有数据时仍然导入（追加）"
+    )
+    args = parser.parse_args()
+
+    # 逐条的调试日志会淹没进度信息，只保留信息级别以上
+    logger.remove()
+    logger.add(sys.stderr, level="INFO")
+
+    from bot.services.message_store import StoreLockedError, create_message_store
+
+    # 自行创建存储实例：导出只需读取，机器人运行时也可以导出；
+    # 导入需要写入权，数据目录正被机器人写入时拒绝导入
+    try:
+        message_store = create_message_store(
+            read_only=True if args.command == "export" else None
+        )
+    except StoreLockedError as e:
+        print(f"❌ {e}，请先停止机器人再导入", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        if args.command == "export":
+            counts = export_snapshot(message_store, args.path)
+            print(
+                f"✅ 已导出 {counts['chats']} 个聊天的 {counts['messages']} 条消息和 "
+                f"{counts['dialogs']} 个对话历史到 {args.path}"
+            )
+        else:
+            counts = import_snapshot(message_store, args.path, force=args.force)
+            print(
+                f"✅ 已导入 {counts['chats']} 个聊天的 {counts['messages']} 条消息和 "
+                f"{counts['dialogs']} 个对话历史"
+            )
+            if counts["dropped"]:
+                print(
+                    f"⚠️ 目标存储每个聊天只保留有限的消息，"
+                    f"{counts['dropped']} 条较早的消息未能保留"
+                )
+    except (SnapshotError, ValueError, OSError) as e:
+        print(f"❌ {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        message_store.flush()
+        if hasattr(message_store, "close"):
+            message_store.close()
+
+
+if __name__ == "__main__":
+    main()
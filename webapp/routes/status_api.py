@@ -3,7 +3,7 @@
 处理机器人状态查询
 """
 
-from flask import Blueprint, jsonify
+from flask import Blueprint, current_app, jsonify
 from loguru import logger
 
 from config.settings import config_manager
@@ -34,6 +34,32 @@ def get_status():
             },
         }
 
+        # 机器人在同一进程中运行时，附带消息存储的运行指标
+        if getattr(current_app, "bot", None):
+            from bot.services.async_message_store import async_message_store
+            from bot.services.message_store import message_store
+
+            status["storage"] = {
+                "flush": message_store.get_flush_stats(),
+                "dialog_cache": message_store.get_dialog_cache_stats(),
+                "memory": message_store.get_memory_stats(),
+                "index": async_message_store.index.get_stats()
+                if async_message_store.index
+                else None,
+            }
+
+            from bot.services.ai_services import ai_services
+            from bot.services.response_cache import response_cache
+
+            status["ai"] = {
+                "routing": ai_services.get_provider_stats(),
+                "single_flight": ai_services.get_single_flight_stats(),
+                "scheduler": ai_services.get_scheduler_stats(),
+                "response_cache": response_cache.get_stats()
+                if response_cache
+                else None,
+            }
+
         return jsonify({"success": True, "status": status})
 
     except Exception as e:
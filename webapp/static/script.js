@@ -241,6 +241,22 @@ class BotControlPanel {
             }
         ];
 
+        // AI 服务商的熔断状态、错误率和延迟（机器人在同一进程中运行时才有）
+        const routing = (status.ai || {}).routing;
+        if (routing && routing.providers) {
+            const stateText = { closed: '正常', half_open: '试探恢复', open: '已熔断' };
+            routing.providers.forEach(provider => {
+                const latency = provider.ewma_latency_ms !== null ? `${provider.ewma_latency_ms} ms` : '暂无数据';
+                const errorRate = (provider.error_rate * 100).toFixed(1);
+                statusItems.push({
+                    title: `🛰️ ${provider.name}`,
+                    enabled: provider.state === 'closed' && provider.healthy !== false,
+                    description: `${stateText[provider.state] || provider.state} · 延迟 ${latency} · 错误率 ${errorRate}% (${provider.failures}/${provider.requests})`,
+                    isConfig: true
+                });
+            });
+        }
+
         container.innerHTML = statusItems.map(item => {
             const statusClass = item.enabled ? 'status-enabled' : 
                                item.isConfig ? 'status-warning' : 'status-disabled';